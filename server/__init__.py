@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 
+import os
 import sys
 from pathlib import Path
 
@@ -10,14 +11,40 @@ app = Flask(__name__)
 
 
 # Local imports
-from server.api.separate_routes import separate_routes
+from server.api.separate_routes import separate_routes, separation_queue
 from server.api.download_stem_routes import download_stem_routes
-from server.api.clean_bucket_routes import clean_bucket_routes
+from server.api.clean_bucket_routes import clean_bucket_routes, start_periodic_sweeps, sweep_queue
+from server.api.metrics_routes import metrics_routes
+from server.api.batch_routes import batch_routes, batch_queue
+from utils.separation_engine import load_model
+from utils.install_ffmpeg import check_ffmpeg
+from utils.uploads import UploadRequest
+from utils.metrics import registry
 
 # Initialize Flask app
 app.url_map.strict_slashes = False
+# Lets /api/separate write uploaded audio straight to disk instead of spooling it; other routes parse files as usual
+app.request_class = UploadRequest
 load_dotenv()
 
+# Load the Demucs model when the worker boots instead of on the first request
+if os.getenv('DEMUCS_PRELOAD', '').lower() in ('1', 'true', 'yes'):
+    load_model()
+
+# Look for ffmpeg once; requests reuse the cached answer
+check_ffmpeg()
+
+# Start the queue workers now, so jobs left queued or abandoned by a dead worker don't wait for a submission
+separation_queue.init_app(app)
+batch_queue.init_app(app)
+sweep_queue.init_app(app)
+
+# Share this worker's metrics with the others, so any of them can answer /metrics
+registry.start()
+
+# Delete stems past their retention TTL in the background
+start_periodic_sweeps()
+
 # CORS(app, resources={
 #     r"/api/*": {
 #         "origins": "*",
@@ -28,5 +55,7 @@ load_dotenv()
 # })
 # Register blueprints
 app.register_blueprint(separate_routes, url_prefix="/api/separate")
+app.register_blueprint(batch_routes, url_prefix="/api/separate/batch")
 app.register_blueprint(download_stem_routes, url_prefix="/api/download_stem")
-app.register_blueprint(clean_bucket_routes, url_prefix="/api/clean_bucket")
\ No newline at end of file
+app.register_blueprint(clean_bucket_routes, url_prefix="/api/clean_bucket")
+app.register_blueprint(metrics_routes, url_prefix="/metrics")
\ No newline at end of file
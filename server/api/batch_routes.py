@@ -0,0 +1,336 @@
+import json
+import os
+import sys
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from flask import Blueprint, Response, jsonify, request, stream_with_context, url_for
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.batch_items import create_item_store
+from utils.inference_pool import PROCESSES
+from utils.job_queue import BULK, DONE, FAILED, QUEUED, RUNNING, JobQueue, QueueFullError, create_job_store
+from utils.model_registry import QUALITIES, UnknownModelError, choose_model, model_spec
+from utils.tracing import current_trace
+from utils.uploads import discard_upload, is_upload
+from server.api.separate_routes import (
+    ensure_ffmpeg, estimate_cost, needs_ffmpeg, parse_output, parse_window, request_client, separation_queue
+)
+
+batch_routes = Blueprint("batch", __name__)
+
+# Most items one batch may hold
+MAX_ITEMS = int(os.getenv('SEPARATION_BATCH_MAX_ITEMS', '500'))
+# Items of a batch on the separation queue at the same time; with an inference pool, one per process
+CONCURRENCY = int(os.getenv('SEPARATION_BATCH_CONCURRENCY', str(max(PROCESSES, 1))))
+# Seconds between looks at the jobs of a batch's items, or at the batch while streaming its results
+POLL_INTERVAL = float(os.getenv('SEPARATION_BATCH_POLL_INTERVAL', '0.5'))
+# Longest a streamed response holds a server worker, well under the gunicorn timeout
+STREAM_MAX_SECONDS = float(os.getenv('SEPARATION_BATCH_STREAM_MAX_SECONDS', '30'))
+
+NDJSON = 'application/x-ndjson'
+# Fields an item may set, or the request set for all of its items
+ITEM_FIELDS = ('link', 'mode', 'streaming', 'format', 'bitrate', 'model', 'quality', 'start', 'duration')
+
+
+def _error_message(error):
+    return error[0].get_json()["error"]
+
+
+def batch_item(fields):
+    """Job params of one item, validated like the form of `/api/separate`.
+
+    Returns `(params, error)` with an error message for a bad item.
+    """
+    link = fields.get('link')
+    if not link or not isinstance(link, str):
+        return None, "No audio URL provided"
+    window, error = parse_window(fields)
+    if error:
+        return None, _error_message(error)
+    output, error = parse_output(fields, window)
+    if error:
+        return None, _error_message(error)
+    params = {
+        'link': link,
+        'mode': str(fields.get('mode') or '2'),
+        'streaming': str(fields.get('streaming', '')).lower() in ('1', 'true', 'yes'),
+        'format': output[0],
+        'bitrate': output[1]
+    }
+    if window:
+        params['window'] = list(window)
+    quality = str(fields.get('quality') or '').lower() or None
+    if quality and quality not in QUALITIES:
+        return None, f"quality must be one of {', '.join(QUALITIES)}"
+    try:
+        params['model'] = choose_model(fields.get('model'), quality, bool(window), None)
+    except UnknownModelError as e:
+        return None, str(e)
+    return params, None
+
+
+def parse_manifest(text):
+    """Items of an uploaded manifest: a JSON list (or `{"items": [...]}`), else one link or JSON object per line."""
+    try:
+        manifest = json.loads(text)
+    except ValueError:
+        return [json.loads(line) if line.startswith('{') else line
+                for line in (line.strip() for line in text.splitlines()) if line and not line.startswith('#')]
+    return manifest.get('items', []) if isinstance(manifest, dict) else manifest
+
+
+def request_items():
+    """Items of a batch request, each a dict of `ITEM_FIELDS`.
+
+    Items come from a JSON body (`{"items": [...]}` or a bare list), an
+    uploaded `manifest` file, or repeated `link` fields. Links may be given
+    as plain strings; fields set next to the items apply to every item that
+    doesn't set them itself.
+    """
+    if request.is_json:
+        body = request.get_json(silent=True)
+        defaults = body if isinstance(body, dict) else {}
+        items = body.get('items', []) if isinstance(body, dict) else body
+    else:
+        defaults = request.values
+        manifest = request.files.get('manifest')
+        if manifest:
+            items = parse_manifest(manifest.read().decode('utf-8', errors='replace'))
+            if is_upload(getattr(manifest.stream, 'name', '') or ''):
+                discard_upload(manifest.stream.name)
+        else:
+            items = request.values.getlist('link')
+    if not isinstance(items, list):
+        raise ValueError("items must be a list")
+    defaults = {name: defaults[name] for name in ITEM_FIELDS if name != 'link' and name in defaults}
+    return [{**defaults, **(item if isinstance(item, dict) else {'link': item})} for item in items]
+
+
+def add_items(batch_id, entries):
+    """Store the items of a new batch, queued, or failed when they didn't validate."""
+    item_store.add(batch_id, [
+        {'index': entry['index'], 'link': entry.get('link'), 'status': QUEUED}
+        if 'error' not in entry else
+        {'index': entry['index'], 'link': entry.get('link'), 'status': FAILED, 'error': entry['error']}
+        for entry in entries
+    ])
+
+
+def prune_items():
+    """Drop the items of batches the queue has pruned."""
+    # Items are stored just before their batch is queued, leave those alone
+    for batch_id in item_store.batches(time.time() - 60):
+        if batch_queue.store.get(batch_id) is None:
+            item_store.delete(batch_id)
+
+
+def submit_item(entry, client):
+    """Queue one item as a bulk separation job of the batch's client; returns its job id."""
+    duration = estimate_cost(entry['link'])
+    return separation_queue.submit(
+        entry['params'],
+        priority=BULK,
+        client=client,
+        cost=duration * model_spec(entry['params']['model']).relative_cost if duration else None
+    )
+
+
+def run_batch(params, report):
+    """Separate every item of a batch through the separation queue, `CONCURRENCY` at a time.
+
+    Items are queued as bulk jobs of the batch's client, so they are
+    scheduled, fair-shared and run by the separation workers like any other
+    job; a full queue just holds the next item back. An item that fails is
+    recorded with its error and the others go on. Items are kept in
+    `item_store`, each with its status and, once done, its job result; the
+    batch job itself only reports the totals. A batch queued again after
+    its worker died follows the jobs it had queued and only queues the
+    items that hadn't started.
+    """
+    batch_id = params['batch_id']
+    entries = {entry['index']: entry for entry in params['items']}
+    items = item_store.items(batch_id)
+    in_flight = {item['job_id']: item['index'] for item in items if item['status'] == RUNNING and item.get('job_id')}
+    todo = deque(entries[item['index']] for item in items
+                 if item['status'] == QUEUED or (item['status'] == RUNNING and not item.get('job_id')))
+    totals = item_store.totals(batch_id)
+    trace = current_trace()
+
+    def publish():
+        report(RUNNING, (totals['done'] + totals['failed']) / totals['total'], **totals)
+
+    def finish(index, status, **fields):
+        item_store.update(batch_id, index, **fields, status=status)
+        totals[status] += 1
+        publish()
+
+    publish()
+    while todo or in_flight:
+        while todo and len(in_flight) < CONCURRENCY:
+            entry = todo[0]
+            try:
+                job_id = submit_item(entry, params.get('client'))
+            except QueueFullError:
+                break
+            todo.popleft()
+            in_flight[job_id] = entry['index']
+            item_store.update(batch_id, entry['index'], status=RUNNING, job_id=job_id)
+            trace.event('batch_item_queued', index=entry['index'], job_id=job_id)
+        for job_id, index in list(in_flight.items()):
+            job = separation_queue.store.get(job_id)
+            if job is None:
+                finish(index, FAILED, error="The item's separation job was lost")
+            elif job['status'] == DONE:
+                finish(index, DONE, **job['result'])
+            elif job['status'] == FAILED:
+                finish(index, FAILED, error=job['error'])
+            else:
+                continue
+            del in_flight[job_id]
+        if todo or in_flight:
+            time.sleep(POLL_INTERVAL)
+    return {"message": "Batch complete", **totals}
+
+
+item_store = create_item_store(os.getenv('SEPARATION_BATCH_DB', 'temp/batches.db'))
+
+batch_queue = JobQueue(
+    run_batch,
+    create_job_store(os.getenv('SEPARATION_BATCH_DB', 'temp/batches.db')),
+    workers=int(os.getenv('SEPARATION_BATCH_WORKERS', '1')),
+    max_depth=int(os.getenv('SEPARATION_BATCH_QUEUE_DEPTH', '4')),
+    retry_after=int(os.getenv('SEPARATION_RETRY_AFTER', '30')),
+    max_per_client=int(os.getenv('SEPARATION_BATCH_CLIENT_DEPTH', '2')),
+    stale_after=int(os.getenv('SEPARATION_JOB_STALE_AFTER', '120')),
+    max_attempts=int(os.getenv('SEPARATION_JOB_MAX_ATTEMPTS', '3'))
+)
+
+
+def wants_ndjson():
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes') or \
+        request.accept_mimetypes.best == NDJSON
+
+
+def batch_view(batch_id):
+    """Status of a batch with every item, or None if it doesn't exist."""
+    status = batch_queue.status(batch_id)
+    if status is None:
+        return None
+    return {**status, **item_store.totals(batch_id), 'items': item_store.items(batch_id)}
+
+
+def stream_batch(batch_id, status_url, poll_interval=None, max_seconds=None):
+    """Yield an NDJSON line for each item as it finishes, then one with the batch totals.
+
+    A stream holds a server worker, so it ends after `max_seconds` even if
+    the batch is still running; its last line then has the `status_url` to
+    poll, or stream again, for the rest.
+    """
+    poll_interval = poll_interval or POLL_INTERVAL
+    deadline = time.monotonic() + (max_seconds or STREAM_MAX_SECONDS)
+    sent = set()
+    since = 0.0
+    while True:
+        status = batch_queue.status(batch_id)
+        if status is None:
+            return
+        # Items finishing while this look runs are caught by the next one
+        look = time.time()
+        for item in item_store.items(batch_id, finished_since=since):
+            if item['index'] not in sent:
+                sent.add(item['index'])
+                yield json.dumps(item) + "\n"
+        since = look - 1
+        ended = status['status'] in (DONE, FAILED)
+        if ended or time.monotonic() >= deadline:
+            line = {'batch_id': batch_id, 'status': status['status'], 'error': status['error'],
+                    **item_store.totals(batch_id)}
+            if not ended:
+                line['status_url'] = status_url
+            yield json.dumps(line) + "\n"
+            return
+        time.sleep(poll_interval)
+
+
+def batch_response(batch_id):
+    status_url = url_for('batch.batch_status', batch_id=batch_id)
+    return Response(stream_with_context(stream_batch(batch_id, status_url)), mimetype=NDJSON)
+
+
+@batch_routes.route("/", methods=['POST'])
+def separate_batch():
+    """Queue a batch of separations and return its id, or stream its results as NDJSON.
+
+    See `request_items` for the ways to send the items. Items that fail
+    validation are reported as failed in the batch instead of refusing it.
+    With `?stream=1` or `Accept: application/x-ndjson` the response is one
+    JSON line per finished item followed by the batch totals, for at most
+    `STREAM_MAX_SECONDS`; polling the status URL is the way to follow long
+    batches.
+    """
+    try:
+        items = request_items()
+    except ValueError as e:
+        return jsonify({"error": f"Could not read the batch: {str(e)}"}), 400
+    if not items:
+        return jsonify({"error": "No batch items provided"}), 400
+    if len(items) > MAX_ITEMS:
+        return jsonify({"error": f"Batches are limited to {MAX_ITEMS} items"}), 400
+
+    entries = []
+    for index, fields in enumerate(items):
+        params, error = batch_item(fields)
+        entry = {'index': index, 'link': fields.get('link')}
+        entry.update({'error': error} if error else {'params': params})
+        entries.append(entry)
+    invalid = sum(1 for entry in entries if 'error' in entry)
+    if invalid == len(entries):
+        return jsonify({
+            "error": "No valid batch items",
+            "items": [{'index': entry['index'], 'error': entry['error']} for entry in entries]
+        }), 400
+
+    ffmpeg_result = ensure_ffmpeg(any(needs_ffmpeg(entry['link']) for entry in entries if 'error' not in entry))
+    if not isinstance(ffmpeg_result, bool):
+        return ffmpeg_result
+
+    # Items go in first, so they are there whenever the batch runs
+    batch_id = uuid.uuid4().hex
+    prune_items()
+    add_items(batch_id, entries)
+    try:
+        client = request_client()
+        batch_queue.submit({'batch_id': batch_id, 'items': entries, 'client': client}, priority=BULK, client=client,
+                           job_id=batch_id)
+    except QueueFullError as e:
+        item_store.delete(batch_id)
+        response = jsonify({"error": str(e), "retry_after": e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    status_url = url_for('batch.batch_status', batch_id=batch_id)
+    if wants_ndjson():
+        response = batch_response(batch_id)
+        response.headers['Location'] = status_url
+        return response
+    response = jsonify({
+        "message": "Batch queued",
+        "batch_id": batch_id,
+        "status_url": status_url,
+        "items": len(entries),
+        "invalid": invalid
+    })
+    response.headers['Location'] = status_url
+    return response, 202
+
+
+@batch_routes.route("/<batch_id>", methods=['GET'])
+def batch_status(batch_id):
+    """Progress of a batch with the status, and once done the result, of every item."""
+    status = batch_view(batch_id)
+    if status is None:
+        return jsonify({"error": f"Batch {batch_id} not found"}), 404
+    if wants_ndjson():
+        return batch_response(batch_id)
+    return jsonify(status), 200
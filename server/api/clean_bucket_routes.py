@@ -1,37 +1,104 @@
 import os
-from flask import Blueprint, jsonify, request
-import boto3
+import threading
+import time
+from flask import Blueprint, jsonify, request, url_for
+from utils.job_queue import JobQueue, QueueFullError, create_job_store
+from utils.retention import ALL, EXPIRED, SCOPES, SWEEP_INTERVAL, Sweeper
+from utils.s3_client import get_s3_client
+from utils.tracing import current_trace
+from server.api.separate_routes import result_cache, retention_index
 
 clean_bucket_routes = Blueprint("clean_bucket", __name__)
 
+def run_sweep(params, report):
+    """Delete expired stems, or every object for scope `all`, and return what was freed."""
+    scope = params.get('scope', EXPIRED)
+    bucket_name = os.getenv('AWS_BUCKET_NAME')
+    sweeper = Sweeper(retention_index, get_s3_client(), bucket_name)
+    expired = retention_index.stats()['expired'] if retention_index and scope == EXPIRED else 0
+
+    def report_totals(totals):
+        progress = min(totals['deleted'] / expired, 0.99) if expired else 0.0
+        report("deleting", progress, **totals)
+
+    sweep_start = time.time()
+    totals = sweeper.sweep(scope, report_totals)
+    current_trace().record('sweep', time.time() - sweep_start, sweep_start, scope=scope, bucket=bucket_name,
+                           **totals)
+
+    # Cached results point at the stems that were just deleted
+    if result_cache:
+        if scope == ALL:
+            result_cache.clear()
+        elif retention_index:
+            result_cache.clear(before=sweep_start - retention_index.ttl)
+
+    return {"message": "Bucket swept", "bucket": bucket_name, "scope": scope, **totals}
+
+sweep_queue = JobQueue(
+    run_sweep,
+    create_job_store(os.getenv('SWEEP_QUEUE_DB', 'temp/sweeps.db')),
+    workers=1,
+    max_depth=int(os.getenv('SWEEP_QUEUE_DEPTH', '4'))
+)
+
+def start_periodic_sweeps(interval=SWEEP_INTERVAL):
+    """Queue a sweep of expired stems every `interval` seconds, from one worker at a time."""
+    if not retention_index or interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                if retention_index.claim_sweep(interval):
+                    sweep_queue.submit({'scope': EXPIRED})
+            except Exception as e:
+                print(f"Failed to queue the retention sweep: {str(e)}")
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
 @clean_bucket_routes.route("/", methods=['DELETE'])
 def clean_bucket_handler():
+    """Queue a sweep of the bucket and return its job id right away.
+
+    `scope=expired` (default) deletes the stems past their retention TTL,
+    `scope=all` everything in the bucket.
+    """
+    scope = request.values.get('scope', EXPIRED).lower()
+    if scope not in SCOPES:
+        return jsonify({"error": f"scope must be one of {', '.join(SCOPES)}"}), 400
+    if scope == EXPIRED and not retention_index:
+        return jsonify({"error": "Retention is disabled, only scope=all can be swept"}), 400
     try:
-        # Initialize S3 client
-        s3_client = boto3.client('s3')
-        bucket_name = os.getenv('AWS_BUCKET_NAME')
-
-        # List all objects in the bucket
-        paginator = s3_client.get_paginator('list_objects_v2')
-        
-        # Delete all objects including those in subdirectories
-        for page in paginator.paginate(Bucket=bucket_name):
-            if 'Contents' in page:
-                objects_to_delete = [{'Key': obj['Key']} for obj in page['Contents']]
-                if objects_to_delete:
-                    s3_client.delete_objects(
-                        Bucket=bucket_name,
-                        Delete={'Objects': objects_to_delete}
-                    )
-                    print(f"Deleted {len(objects_to_delete)} objects")
-
-        return jsonify({
-            "message": "Bucket cleaned successfully",
-            "bucket": bucket_name
-        }), 200
-
-    except Exception as e:
-        print(f"Error cleaning bucket: {str(e)}")
-        return jsonify({
-            "error": f"Failed to clean bucket: {str(e)}"
-        }), 500
\ No newline at end of file
+        job_id = sweep_queue.submit({'scope': scope})
+    except QueueFullError as e:
+        response = jsonify({"error": str(e), "retry_after": e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    status_url = url_for('clean_bucket.sweep_status', job_id=job_id)
+    response = jsonify({
+        "message": "Bucket sweep queued",
+        "job_id": job_id,
+        "status_url": status_url
+    })
+    response.headers['Location'] = status_url
+    return response, 202
+
+@clean_bucket_routes.route("/<job_id>", methods=['GET'])
+def sweep_status(job_id):
+    """Progress of a sweep: objects deleted, bytes freed and errors so far."""
+    status = sweep_queue.status(job_id)
+    if status is None:
+        return jsonify({"error": f"Sweep {job_id} not found"}), 404
+    return jsonify(status), 200
+
+@clean_bucket_routes.route("/", methods=['GET'])
+def retention_stats():
+    """Objects tracked for retention and how many have expired."""
+    if not retention_index:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **retention_index.stats()}), 200
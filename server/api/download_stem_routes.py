@@ -1,47 +1,129 @@
 import sys
 from pathlib import Path
-import boto3
 from urllib.parse import urlparse
-from flask import Blueprint, send_file, jsonify
-import io
+from flask import Blueprint, Response, jsonify, redirect, request, stream_with_context
+from botocore.exceptions import ClientError
+import mimetypes
 import os
 sys.path.append(str(Path(__file__).parent.parent))
+from utils.s3_client import PRESIGN_EXPIRY, get_s3_client, presigned_url
+from utils.metrics import s3_bytes
+from utils.tracing import current_trace
 
 download_stem_routes = Blueprint("download", __name__)
 
+# Bytes read from S3 and written to the client at a time
+CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_KB', '64')) * 1024
+
+# `stream` proxies the bytes through this worker, `redirect` answers with a 302 to a
+# presigned S3 URL and `url` returns that URL as JSON; `?mode=` overrides it per request
+DOWNLOAD_MODE = os.getenv('STEM_DOWNLOAD_MODE', 'stream')
+DOWNLOAD_MODES = ('stream', 'redirect', 'url')
+
+FORBIDDEN_CODES = {'AccessDenied', 'InvalidAccessKeyId', 'SignatureDoesNotMatch', '403'}
+# Every stem and waveform the service uploads lives under this prefix
+STEM_PREFIX = 'stems/'
+
+
+def parse_file_url(file_url):
+    """Split a stem URL into its bucket and key."""
+    parsed_url = urlparse(file_url)
+    bucket_name = parsed_url.netloc.split('.')[0]
+    key = parsed_url.path.lstrip('/')
+    return bucket_name, key
+
+
+def is_stem_object(bucket_name, key):
+    """Whether `key` in `bucket_name` is something the service uploaded.
+
+    Downloads are read, or presigned, with the server's credentials, so any
+    other object they can reach must stay out of the client's hands.
+    """
+    return (bucket_name == os.getenv('AWS_BUCKET_NAME') and key.startswith(STEM_PREFIX)
+            and '..' not in key.split('/'))
+
+
+def get_stem_object(s3_client, bucket_name, key, range_header=None):
+    """`get_object`, restricted to a single byte range when one was requested.
+
+    Multi-range requests are answered with the whole object, which HTTP allows.
+    """
+    kwargs = {'Bucket': bucket_name, 'Key': key}
+    if range_header and ',' not in range_header:
+        kwargs['Range'] = range_header
+    return s3_client.get_object(**kwargs)
+
+
+def stream_body(body, chunk_size=CHUNK_SIZE):
+    """Yield the S3 body chunk by chunk and close it when done or aborted."""
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            s3_bytes.inc(len(chunk), direction='download')
+            yield chunk
+    finally:
+        body.close()
+
+
+def direct_download(bucket_name, key, filename, mode):
+    """Send the client straight to storage with a short-lived presigned URL."""
+    try:
+        url = presigned_url(bucket_name, key, filename=filename)
+    except Exception as e:
+        return jsonify({"error": f"File download failed: {str(e)}"}), 500
+    if mode == 'redirect':
+        return redirect(url, code=302)
+    return jsonify({"url": url, "expires_in": PRESIGN_EXPIRY, "filename": filename}), 200
+
+
 @download_stem_routes.route("/<path:file_url>")
 def download_file(file_url):
+    bucket_name, key = parse_file_url(file_url)
+    filename = os.path.basename(key)
+    if not is_stem_object(bucket_name, key):
+        return jsonify({"error": "Only stems of this service can be downloaded"}), 403
+
+    mode = request.args.get('mode', DOWNLOAD_MODE)
+    current_trace().event('download_stem', bucket=bucket_name, key=key, mode=mode)
+    if mode not in DOWNLOAD_MODES:
+        return jsonify({"error": f"Unknown download mode {mode}, use one of {', '.join(DOWNLOAD_MODES)}"}), 400
+    if mode != 'stream':
+        return direct_download(bucket_name, key, filename, mode)
+
     try:
-        # Add debug logging
-        print(f"Attempting to download: {file_url}")
-        
-        parsed_url = urlparse(file_url)
-        bucket_name = parsed_url.netloc.split('.')[0]
-        key = parsed_url.path.lstrip('/')
-        
-        filename = os.path.basename(key)
-
-        s3_client = boto3.client('s3')
-        try:
-            s3_client.list_objects_v2(Bucket=bucket_name, MaxKeys=1)
-        except Exception as aws_error:
-            print(f"AWS Error: {str(aws_error)}")
-            return jsonify({"error": f"AWS Authentication failed: {str(aws_error)}"}), 403
-        file_obj = io.BytesIO()
-        s3_client.download_fileobj(
-            bucket_name,
-            key,
-            file_obj
-        )
-        
-        # Seek to beginning of file
-        file_obj.seek(0)
-        
-        return send_file(
-            file_obj,
-            mimetype='audio/mpeg',
-            as_attachment=True,
-            download_name=filename
-        ), 200
+        s3_object = get_stem_object(get_s3_client(), bucket_name, key, request.headers.get('Range'))
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code', '')
+        if code == 'InvalidRange':
+            response = jsonify({"error": "Requested range not satisfiable"})
+            size = e.response.get('Error', {}).get('ActualObjectSize')
+            if size:
+                response.headers['Content-Range'] = f"bytes */{size}"
+            return response, 416
+        if code in FORBIDDEN_CODES:
+            current_trace().event('download_stem_forbidden', bucket=bucket_name, key=key, error=str(e))
+            return jsonify({"error": f"AWS Authentication failed: {str(e)}"}), 403
+        return jsonify({"error": f"File download failed: {str(e)}"}), 404
     except Exception as e:
-        return jsonify({"error": f"File download failed: {str(e)}"}), 404
\ No newline at end of file
+        return jsonify({"error": f"File download failed: {str(e)}"}), 404
+
+    content_type = (
+        s3_object.get('ContentType')
+        or mimetypes.guess_type(filename)[0]
+        or 'application/octet-stream'
+    )
+    response = Response(
+        stream_with_context(stream_body(s3_object['Body'])),
+        status=206 if s3_object.get('ContentRange') else 200,
+        content_type=content_type,
+        direct_passthrough=True
+    )
+    response.headers['Content-Length'] = str(s3_object['ContentLength'])
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if s3_object.get('ContentRange'):
+        response.headers['Content-Range'] = s3_object['ContentRange']
+    if s3_object.get('ETag'):
+        response.headers['ETag'] = s3_object['ETag']
+    if s3_object.get('LastModified'):
+        response.last_modified = s3_object['LastModified']
+    return response
@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+from flask import Blueprint, Response
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.metrics import registry
+
+metrics_routes = Blueprint("metrics", __name__)
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+@metrics_routes.route("/", methods=['GET'])
+def metrics():
+    """Stage timings, job counts, queue depth, S3 traffic and memory of the server, for Prometheus.
+
+    Whichever gunicorn worker answers adds up the metrics every worker
+    wrote to `METRICS_DIR`, see `Registry`.
+    """
+    return Response(registry.render(), content_type=CONTENT_TYPE)
@@ -1,70 +1,129 @@
 import sys
 import os
+import hashlib
+import math
 import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import perf_counter
-import boto3
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-import demucs.separate
 from dotenv import load_dotenv
 from utils.install_ffmpeg import install_ffmpeg, check_ffmpeg
-import requests
+from utils.separation_engine import (
+    DEFAULT_MODEL, PREVIEW_PADDING, resident_models, separate_file, separate_file_streaming
+)
+from utils.inference_backend import model_variant
+from utils.model_registry import QUALITIES, UnknownModelError, choose_model, list_models, model_spec
+from utils.job_queue import BULK, INTERACTIVE, PRIORITIES, JobQueue, QueueFullError, create_job_store
+from utils.s3_client import (
+    MAX_CONCURRENCY, PRIVATE_OBJECTS, TRANSFER_CONFIG, StreamingUpload, extra_args, get_s3_client,
+    object_key, object_url
+)
+from utils.result_cache import ResultCache, create_result_cache, hash_file
+from utils.retention import create_retention_index
+from utils.waveform import peaks_path
+from utils.metrics import audio_seconds, jobs_in_flight, jobs_total, realtime_factor, registry, s3_bytes
+from utils.tracing import current_trace, record_stage, stage
+from utils.segment_store import create_segment_store
+from utils.checkpoints import create_checkpoint_store
+from utils.scratch import job_scratch
+from utils.ingest import MAX_BYTES, Download
+from utils.uploads import (
+    FORM_OVERHEAD, MIME_EXTENSIONS, UploadTooLarge, discard_upload, is_upload, new_upload_path, prune_uploads,
+    save_stream
+)
+from utils.convert_m4a_to_mp3 import convert_m4a_to_mp3
+from utils.get_audio_info import estimate_duration, get_audio_duration
+from utils.audio_io import (
+    APPEND_ONLY, BITRATES, DEFAULT_BITRATES, DEFAULT_OUTPUT, FFMPEG_ONLY, OUTPUT_FORMATS, content_type, output_tag
+)
 import urllib.parse 
+import requests
 sys.path.append(str(Path(__file__).parent.parent))
 
 load_dotenv()
 separate_routes = Blueprint("audio", __name__)
 
+# Upload each stem while the next one is still being encoded or separated
+PIPELINE_UPLOADS = os.getenv('SEPARATION_PIPELINE_UPLOADS', '1').lower() not in ('0', 'false', 'no')
+# Streaming jobs start decoding while the source is still downloading
+PROGRESSIVE_DECODE = os.getenv('SEPARATION_PROGRESSIVE_DECODE', '1').lower() not in ('0', 'false', 'no')
+PREVIEW_DURATION = float(os.getenv('PREVIEW_DEFAULT_SECONDS', '30'))
+PREVIEW_MAX_DURATION = float(os.getenv('PREVIEW_MAX_SECONDS', '120'))
+# Stem format and kbps when a request doesn't pick one; previews default to small Opus files
+STEM_FORMAT = os.getenv('STEM_FORMAT', 'mp3')
+STEM_BITRATE = os.getenv('STEM_BITRATE')
+PREVIEW_FORMAT = os.getenv('STEM_PREVIEW_FORMAT', 'opus')
+PREVIEW_BITRATE = os.getenv('STEM_PREVIEW_BITRATE', '96')
+# Seconds the HEAD request sizing a link for the scheduler may take, `0` to skip it
+COST_PROBE_TIMEOUT = float(os.getenv('SEPARATION_COST_PROBE_TIMEOUT', '0.5'))
+
 ALLOWED_EXTENSIONS = {'wav', 'mp3'}
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Uploaded M4A files are converted to MP3 before separation
+UPLOAD_EXTENSIONS = ALLOWED_EXTENSIONS | {'m4a'}
+def allowed_file(filename, extensions=ALLOWED_EXTENSIONS):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
 
 def download_file_from_url(url, download_path):
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    
-    with open(download_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
-    
-    return download_path
+    """Download `url` over the pooled session, resuming if the transfer breaks off."""
+    return Download(url, download_path).start().wait()
 
 
-def ensure_ffmpeg():
-    """Ensure FFmpeg is installed and available."""
-    if not check_ffmpeg():
-        try:
-            print("FFmpeg not found. Installing...")
-            install_ffmpeg()
-            print("FFmpeg installed successfully.")
+def needs_ffmpeg(source):
+    """Whether the audio named `source`, a file name or a link, can only be decoded by FFmpeg."""
+    return Path(urllib.parse.urlparse(source or '').path).suffix.lower() in FFMPEG_ONLY
+
+def ensure_ffmpeg(required=True):
+    """Ensure FFmpeg is installed and available.
+
+    WAV and MP3 are decoded in-process, so FFmpeg is only installed when the
+    audio is `required` to go through it (see `needs_ffmpeg`).
+    """
+    with stage('ffmpeg_check') as span:
+        if check_ffmpeg() or not required:
             return True
+        span['installed'] = True
+        try:
+            installed = install_ffmpeg()
         except Exception as e:
+            span['error'] = str(e)
             return jsonify({"error": f"Failed to install FFmpeg: {str(e)}"}), 500
-    else:
-        print("FFmpeg is already installed.")
+        if not installed:
+            span['error'] = "FFmpeg is not available"
+            return jsonify({"error": "FFmpeg is not available to decode this audio"}), 503
         return True
 
-def prepare_audio_file(url):
-    """Download and prepare the audio file for processing."""
+def audio_filename(url):
+    """Safe local file name for the audio at `url`."""
+    parsed_url = urllib.parse.urlparse(url)
+    filename = os.path.basename(parsed_url.path)
+    
+    if not filename or not allowed_file(filename):
+        extension = '.mp3'
+        if '.' in filename:
+            extension = '.' + filename.rsplit('.', 1)[1].lower()
+            if extension not in ['.mp3', '.wav']:
+                extension = '.mp3'
+        
+        filename = f"download{extension}"
+    
+    return secure_filename(filename)
+
+def prepare_audio_file(url, scratch=None):
+    """Download and prepare the audio file for processing.
+
+    The file goes into the job's `scratch` directory, or the shared temp/
+    directory when none is given.
+    """
     if not url:
         return None, None, (jsonify({"error": "No audio URL provided"}), 400)
     
     try:
-        parsed_url = urllib.parse.urlparse(url)
-        filename = os.path.basename(parsed_url.path)
-        
-        if not filename or not allowed_file(filename):
-            extension = '.mp3'
-            if '.' in filename:
-                extension = '.' + filename.rsplit('.', 1)[1].lower()
-                if extension not in ['.mp3', '.wav']:
-                    extension = '.mp3'
-            
-            filename = f"download{extension}"
-        
-        safe_filename = secure_filename(filename)
-        temp_dir = Path('temp')
+        safe_filename = audio_filename(url)
+        temp_dir = Path(scratch) if scratch else Path('temp')
         temp_dir.mkdir(exist_ok=True)
         
         temp_path = temp_dir / safe_filename
@@ -76,72 +135,240 @@ def prepare_audio_file(url):
             "error": f"Failed to prepare audio file: {str(e)}",
             "details": str(e)
         }), 500)
-        
-def run_separation(temp_path, mode="2"):
-    """Run the audio separation using demucs."""
 
-    separation_start = perf_counter()
-    output_dir = Path("separated/htdemucs") / temp_path.stem
-    
+def take_upload(upload_path, scratch=None):
+    """Link, or copy, audio uploaded with the request into the job's `scratch` directory.
+
+    The upload itself stays until the job is over, so a retry of a job
+    whose worker died can take it again. M4A uploads are converted to MP3
+    first. Returns `(temp_path, safe_filename, error)` like
+    `prepare_audio_file`.
+    """
     try:
-        cmd_args = ["--mp3"]
-        if mode == '2':
-            cmd_args.extend(["--two-stems", "vocals"])
-        cmd_args.extend(["-n", "htdemucs", str(temp_path)])
+        temp_dir = Path(scratch) if scratch else Path('temp')
+        temp_dir.mkdir(exist_ok=True)
+        temp_path = temp_dir / Path(upload_path).name
+        try:
+            os.link(upload_path, temp_path)
+        except OSError:
+            shutil.copyfile(upload_path, temp_path)
+        if temp_path.suffix.lower() == '.m4a':
+            mp3_path = temp_path.with_suffix('.mp3')
+            converted, _ = convert_m4a_to_mp3(str(temp_path), str(mp3_path))
+            temp_path.unlink()
+            if not converted:
+                raise RuntimeError("Could not convert the M4A file to MP3")
+            temp_path = mp3_path
+        return temp_path, temp_path.name, None
+    except Exception as e:
+        return None, None, (jsonify({
+            "error": f"Failed to prepare audio file: {str(e)}",
+            "details": str(e)
+        }), 500)
 
-        print(f"Running separation with args: {cmd_args}")
-        demucs.separate.main(cmd_args)
+def start_audio_download(url, scratch):
+    """Start downloading into `scratch` and return as soon as the first bytes are in.
 
-        output_dir = Path("separated/htdemucs") / temp_path.stem
+    Returns `(download, safe_filename, error)` like `prepare_audio_file`.
+    """
+    try:
+        safe_filename = audio_filename(url)
+        download = Download(url, Path(scratch) / safe_filename).start()
+        download.wait_for(1)
+        return download, safe_filename, None
+    except Exception as e:
+        return None, None, (jsonify({
+            "error": f"Failed to prepare audio file: {str(e)}",
+            "details": str(e)
+        }), 500)
         
-        if mode == '2':
-            stems_files = {
-                'vocals': str(output_dir / "vocals.mp3"),
-                'instrumental': str(output_dir / "no_vocals.mp3")
-            }
+def run_separation(temp_path, mode="2", streaming=False, uploader=None, output_dir=None, source=None,
+                   window=None, audio_hash=None, model_name=DEFAULT_MODEL, output_format='mp3', bitrate=None):
+    """Run the audio separation using the resident Demucs engine.
+
+    With `streaming` the track is decoded, separated and encoded window by
+    window, which keeps memory flat for hour-long recordings. A `StemUploader`
+    passed as `uploader` starts uploading stems as soon as they are written.
+    Stems go to `output_dir`, by default `separated/<model>/<track name>`.
+    `model_name` is any model of the registry, and stems are encoded as
+    `output_format` at `bitrate` kbps (ignored for lossless formats).
+    A `source` file object, such as a download still in flight, is decoded
+    instead of `temp_path` when given. A preview `window` of `(start, duration)`
+    seconds separates only that part; its blocks go to the segment store
+    under `audio_hash` for later previews and the full track to reuse.
+    Whole tracks are checkpointed under `audio_hash` so a retry of a job
+    that died mid-separation resumes its inference.
+    """
+
+    separation_start = perf_counter()
+    output_dir = Path(output_dir) if output_dir else Path("separated") / model_name / temp_path.stem
+    
+    try:
+        options = {'model_name': model_name, 'output_format': output_format, 'bitrate': bitrate,
+                   'checkpoints': checkpoint_store, 'audio_hash': audio_hash}
+        if uploader:
+            options['on_stem'] = uploader.on_stem
+            if streaming:
+                options['on_chunk'] = uploader.on_chunk
+        if streaming and not window:
+            separate = separate_file_streaming
         else:
-            stems_files = {
-                'vocals': str(output_dir / "vocals.mp3"),
-                'drums': str(output_dir / "drums.mp3"),
-                'bass': str(output_dir / "bass.mp3"),
-                'other': str(output_dir / "other.mp3")
-            }
+            separate = separate_file
+            options.pop('on_chunk', None)
+            options.update(window=window, segment_store=segment_store)
+        stems_files, timings = separate(source or temp_path, output_dir, mode, **options)
         
         separation_time = perf_counter() - separation_start
-        return stems_files, output_dir, separation_time, None
+        return stems_files, output_dir, separation_time, timings
     except Exception as e:
         return None, output_dir, 0, jsonify({"error": f"Separation failed: {str(e)}"}), 500
     
-def upload_stems_to_s3(stems_files, safe_filename):
-    """Upload the separated stems to S3 and generate download links."""
+def stem_url(bucket_name, s3_stem_path):
+    """Download link of an uploaded stem, presigned when stems are private."""
+    return object_url(bucket_name, s3_stem_path)
+
+def refresh_links(download_links):
+    """Re-sign cached links of private stems, whose signatures may have expired."""
+    if not PRIVATE_OBJECTS:
+        return download_links
+    bucket_name = os.getenv('AWS_BUCKET_NAME')
+    return {
+        stem: stem_url(bucket_name, object_key(url, bucket_name))
+        for stem, url in download_links.items()
+    }
+
+def stem_key(prefix, stem, safe_filename, stem_path):
+    """S3 key of a stem or its sidecar: the track name with the extensions of the file."""
+    return f"{prefix}/{stem}_{Path(safe_filename).stem}{''.join(Path(stem_path).suffixes)}"
+
+def record_upload(s3_stem_path, stem_path):
+    """Start the retention clock of an uploaded stem; bookkeeping never fails the upload."""
+    if not retention_index:
+        return
+    try:
+        retention_index.record(s3_stem_path, os.path.getsize(stem_path))
+    except Exception as e:
+        print(f"Could not index {s3_stem_path} for retention: {str(e)}")
+
+def upload_stem(s3_client, bucket_name, stem_path, s3_stem_path):
+    """Upload one stem file (multipart when large) and delete the local copy."""
+    with open(stem_path, 'rb') as stem_data:
+        s3_client.upload_fileobj(
+            stem_data,
+            bucket_name,
+            s3_stem_path,
+            ExtraArgs=extra_args(content_type(stem_path)),
+            Config=TRANSFER_CONFIG
+        )
+    record_upload(s3_stem_path, stem_path)
+    os.unlink(stem_path)
+    return stem_url(bucket_name, s3_stem_path)
+
+def upload_stems_to_s3(stems_files, safe_filename, prefix="stems"):
+    """Upload the separated stems to S3 concurrently and generate download links.
+
+    Every stem gets its own thread on the shared client, so the upload step
+    takes about as long as the slowest stem.
+    """
     bucket_name = os.getenv('AWS_BUCKET_NAME')
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
     download_links = {}
     
-    for stem, stem_path in stems_files.items():
+    with ThreadPoolExecutor(max_workers=max(len(stems_files), 1)) as pool:
+        futures = {
+            stem: pool.submit(upload_stem, s3_client, bucket_name, stem_path,
+                              stem_key(prefix, stem, safe_filename, stem_path))
+            for stem, stem_path in stems_files.items()
+        }
+    
+    for stem, future in futures.items():
         try:
-            stem_filename = f"{stem}_{safe_filename}"
-            s3_stem_path = f"stems/{stem_filename}"
-            
-            with open(stem_path, 'rb') as stem_data:
-                s3_client.upload_fileobj(
-                    stem_data,
-                    bucket_name,
-                    s3_stem_path,
-                    ExtraArgs={
-                        'ContentType': 'audio/mpeg',
-                        'ACL': 'public-read'
-                    }
-                )
-            
-            download_links[stem] = f"https://{bucket_name}.s3.{os.getenv('AWS_DEFAULT_REGION')}.amazonaws.com/{s3_stem_path}"
-            os.unlink(stem_path)
-            
+            download_links[stem] = future.result()
         except Exception as e:
             return None, jsonify({"error": f"Error processing {stem}: {str(e)}"}), 500
         
     return download_links, None
 
+class StemUploader:
+    """Uploads stems in the background while the engine is still producing them.
+
+    Hand `on_stem` (and `on_chunk` in streaming mode) to the engine, then
+    call `result()` once separation is done. In streaming mode complete
+    multipart parts go up while later windows are still being separated;
+    formats whose headers are rewritten on close (FLAC, WAV) wait for the
+    finished file instead.
+    """
+
+    def __init__(self, safe_filename, prefix="stems"):
+        self.bucket_name = os.getenv('AWS_BUCKET_NAME')
+        self.s3_client = get_s3_client()
+        self.safe_filename = safe_filename
+        self.prefix = prefix
+        self.stem_pool = ThreadPoolExecutor(max_workers=4)
+        self.part_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        self.streams = {}
+        self.futures = {}
+        self.stems_bytes = 0
+        self.upload_start = None
+        self.upload_time = 0.0
+
+    def key(self, stem, stem_path):
+        return stem_key(self.prefix, stem, self.safe_filename, stem_path)
+
+    def on_chunk(self, stems_files):
+        """Send the complete multipart parts of every partial stem file."""
+        if self.upload_start is None:
+            self.upload_start = perf_counter()
+        for stem, stem_path in stems_files.items():
+            if Path(stem_path).suffix.lower() not in APPEND_ONLY:
+                continue
+            if stem not in self.streams:
+                self.streams[stem] = StreamingUpload(
+                    self.s3_client, self.bucket_name, self.key(stem, stem_path),
+                    extra_args(content_type(stem_path)), self.part_pool
+                )
+            self.streams[stem].feed(stem_path)
+
+    def on_stem(self, stem, stem_path):
+        """Start uploading a finished stem file."""
+        if self.upload_start is None:
+            self.upload_start = perf_counter()
+        self.stems_bytes += os.path.getsize(stem_path)
+        self.futures[stem] = self.stem_pool.submit(self._upload, stem, stem_path)
+
+    def result(self):
+        """Wait for every upload and return links like `upload_stems_to_s3`."""
+        download_links = {}
+        try:
+            for stem, future in self.futures.items():
+                try:
+                    download_links[stem] = future.result()
+                except Exception as e:
+                    return None, jsonify({"error": f"Error processing {stem}: {str(e)}"}), 500
+            return download_links, None
+        finally:
+            self.close()
+
+    def abort(self):
+        """Give up on every upload, e.g. after the separation failed."""
+        self.close()
+        for stream in self.streams.values():
+            stream.abort()
+
+    def close(self):
+        self.stem_pool.shutdown(wait=True)
+        self.part_pool.shutdown(wait=True)
+        if self.upload_start is not None:
+            self.upload_time = perf_counter() - self.upload_start
+
+    def _upload(self, stem, stem_path):
+        if stem not in self.streams:
+            return upload_stem(self.s3_client, self.bucket_name, stem_path, self.key(stem, stem_path))
+        self.streams[stem].finish(stem_path)
+        record_upload(self.key(stem, stem_path), stem_path)
+        os.unlink(stem_path)
+        return stem_url(self.bucket_name, self.key(stem, stem_path))
+
 def clean_up_files(temp_path, output_dir):
     """Clean up temporary files and directories."""
     if temp_path and temp_path.exists():
@@ -151,50 +378,464 @@ def clean_up_files(temp_path, output_dir):
             
             
 
-@separate_routes.route("/", methods=['POST'])
-def separate_audio():
-    """Main route handler for audio separation."""
+def _error_message(response):
+    """Pull the message out of a jsonify'd error response."""
+    return response.get_json()["error"]
+
+def with_preview(result, window, output):
+    """Add the stem format, and the preview window when it was one, to a job result."""
+    output_format, bitrate = output
+    result["format"] = output_format
+    if bitrate:
+        result["bitrate"] = bitrate
+    if window:
+        result["preview"] = {"start": window[0], "duration": window[1]}
+    return result
+
+def process_separation_job(params, report):
+    """Download, separate and upload one queued job, reporting each stage.
+
+    All of the job's audio lives in a scratch directory of its own, removed
+    once the job is over, along with the job's upload. Stage timings go to
+    the job's trace and to the `/metrics` histograms.
+    """
+    jobs_in_flight.inc()
+    try:
+        with job_scratch() as scratch:
+            result = _process_in_scratch(params, report, scratch)
+    except Exception:
+        jobs_total.inc(outcome='failed')
+        raise
+    finally:
+        jobs_in_flight.dec()
+        # Only a job whose worker died is queued again, and it needs the upload
+        if params.get('upload'):
+            discard_upload(params['upload'])
+    jobs_total.inc(outcome='cached' if result.get('cached') else 'done')
+    return result
+
+def record_separation(timings, model_name, mode, streaming):
+    """Add the engine's stages, timed inside `separate_file*`, to the trace and histograms."""
+    record_stage('model_load', timings['model_load_time'], model=model_name)
+    record_stage('decode', timings['decode_time'])
+    record_stage('inference', timings['inference_time'], model=model_name, mode=mode, streaming=streaming,
+                 audio_duration=timings.get('audio_duration'))
+    record_stage('encode', timings['encode_time'])
+
+def _progressive(params, scratch):
+    """Whether the job can decode its source while it is still downloading."""
+    return (PROGRESSIVE_DECODE and scratch is not None and params.get('streaming', False) and params.get('link')
+            and not params.get('window') and Path(audio_filename(params['link'])).suffix.lower() not in FFMPEG_ONLY)
+
+def _process_in_scratch(params, report, scratch):
     start_time = perf_counter()
-    
-    ffmpeg_result = ensure_ffmpeg()
-    if not isinstance(ffmpeg_result, bool):
-        return ffmpeg_result
-    
-    url = request.form.get('link')
-    temp_path, safe_filename, error = prepare_audio_file(url)
-    if error:
-        return error
+    temp_path, output_dir, download, reader = None, None, None, None
+    window = tuple(params['window']) if params.get('window') else None
+    model_name = params.get('model', DEFAULT_MODEL)
+    output = (params.get('format', 'mp3'), params.get('bitrate'))
+    if output[0] in DEFAULT_BITRATES:
+        output = (output[0], output[1] or DEFAULT_BITRATES[output[0]])
+    audio_hash = None
     
     try:
-        mode = request.form.get('mode', '2')
-        separation_result = run_separation(temp_path, mode)
+        report("downloading", 0.05)
+        if params.get('upload'):
+            temp_path, safe_filename, error = take_upload(params['upload'], scratch)
+        elif _progressive(params, scratch):
+            download, safe_filename, error = start_audio_download(params['link'], scratch)
+        else:
+            temp_path, safe_filename, error = prepare_audio_file(params['link'], scratch)
+        if error:
+            raise RuntimeError(_error_message(error[0]))
+        download_time = perf_counter() - start_time
+        if not download:
+            record_stage('download', download_time, file=safe_filename)
+        
+        if download:
+            # The content hash is only known once the download is over, so a
+            # progressive job can't be answered from the cache, only fill it
+            temp_path = Path(download.path)
+            reader = download.reader()
+            prefix = f"stems/{uuid.uuid4().hex[:16]}"
+            # Stands in for the hash to find the checkpoint of an earlier attempt
+            audio_hash = "link-" + hashlib.sha256(
+                f"{params['link']}\n{download.wait_for_size()}".encode()
+            ).hexdigest()
+        else:
+            audio_hash = hash_file(temp_path)
+            cache_key = ResultCache.key(audio_hash, model_variant(model_name), params['mode'], window,
+                                        output_tag(*output))
+            cached = result_cache.get(cache_key) if result_cache else None
+            if cached:
+                current_trace().event('cache_hit', file=safe_filename, key=cache_key)
+                return with_preview({
+                    "message": "Separation complete",
+                    "downloads": refresh_links(cached['downloads']),
+                    "waveforms": refresh_links(cached['waveforms']),
+                    "processing_time": perf_counter() - start_time,
+                    "separation_time": 0,
+                    "model": model_name,
+                    "cached": True,
+                }, window, output)
+            # Keys are namespaced by content hash so same-named songs don't overwrite each other
+            prefix = f"stems/{audio_hash[:16]}"
+            if window:
+                prefix += f"/preview-{window[0]:g}-{window[1]:g}"
+            if output_tag(*output) != DEFAULT_OUTPUT:
+                prefix += f"/{output_tag(*output)}"
         
+        report("separating", 0.2)
+        uploader = StemUploader(safe_filename, prefix) if PIPELINE_UPLOADS else None
+        separation_result = run_separation(
+            temp_path, params['mode'], params.get('streaming', False), uploader,
+            output_dir=scratch / "stems" if scratch else None, source=reader,
+            window=window, audio_hash=audio_hash, model_name=model_name,
+            output_format=output[0], bitrate=output[1]
+        )
         if len(separation_result) == 5:  # Error case
-            stems_files, output_dir, separation_time, error = separation_result
-            clean_up_files(temp_path, output_dir)
-            return error
+            output_dir = separation_result[1]
+            if uploader:
+                uploader.abort()
+            raise RuntimeError(_error_message(separation_result[3]))
         
-        stems_files, output_dir, separation_time, _ = separation_result
+        stems_files, output_dir, separation_time, timings = separation_result
+        if timings.get('resumed_duration'):
+            current_trace().event('checkpoint_resumed', seconds=timings['resumed_duration'])
+        record_separation(timings, model_name, params['mode'], params.get('streaming', False))
+        # Stem uploads leave the peaks sidecars alone, they go up once the stems are done
+        waveform_files = {
+            stem: str(peaks_path(path)) for stem, path in stems_files.items() if peaks_path(path).exists()
+        }
+        if download:
+            cache_key = ResultCache.key(download.sha256(), model_variant(model_name), params['mode'],
+                                        output=output_tag(*output))
+            timings['first_bytes_time'] = download_time
+            download_time = download.elapsed
+            record_stage('download', download_time, file=safe_filename, first_bytes=timings['first_bytes_time'])
+        timings['download_time'] = download_time
         
-        upload_result = upload_stems_to_s3(stems_files, safe_filename)
+        report("uploading", 0.8, separation_time=separation_time, timings=timings)
+        upload_start = perf_counter()
+        if uploader:
+            stems_bytes = uploader.stems_bytes
+            upload_result = uploader.result()
+        else:
+            stems_bytes = sum(os.path.getsize(path) for path in stems_files.values())
+            upload_result = upload_stems_to_s3(stems_files, safe_filename, prefix=prefix)
+        waveform_links = {}
+        upload_bytes = stems_bytes + sum(os.path.getsize(path) for path in waveform_files.values())
+        if waveform_files and len(upload_result) == 2:
+            waveform_result = upload_stems_to_s3(waveform_files, safe_filename, prefix=prefix)
+            if len(waveform_result) == 3:  # Error case
+                upload_result = waveform_result
+            waveform_links = waveform_result[0]
+        # Time spent waiting on uploads after separation; near zero when they overlapped
+        timings['upload_wait_time'] = perf_counter() - upload_start
+        timings['upload_time'] = uploader.upload_time if uploader else timings['upload_wait_time']
+        record_stage('upload', timings['upload_time'], bytes=upload_bytes)
         if len(upload_result) == 3:  # Error case
-            clean_up_files(temp_path, output_dir)
-            return upload_result[1]
+            raise RuntimeError(_error_message(upload_result[1]))
+        s3_bytes.inc(upload_bytes, direction='upload')
         
         download_links, _ = upload_result
+        if result_cache:
+            result_cache.put(cache_key, download_links, stems_bytes, separation_time, waveform_links)
         
-        clean_up_files(temp_path, output_dir)
-        
-        return jsonify({
+        processing_time = perf_counter() - start_time
+        if timings.get('audio_duration'):
+            audio_seconds.observe(timings['audio_duration'])
+            realtime_factor.observe(processing_time / timings['audio_duration'])
+        return with_preview({
             "message": "Separation complete",
             "downloads": download_links,
-            "processing_time": perf_counter() - start_time,
+            "waveforms": waveform_links,
+            "processing_time": processing_time,
             "separation_time": separation_time,
+            "timings": timings,
+            "model": model_name,
+            "cached": False,
+        }, window, output)
+    finally:
+        if reader:
+            reader.close()
+        if download:
+            download.cancel()
+        with stage('cleanup'):
+            clean_up_files(temp_path, output_dir)
+
+result_cache = create_result_cache()
+retention_index = create_retention_index()
+segment_store = create_segment_store()
+checkpoint_store = create_checkpoint_store()
+
+separation_queue = JobQueue(
+    process_separation_job,
+    create_job_store(),
+    workers=int(os.getenv('SEPARATION_WORKERS', '1')),
+    max_depth=int(os.getenv('SEPARATION_QUEUE_DEPTH', '8')),
+    retry_after=int(os.getenv('SEPARATION_RETRY_AFTER', '30')),
+    max_per_client=int(os.getenv('SEPARATION_QUEUE_CLIENT_DEPTH', '4')),
+    fair_window=int(os.getenv('SEPARATION_FAIR_WINDOW', '3600')),
+    aging=int(os.getenv('SEPARATION_PRIORITY_AGING', '600')),
+    stale_after=int(os.getenv('SEPARATION_JOB_STALE_AFTER', '120')),
+    max_attempts=int(os.getenv('SEPARATION_JOB_MAX_ATTEMPTS', '3'))
+)
+
+def queue_depth():
+    """Queued separation jobs per priority class, for the `/metrics` gauge."""
+    queued = separation_queue.store.queued_by_priority()
+    return {(priority,): queued.get(priority, 0) for priority in PRIORITIES}
+
+registry.gauge('separation_queue_depth', 'Separation jobs waiting, by priority class', ['priority'],
+               function=queue_depth, shared=True)
+
+def request_client():
+    """Who a request counts against for fair sharing: its API key, else its address."""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return request.remote_addr or ''
+
+def request_priority(mode, window=None):
+    """Priority class asked for, by default interactive for previews and 2 stems, else bulk."""
+    priority = request.values.get('priority', '').lower()
+    if priority in PRIORITIES:
+        return priority
+    return INTERACTIVE if window or mode == '2' else BULK
+
+def estimate_cost(url):
+    """Estimated seconds of audio at `url`, guessed from its size; None if unknown.
+
+    The HEAD request runs while the client waits, so it skips the pooled
+    session and its connect retries and gives up after `COST_PROBE_TIMEOUT`.
+    """
+    if COST_PROBE_TIMEOUT <= 0:
+        return None
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=COST_PROBE_TIMEOUT)
+        size = int(response.headers.get('Content-Length', 0))
+    except Exception:
+        return None
+    return estimate_duration(size, audio_filename(url)) if size else None
+
+def request_window():
+    """Preview window asked for as `(start, duration)` seconds, None for the whole track.
+
+    Returns `(window, error)`.
+    """
+    return parse_window(request.values)
+
+def parse_window(fields):
+    """`request_window` for the `start` and `duration` of any mapping, e.g. a batch item."""
+    start = fields.get('start')
+    duration = fields.get('duration')
+    if start is None and duration is None:
+        return None, None
+    try:
+        start = float(start or 0)
+        duration = float(duration or PREVIEW_DURATION)
+    except ValueError:
+        return None, (jsonify({"error": "start and duration must be numbers of seconds"}), 400)
+    if start < 0 or duration <= 0 or not math.isfinite(start + duration):
+        return None, (jsonify({"error": "start must be 0 or more and duration above 0"}), 400)
+    if duration > PREVIEW_MAX_DURATION:
+        return None, (jsonify({
+            "error": f"Previews are limited to {PREVIEW_MAX_DURATION:g} seconds"
+        }), 400)
+    return (start, duration), None
+
+def request_output(window=None):
+    """Stem format and kbps asked for as `(format, bitrate)`, bitrate None for lossless.
+
+    Previews default to `STEM_PREVIEW_FORMAT`, everything else to `STEM_FORMAT`.
+    Returns `(output, error)`.
+    """
+    return parse_output(request.values, window)
+
+def parse_output(fields, window=None):
+    """`request_output` for the `format` and `bitrate` of any mapping, e.g. a batch item."""
+    output_format = str(fields.get('format') or '').lower() or (PREVIEW_FORMAT if window else STEM_FORMAT)
+    if output_format not in OUTPUT_FORMATS:
+        return None, (jsonify({"error": f"format must be one of {', '.join(OUTPUT_FORMATS)}"}), 400)
+    if output_format not in BITRATES:
+        return (output_format, None), None
+    bitrate = fields.get('bitrate')
+    if not bitrate and output_format == (PREVIEW_FORMAT if window else STEM_FORMAT):
+        bitrate = PREVIEW_BITRATE if window else STEM_BITRATE
+    low, high = BITRATES[output_format]
+    try:
+        bitrate = int(bitrate or DEFAULT_BITRATES[output_format])
+    except ValueError:
+        return None, (jsonify({"error": "bitrate must be a whole number of kbps"}), 400)
+    if not low <= bitrate <= high:
+        return None, (jsonify({"error": f"{output_format} bitrate must be from {low} to {high} kbps"}), 400)
+    return (output_format, bitrate), None
+
+def request_upload():
+    """Save audio sent with the request, as a multipart `file` field or as the raw body.
+
+    Multipart files are written to the upload directory as they are parsed
+    (see `UploadRequest`) and raw bodies are copied there chunk by chunk,
+    so neither is held in memory. A raw body is named by the `X-Filename`
+    header or `filename` query parameter, else by its content type.
+    Returns `(path, error)`, with a None path when no audio was sent.
+    """
+    if request.mimetype == 'multipart/form-data':
+        request.max_content_length = MAX_BYTES + FORM_OVERHEAD
+        request.upload_to_disk = True
+        try:
+            upload = request.files.get('file')
+        except RequestEntityTooLarge:
+            upload, error = None, (jsonify({"error": str(UploadTooLarge(MAX_BYTES))}), 413)
+        else:
+            error = None
+        stream = upload.stream if upload else None
+        path = Path(stream.name) if is_upload(getattr(stream, 'name', '') or '') else None
+        # Only the audio is kept; other file parts, or all of them past the limit, are deleted now
+        for part in request.upload_paths:
+            if part != path:
+                discard_upload(part)
+        if upload is None:
+            return None, error
+        filename = upload.filename or ''
+    elif request.mimetype.startswith('audio/') or request.mimetype == 'application/octet-stream':
+        extension = MIME_EXTENSIONS.get(request.mimetype)
+        filename = (request.headers.get('X-Filename') or request.args.get('filename')
+                    or (f"upload.{extension}" if extension else ''))
+        if (request.content_length or 0) > MAX_BYTES:
+            return None, (jsonify({"error": str(UploadTooLarge(MAX_BYTES))}), 413)
+        stream = request.stream
+        path = None
+    else:
+        return None, None
+
+    if not allowed_file(filename, UPLOAD_EXTENSIONS):
+        if path:
+            discard_upload(path)
+        return None, (jsonify({
+            "error": f"Uploaded audio must be a {', '.join(sorted(UPLOAD_EXTENSIONS))} file"
+        }), 400)
+    prune_uploads()
+    try:
+        if path is None:
+            path = new_upload_path(filename)
+            save_stream(stream, path)
+        elif path.stat().st_size > MAX_BYTES:
+            discard_upload(path)
+            raise UploadTooLarge(MAX_BYTES)
+    except UploadTooLarge as e:
+        return None, (jsonify({"error": str(e)}), 413)
+    if path.stat().st_size == 0:
+        discard_upload(path)
+        return None, (jsonify({"error": "Uploaded audio is empty"}), 400)
+    return path, None
+
+@separate_routes.route("/", methods=['POST'])
+def separate_audio():
+    """Queue an audio separation job and return its id right away.
+
+    The audio is either fetched from `link` or sent with the request, see
+    `request_upload`; the other fields may then go in the query string.
+    """
+    upload_path, error = request_upload()
+    if error:
+        return error
+    url = request.values.get('link')
+    if not url and not upload_path:
+        return jsonify({"error": "No audio URL or file provided"}), 400
+    
+    ffmpeg_result = ensure_ffmpeg(needs_ffmpeg(upload_path.name if upload_path else url))
+    if not isinstance(ffmpeg_result, bool):
+        if upload_path:
+            discard_upload(upload_path)
+        return ffmpeg_result
+    
+    response = queue_separation(url, upload_path)
+    if upload_path and response[1] != 202:
+        discard_upload(upload_path)
+    return response
+
+def queue_separation(url, upload_path=None):
+    """Validate the job options of the request and queue it; returns the response."""
+    window, error = request_window()
+    if error:
+        return error
+    
+    output, error = request_output(window)
+    if error:
+        return error
+    
+    mode = request.values.get('mode', '2')
+    params = {
+        'mode': mode,
+        'streaming': request.values.get('streaming', '').lower() in ('1', 'true', 'yes'),
+        'format': output[0],
+        'bitrate': output[1]
+    }
+    if upload_path:
+        params['upload'] = str(upload_path.resolve())
+    else:
+        params['link'] = url
+    if window:
+        params['window'] = list(window)
+        duration = window[1] + 2 * PREVIEW_PADDING
+    elif upload_path:
+        duration = get_audio_duration(upload_path) or estimate_duration(os.path.getsize(upload_path),
+                                                                        upload_path.name)
+    else:
+        duration = estimate_cost(url)
+    quality = request.values.get('quality', '').lower() or None
+    if quality and quality not in QUALITIES:
+        return jsonify({"error": f"quality must be one of {', '.join(QUALITIES)}"}), 400
+    try:
+        params['model'] = choose_model(request.values.get('model'), quality, bool(window), duration)
+    except UnknownModelError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        job_id = separation_queue.submit(
+            params,
+            priority=request_priority(mode, window),
+            client=request_client(),
+            cost=duration * model_spec(params['model']).relative_cost if duration else None
+        )
+    except QueueFullError as e:
+        response = jsonify({
+            "error": str(e),
+            "retry_after": e.retry_after
         })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    
+    status_url = url_for('audio.separation_status', job_id=job_id)
+    response = jsonify({
+        "message": "Separation queued",
+        "job_id": job_id,
+        "status_url": status_url
+    })
+    response.headers['Location'] = status_url
+    return response, 202
 
-    except Exception as e:
-        clean_up_files(temp_path, output_dir if 'output_dir' in locals() else None)
-        return jsonify({
-            "error": f"Separation failed: {str(e)}",
-            "details": str(e)
-        }), 500
\ No newline at end of file
+@separate_routes.route("/<job_id>", methods=['GET'])
+def separation_status(job_id):
+    """Report the progress, timings and downloads of a separation job."""
+    status = separation_queue.status(job_id)
+    if status is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(status), 200
+
+@separate_routes.route("/queue", methods=['GET'])
+def queue_stats():
+    """Report queued jobs and queue wait times per priority class."""
+    return jsonify(separation_queue.stats()), 200
+
+@separate_routes.route("/models", methods=['GET'])
+def available_models():
+    """List the models requests may pick and those loaded in this worker."""
+    return jsonify({"models": list_models(), "resident": resident_models()}), 200
+
+@separate_routes.route("/cache", methods=['GET'])
+def result_cache_stats():
+    """Report result cache size, hit rate and the work hits have saved."""
+    if result_cache is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **result_cache.stats()}), 200
@@ -0,0 +1,76 @@
+"""Compare per-file probe and decode overhead of `utils.audio_io` with ffprobe/ffmpeg.
+
+    python tests/bench_audio_io.py --files 20 --seconds 30
+
+The subprocess columns run the ffprobe/ffmpeg commands the old code used.
+Without ffmpeg on PATH only the fork/exec of `true` is timed, as a lower
+bound of what every subprocess call costs.
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.audio_io import decode, encode, probe
+
+
+def write_files(directory, count, seconds, extension):
+    paths = []
+    for index in range(count):
+        wav = np.random.uniform(-0.3, 0.3, (2, int(seconds * 44100))).astype(np.float32)
+        path = Path(directory) / f"track{index}.{extension}"
+        encode(path, wav, 44100)
+        paths.append(path)
+    return paths
+
+
+def per_file(function, paths):
+    start = perf_counter()
+    for path in paths:
+        function(path)
+    return (perf_counter() - start) / len(paths) * 1000
+
+
+def ffprobe_samplerate(path):
+    result = subprocess.run(['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', str(path)],
+                            capture_output=True, text=True)
+    return int(json.loads(result.stdout)['streams'][0]['sample_rate'])
+
+
+def ffmpeg_decode(path):
+    result = subprocess.run(['ffmpeg', '-v', 'error', '-i', str(path), '-f', 'f32le', '-ac', '2',
+                             '-ar', '44100', '-'], capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=30)
+    args = parser.parse_args()
+
+    has_ffmpeg = shutil.which('ffmpeg') and shutil.which('ffprobe')
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in ('wav', 'mp3'):
+            paths = write_files(directory, args.files, args.seconds, extension)
+            probe_ms = per_file(probe, paths)
+            decode_ms = per_file(decode, paths)
+            print(f"{extension}: in-process probe {probe_ms:7.2f} ms/file, decode {decode_ms:7.2f} ms/file")
+            if has_ffmpeg:
+                print(f"{extension}: ffprobe          {per_file(ffprobe_samplerate, paths):7.2f} ms/file, "
+                      f"ffmpeg {per_file(ffmpeg_decode, paths):7.2f} ms/file")
+
+    if not has_ffmpeg:
+        spawn_ms = per_file(lambda _: subprocess.run(['true'], capture_output=True), range(args.files))
+        print(f"ffmpeg not on PATH; bare fork/exec of `true` costs {spawn_ms:.2f} ms per call")
+
+
+if __name__ == "__main__":
+    main()
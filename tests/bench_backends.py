@@ -0,0 +1,62 @@
+"""Speed and quality of each inference backend against the float model.
+
+    python tests/bench_backends.py --model htdemucs --seconds 60
+    python tests/bench_backends.py --tiny --backends eager int8 torchscript int8+torchscript compile
+
+For every backend: the first build (quantizing, tracing or compiling into an
+empty cache), a build from the on-disk cache, seconds per audio minute and
+the SDR of its output against the eager float model on the same clip.
+Pick `INFERENCE_BACKEND` from the speed/quality trade-off.
+"""
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from test_inference_backend import fixed_clip, sdr, tiny_htdemucs
+from utils.inference_backend import build_model
+from utils.separation_engine import load_checkpoint, run_segments, separate_tensor
+
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="htdemucs")
+    parser.add_argument("--tiny", action="store_true", help="use a random small HTDemucs")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--backends", nargs="+", default=["eager", "int8", "torchscript", "int8+torchscript"])
+    args = parser.parse_args()
+
+    loader = tiny_htdemucs if args.tiny else load_checkpoint
+    name = "tiny" if args.tiny else args.model
+    clip = fixed_clip(args.seconds)
+    reference = None
+
+    print(f"{name}, {args.seconds:.0f}s clip, {torch.get_num_threads()} torch threads\n")
+    print("| backend | first build s | cached build s | s / audio min | SDR vs float dB |")
+    print("|---|---:|---:|---:|---:|")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for backend in args.backends:
+            _, first_build = timed(build_model, name, loader, backend, cache_dir)
+            model, cached_build = timed(build_model, name, loader, backend, cache_dir)
+            # Compiled models build lazily, keep their first run out of the timing
+            separate_tensor(model, clip[:, :model.samplerate], run_segments)
+            separated, elapsed = timed(separate_tensor, model, clip, run_segments)
+            if reference is None:
+                reference = separated if backend == "eager" else \
+                    separate_tensor(loader(name), clip, run_segments)
+            print(f"| {backend} | {first_build:.2f} | {cached_build:.2f} | "
+                  f"{elapsed / args.seconds * 60:.1f} | {sdr(reference, separated):.1f} |")
+
+
+if __name__ == "__main__":
+    main()
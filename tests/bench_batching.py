@@ -0,0 +1,84 @@
+"""Compare separation throughput with and without cross-job batching.
+
+    python tests/bench_batching.py --songs 4 --seconds 30 --batch-size 4
+    python tests/bench_batching.py --tiny   # random small HTDemucs, no download
+
+The baseline separates the songs one call at a time, like the current
+one-request-per-call path. The batched run separates them from concurrent
+threads through a `BatchScheduler`, so segments of different songs share
+forward passes.
+"""
+import argparse
+import sys
+import threading
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.batch_scheduler import BatchScheduler
+from utils.separation_engine import load_model, run_model, run_segments, separate_tensor
+
+
+def tiny_model():
+    from demucs.htdemucs import HTDemucs
+    model = HTDemucs(sources=['drums', 'bass', 'other', 'vocals'], channels=8, depth=4,
+                     t_layers=1, segment=4)
+    return model.eval()
+
+
+def songs_per_minute(songs, elapsed):
+    return len(songs) / elapsed * 60
+
+
+def bench_sequential(model, songs):
+    start = perf_counter()
+    for wav in songs:
+        separate_tensor(model, wav, run_segments)
+    return perf_counter() - start
+
+
+def bench_batched(model, songs, batch_size, max_wait):
+    scheduler = BatchScheduler(run_model, batch_size, max_wait)
+    runner = lambda model, segments: scheduler.run("bench", model, segments)
+    threads = [
+        threading.Thread(target=separate_tensor, args=(model, wav, runner)) for wav in songs
+    ]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return perf_counter() - start, scheduler.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="htdemucs")
+    parser.add_argument("--tiny", action="store_true", help="use a random small HTDemucs")
+    parser.add_argument("--songs", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    model = tiny_model() if args.tiny else load_model(args.model)[0]
+    songs = [
+        torch.randn(model.audio_channels, int(args.seconds * model.samplerate)) * 0.1
+        for _ in range(args.songs)
+    ]
+    print(f"{args.songs} songs x {args.seconds:.0f}s, torch threads: {torch.get_num_threads()}")
+
+    sequential = bench_sequential(model, songs)
+    print(f"one request per call: {sequential:7.2f}s  "
+          f"{songs_per_minute(songs, sequential):6.2f} songs/min")
+
+    batched, stats = bench_batched(model, songs, args.batch_size, args.max_wait_ms / 1000)
+    print(f"batched (max {args.batch_size}): {batched:7.2f}s  "
+          f"{songs_per_minute(songs, batched):6.2f} songs/min  "
+          f"mean batch {stats['mean_batch_size']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Sweep inference pool processes x torch threads for the best separation throughput.
+
+    python tests/bench_inference_pool.py --songs 4 --seconds 30
+    python tests/bench_inference_pool.py --tiny --processes 1 2 4 --threads 1 2 4
+    python tests/bench_inference_pool.py --tiny --affinity auto
+
+Every combination whose processes x threads fits the usable CPUs (or
+`--oversubscribe` times them) separates the same songs from concurrent
+threads, the way queue workers share the pool. The in-process baseline
+runs them one after the other with the default torch thread count.
+Use the best row for `INFERENCE_PROCESSES` and `INFERENCE_THREADS`.
+"""
+import argparse
+import sys
+import threading
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.inference_pool import InferencePool, parse_affinity, usable_cpus
+from utils.separation_engine import load_weights, run_model, run_segments, separate_tensor
+
+
+def tiny_model(name="tiny"):
+    from demucs.htdemucs import HTDemucs
+    # Same weights in every process
+    torch.manual_seed(0)
+    model = HTDemucs(sources=['drums', 'bass', 'other', 'vocals'], channels=8, depth=4,
+                     t_layers=1, segment=4)
+    return model.eval()
+
+
+def songs_per_minute(songs, elapsed):
+    return len(songs) / elapsed * 60
+
+
+def bench_in_process(model, songs):
+    start = perf_counter()
+    for wav in songs:
+        separate_tensor(model, wav, run_segments)
+    return perf_counter() - start
+
+
+def bench_pool(loader, name, songs, processes, threads, affinity):
+    pool = InferencePool(loader, run_model, processes, threads,
+                         parse_affinity(affinity, processes))
+    try:
+        info = pool.model_info(name)
+        # Load the model in every process before timing
+        for future in [pool.submit(name, info, songs[0][None, :, :1024]) for _ in range(processes)]:
+            future.result()
+        runner = lambda model, segments: pool.run(name, model, segments)
+        jobs = [
+            threading.Thread(target=separate_tensor, args=(info, wav, runner)) for wav in songs
+        ]
+        start = perf_counter()
+        for thread in jobs:
+            thread.start()
+        for thread in jobs:
+            thread.join()
+        return perf_counter() - start
+    finally:
+        pool.close()
+
+
+def main():
+    cpus = len(usable_cpus())
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="htdemucs")
+    parser.add_argument("--tiny", action="store_true", help="use a random small HTDemucs")
+    parser.add_argument("--songs", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--affinity", default="", help="INFERENCE_CPU_AFFINITY to use")
+    parser.add_argument("--oversubscribe", type=float, default=1.0)
+    args = parser.parse_args()
+
+    loader = tiny_model if args.tiny else load_weights
+    name = "tiny" if args.tiny else args.model
+    model = loader(name)
+    songs = [
+        torch.randn(model.audio_channels, int(args.seconds * model.samplerate)) * 0.1
+        for _ in range(args.songs)
+    ]
+    print(f"{args.songs} songs x {args.seconds:.0f}s on {cpus} CPUs")
+
+    baseline = bench_in_process(model, songs)
+    print(f"in process ({torch.get_num_threads()} threads): {baseline:7.2f}s  "
+          f"{songs_per_minute(songs, baseline):6.2f} songs/min")
+
+    results = []
+    for processes in args.processes:
+        for threads in args.threads:
+            if processes * threads > cpus * args.oversubscribe:
+                continue
+            elapsed = bench_pool(loader, name, songs, processes, threads, args.affinity)
+            results.append((elapsed, processes, threads))
+            print(f"{processes} processes x {threads} threads: {elapsed:7.2f}s  "
+                  f"{songs_per_minute(songs, elapsed):6.2f} songs/min  "
+                  f"x{baseline / elapsed:.2f}")
+
+    if results:
+        elapsed, processes, threads = min(results)
+        print(f"best: INFERENCE_PROCESSES={processes} INFERENCE_THREADS={threads} "
+              f"({songs_per_minute(songs, elapsed):.2f} songs/min)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Seconds of CPU separation per audio minute and peak memory for each model.
+
+    python tests/bench_models.py --models htdemucs htdemucs_ft hdemucs_mmi mdx_extra_q
+    python tests/bench_models.py --tiny   # random small models, no download
+
+Each model runs in a fresh process so its peak RSS isn't inflated by the
+ones before it. Prints a markdown table to paste into the model registry
+discussion; use it to set `relative_cost` in `utils/model_registry.py`.
+"""
+import argparse
+import multiprocessing
+import resource
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.model_registry import model_bytes
+from utils.separation_engine import load_weights, run_segments, separate_tensor
+
+
+def tiny_model(name):
+    from demucs.hdemucs import HDemucs
+    from demucs.htdemucs import HTDemucs
+    sources = ['drums', 'bass', 'other', 'vocals']
+    if name == 'tiny-hdemucs':
+        return HDemucs(sources=sources, channels=8, segment=4).eval()
+    return HTDemucs(sources=sources, channels=8, depth=4, t_layers=1, segment=4).eval()
+
+
+def measure(name, seconds, tiny, threads, results):
+    torch.set_num_threads(threads)
+    load_start = perf_counter()
+    model = tiny_model(name) if tiny else load_weights(name)
+    load_time = perf_counter() - load_start
+    wav = torch.randn(model.audio_channels, int(seconds * model.samplerate)) * 0.1
+
+    start = perf_counter()
+    separate_tensor(model, wav, run_segments)
+    elapsed = perf_counter() - start
+    results.put({
+        'model': name,
+        'load_time': load_time,
+        'seconds_per_minute': elapsed / seconds * 60,
+        'weights_mb': model_bytes(model) / 1024 ** 2,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", nargs="+", default=["htdemucs", "htdemucs_ft", "hdemucs_mmi"])
+    parser.add_argument("--tiny", action="store_true", help="use random small models")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+    models = ["tiny-htdemucs", "tiny-hdemucs"] if args.tiny else args.models
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for name in models:
+        results = context.Queue()
+        process = context.Process(target=measure, args=(name, args.seconds, args.tiny, args.threads, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"{name}: failed with exit code {process.exitcode}")
+            continue
+        rows.append(results.get())
+
+    print(f"{args.seconds:.0f}s of audio, {args.threads} torch threads\n")
+    print("| model | s / audio min | x realtime | load s | weights MB | peak RSS MB |")
+    print("|---|---:|---:|---:|---:|---:|")
+    for row in rows:
+        print(f"| {row['model']} | {row['seconds_per_minute']:.1f} | {60 / row['seconds_per_minute']:.2f} "
+              f"| {row['load_time']:.2f} | {row['weights_mb']:.0f} | {row['peak_rss_mb']:.0f} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Measure stem upload wall time for 2 and 4 stem jobs.
+
+    python tests/bench_s3_upload.py --stem-mb 40
+    python tests/bench_s3_upload.py --endpoint-url http://localhost:9000   # MinIO
+
+Without --endpoint-url an in-process moto server is started. Each job is
+uploaded twice: one stem after the other (the previous loop) and with
+`upload_stems_to_s3`, which uploads every stem concurrently.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from flask import Flask
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api.separate_routes import upload_stems_to_s3
+from utils.s3_client import MB, TRANSFER_CONFIG, get_s3_client
+
+STEMS = {
+    2: ['vocals', 'instrumental'],
+    4: ['vocals', 'drums', 'bass', 'other']
+}
+
+
+def write_stems(directory, stems, size):
+    stems_files = {}
+    for stem in stems:
+        path = Path(directory) / f"{stem}.wav"
+        path.write_bytes(os.urandom(size))
+        stems_files[stem] = str(path)
+    return stems_files
+
+
+def upload_one_by_one(stems_files, bucket_name):
+    s3_client = get_s3_client()
+    for stem, stem_path in stems_files.items():
+        with open(stem_path, 'rb') as stem_data:
+            s3_client.upload_fileobj(stem_data, bucket_name, f"bench/{stem}.wav",
+                                     ExtraArgs={'ContentType': 'audio/wav'}, Config=TRANSFER_CONFIG)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stem-mb", type=int, default=40)
+    parser.add_argument("--endpoint-url")
+    parser.add_argument("--bucket", default="stem-splitter-bench")
+    args = parser.parse_args()
+
+    server = None
+    if args.endpoint_url:
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url
+    else:
+        from moto.server import ThreadedMotoServer
+        server = ThreadedMotoServer(port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        os.environ['AWS_ENDPOINT_URL'] = f"http://{host}:{port}"
+        for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(name, 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['AWS_BUCKET_NAME'] = args.bucket
+
+    s3_client = get_s3_client()
+    try:
+        s3_client.create_bucket(Bucket=args.bucket)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    try:
+        with tempfile.TemporaryDirectory() as directory, Flask(__name__).app_context():
+            for count, stems in STEMS.items():
+                stems_files = write_stems(directory, stems, args.stem_mb * MB)
+                start = perf_counter()
+                upload_one_by_one(stems_files, args.bucket)
+                sequential = perf_counter() - start
+
+                start = perf_counter()
+                _, error = upload_stems_to_s3(stems_files, "bench.wav", prefix="bench")
+                concurrent = perf_counter() - start
+                if error:
+                    raise RuntimeError(error[0].get_json()["error"])
+
+                print(f"{count} stems x {args.stem_mb} MB: one by one {sequential:6.2f}s, "
+                      f"concurrent {concurrent:6.2f}s")
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+"""End-to-end and per-function benchmarks of the separation service.
+
+    python tests/bench_service.py --tiny --durations 30 240 --clients 4 --jobs 8
+    python tests/bench_service.py --durations 30 240 3600 --workers 2
+    python tests/bench_service.py --tiny --micro-only --repeat 5
+    python tests/bench_service.py --compare temp/bench/service-abc1234-*.json temp/bench/service-def5678-*.json
+
+Synthetic tracks of each duration (seeded, so every run separates the same
+audio) are served by a local HTTP file server; stems go to an in-process
+moto S3 unless --endpoint-url points at a real one. Each scenario has
+`--clients` threads submit `--jobs` jobs through `/api/separate`, poll them
+to completion and fetch every stem through `/api/download_stem`, all via the
+Flask app. Reports latency percentiles, throughput, real-time factor and
+peak memory, and saves everything as JSON under temp/bench/ (or --output)
+so runs on different commits can be compared with --compare.
+
+The micro-benchmarks time `prepare_audio_file`, `run_separation`,
+`upload_stems_to_s3` and `download_file` on their own. --tiny swaps the
+Demucs checkpoint for a small random model, which measures the service
+around inference rather than inference itself.
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+from unittest.mock import patch
+
+import numpy as np
+import soundfile as sf
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+SAMPLERATE = 44100
+BUCKET = "stem-splitter-bench"
+RESULTS_DIR = Path("temp/bench")
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile, None without samples."""
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def summary(samples):
+    return {
+        'count': len(samples),
+        'mean': mean(samples) if samples else None,
+        'p50': percentile(samples, 0.50),
+        'p95': percentile(samples, 0.95),
+        'p99': percentile(samples, 0.99),
+        'max': max(samples) if samples else None
+    }
+
+
+def write_track(path, seconds, seed=0, block_seconds=10):
+    """Write a reproducible stereo 16 bit WAV: a chord, a bass line and noise hits, block by block."""
+    rng = np.random.default_rng(seed)
+    with sf.SoundFile(str(path), 'w', SAMPLERATE, 2, 'PCM_16') as f:
+        total = int(seconds * SAMPLERATE)
+        block = block_seconds * SAMPLERATE
+        for start in range(0, total, block):
+            t = np.arange(start, min(start + block, total)) / SAMPLERATE
+            chord = sum(0.12 * np.sin(2 * np.pi * freq * t) for freq in (220, 277.2, 329.6))
+            bass = 0.2 * np.sin(2 * np.pi * 55 * t) * (1 + np.sign(np.sin(2 * np.pi * 0.5 * t))) / 2
+            hits = rng.normal(0, 0.15, t.shape) * (np.mod(t, 0.5) < 0.05)
+            left = chord + bass + hits
+            right = 0.8 * chord + bass + np.roll(hits, 200)
+            f.write(np.clip(np.stack([left, right], axis=1), -1, 1).astype(np.float32))
+    return path
+
+
+def start_file_server(directory):
+    """Serve `directory` over HTTP on a free local port and return `(server, base_url)`."""
+    handler = functools.partial(QuietHandler, directory=str(directory))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PeakMemory:
+    """Highest resident memory seen while the block runs, sampled every `interval` seconds."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        from utils.metrics import resident_memory_bytes
+        self.peak = resident_memory_bytes()
+
+        def sample():
+            while not self._stop.wait(self.interval):
+                self.peak = max(self.peak, resident_memory_bytes())
+
+        self._thread = threading.Thread(target=sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def tiny_model(name=None):
+    from demucs.htdemucs import HTDemucs
+    return HTDemucs(sources=['drums', 'bass', 'other', 'vocals'], channels=8, depth=4, t_layers=1,
+                    segment=4).eval()
+
+
+def configure(args):
+    """Point the service at the benchmark S3 and settings; must run before `server` is imported."""
+    s3_server = None
+    if args.endpoint_url:
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url
+    else:
+        from moto.server import ThreadedMotoServer
+        # moto's werkzeug server logs every request
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        s3_server = ThreadedMotoServer(port=0)
+        s3_server.start()
+        host, port = s3_server.get_host_and_port()
+        os.environ['AWS_ENDPOINT_URL'] = f"http://{host}:{port}"
+        for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(name, 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['AWS_BUCKET_NAME'] = args.bucket
+    os.environ.update({
+        'JOB_QUEUE_BACKEND': 'memory',
+        'SEPARATION_WORKERS': str(args.workers),
+        # Every job is queued up front, from a single client address
+        'SEPARATION_QUEUE_DEPTH': str(args.jobs + 1),
+        'SEPARATION_QUEUE_CLIENT_DEPTH': str(args.jobs + 1),
+        'RESULT_CACHE_ENABLED': '1' if args.cache else '0',
+        'SEGMENT_STORE_ENABLED': '0',
+        'RETENTION_ENABLED': '0',
+        'TRACING_ENABLED': '0',
+        'INGEST_MAX_MB': str(max(1024, int(max(args.durations) * SAMPLERATE * 4 / 2 ** 20) + 1)),
+    })
+
+    from utils.s3_client import get_s3_client
+    s3_client = get_s3_client()
+    try:
+        s3_client.create_bucket(Bucket=args.bucket)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    return s3_server
+
+
+def run_job(client, link, mode, streaming, poll_interval):
+    """Submit one job, wait for it and download its stems; return its measurements."""
+    start = perf_counter()
+    response = client.post("/api/separate", data={'link': link, 'mode': mode, 'streaming': str(int(streaming))})
+    if response.status_code != 202:
+        return {'error': f"{response.status_code} {response.get_json()}"}
+    while True:
+        status = client.get(response.json['status_url']).get_json()
+        if status['status'] in ('done', 'failed'):
+            break
+        time.sleep(poll_interval)
+    latency = perf_counter() - start
+    if status['status'] == 'failed':
+        return {'error': status['error'], 'latency': latency}
+
+    # The job result is merged into its status
+    result = status
+    downloads = []
+    download_bytes = 0
+    for url in result['downloads'].values():
+        download_start = perf_counter()
+        stem = client.get(f"/api/download_stem/{url}")
+        downloads.append(perf_counter() - download_start)
+        download_bytes += len(stem.data)
+    timings = result.get('timings', {})
+    audio_duration = timings.get('audio_duration')
+    return {
+        'latency': latency,
+        'queue_wait': status['started_at'] - status['created_at'] if status.get('started_at') else None,
+        'processing_time': result['processing_time'],
+        'realtime_factor': result['processing_time'] / audio_duration if audio_duration else None,
+        'timings': timings,
+        'downloads': downloads,
+        'download_bytes': download_bytes
+    }
+
+
+def run_scenario(app, link, seconds, args):
+    """Drive `args.jobs` jobs of the track at `link` through `args.clients` concurrent clients."""
+    streaming = args.streaming == 'always' or (args.streaming == 'auto' and seconds > args.streaming_above)
+
+    def client_loop(count):
+        client = app.test_client()
+        return [run_job(client, link, args.mode, streaming, args.poll_interval) for _ in range(count)]
+
+    shares = [args.jobs // args.clients + (i < args.jobs % args.clients) for i in range(args.clients)]
+    with PeakMemory() as memory:
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            jobs = [job for jobs in pool.map(client_loop, shares) for job in jobs]
+        wall_time = perf_counter() - start
+
+    done = [job for job in jobs if 'error' not in job]
+    stages = {}
+    for job in done:
+        for name, value in job['timings'].items():
+            if name.endswith('_time'):
+                stages.setdefault(name, []).append(value)
+    return {
+        'audio_seconds': seconds,
+        'streaming': streaming,
+        'jobs': len(jobs),
+        'failed': len(jobs) - len(done),
+        'errors': sorted({job['error'] for job in jobs if 'error' in job})[:5],
+        'wall_time': wall_time,
+        'throughput_jobs_per_s': len(done) / wall_time,
+        'throughput_audio_s_per_s': len(done) * seconds / wall_time,
+        'latency': summary([job['latency'] for job in done]),
+        'queue_wait': summary([job['queue_wait'] for job in done if job['queue_wait'] is not None]),
+        'download_latency': summary([latency for job in done for latency in job['downloads']]),
+        'download_mb_per_s': sum(job['download_bytes'] for job in done) / 2 ** 20
+                             / max(sum(sum(job['downloads']) for job in done), 1e-9),
+        'realtime_factor': summary([job['realtime_factor'] for job in done if job['realtime_factor']]),
+        'stage_means': {name: mean(values) for name, values in sorted(stages.items())},
+        'peak_rss_mb': memory.peak / 2 ** 20
+    }
+
+
+def time_calls(call, repeat, setup=None):
+    """Run `call(setup())` `repeat` times and summarize its wall times."""
+    times = []
+    for _ in range(repeat):
+        value = setup() if setup else None
+        start = perf_counter()
+        call(value)
+        times.append(perf_counter() - start)
+    return {'runs': repeat, 'min': min(times), 'median': median(times), 'mean': mean(times)}
+
+
+def run_micro(app, link, workdir, args):
+    """Time the four building blocks of a job one by one on the same track."""
+    from flask import Flask
+    from server.api.separate_routes import prepare_audio_file, run_separation, upload_stems_to_s3
+
+    def check(error):
+        if error:
+            raise RuntimeError(error[0].get_json()["error"])
+
+    results = {}
+    scratch = workdir / "micro"
+    scratch.mkdir(exist_ok=True)
+    with Flask(__name__).app_context():
+        def prepare(_):
+            temp_path, _, error = prepare_audio_file(link, scratch)
+            check(error)
+            temp_path.unlink()
+
+        results['prepare_audio_file'] = time_calls(prepare, args.repeat)
+
+        track, _, error = prepare_audio_file(link, scratch)
+        check(error)
+        stems_dir = workdir / "micro-stems"
+
+        def separate(_):
+            shutil.rmtree(stems_dir, ignore_errors=True)
+            result = run_separation(track, args.mode, output_dir=stems_dir)
+            if len(result) == 5:
+                check((result[3], result[4]))
+
+        results['run_separation'] = time_calls(separate, args.repeat)
+        stems_files = {path.stem: str(path) for path in stems_dir.glob("*.mp3")}
+
+        def copy_stems():
+            # upload_stems_to_s3 deletes what it uploaded
+            copies = workdir / "micro-upload"
+            shutil.rmtree(copies, ignore_errors=True)
+            copies.mkdir()
+            return {stem: shutil.copy(path, copies) for stem, path in stems_files.items()}
+
+        links = {}
+
+        def upload(copies):
+            result = upload_stems_to_s3(copies, "bench.wav", prefix="bench/micro")
+            if len(result) == 3:
+                check(result[1:])
+            links.update(result[0])
+
+        results['upload_stems_to_s3'] = time_calls(upload, args.repeat, setup=copy_stems)
+        results['upload_stems_to_s3']['mb'] = sum(os.path.getsize(path) for path in stems_files.values()) / 2 ** 20
+
+    client = app.test_client()
+    url = next(iter(links.values()))
+
+    def download(_):
+        response = client.get(f"/api/download_stem/{url}")
+        if response.status_code != 200:
+            raise RuntimeError(f"download_file answered {response.status_code}")
+
+    results['download_file'] = time_calls(download, args.repeat)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    for scenario in report['scenarios']:
+        latency, rtf = scenario['latency'], scenario['realtime_factor']
+        print(f"{scenario['audio_seconds']:>6.0f}s audio{' (streaming)' if scenario['streaming'] else ''}: "
+              f"{scenario['jobs'] - scenario['failed']}/{scenario['jobs']} jobs in {scenario['wall_time']:.1f}s, "
+              f"{scenario['throughput_audio_s_per_s']:.2f} audio s/s, peak RSS {scenario['peak_rss_mb']:.0f} MB")
+        if latency['count']:
+            print(f"        latency p50 {latency['p50']:.2f}s p95 {latency['p95']:.2f}s p99 {latency['p99']:.2f}s, "
+                  f"real-time factor p50 {rtf['p50'] or 0:.3f}")
+        for error in scenario['errors']:
+            print(f"        error: {error}")
+    for name, timing in report['micro'].items():
+        print(f"{name:>20}: median {timing['median']:.3f}s min {timing['min']:.3f}s over {timing['runs']} runs")
+
+
+def compare(before_path, after_path):
+    """Print the change of the headline numbers between two result files."""
+    before, after = (json.loads(Path(path).read_text()) for path in (before_path, after_path))
+    print(f"{before['commit']} -> {after['commit']}")
+    old = {scenario['audio_seconds']: scenario for scenario in before['scenarios']}
+    for scenario in after['scenarios']:
+        previous = old.get(scenario['audio_seconds'])
+        if not previous or not previous['latency']['count'] or not scenario['latency']['count']:
+            continue
+        for name in ('p50', 'p95', 'p99'):
+            a, b = previous['latency'][name], scenario['latency'][name]
+            print(f"{scenario['audio_seconds']:>6.0f}s latency {name}: {a:.2f}s -> {b:.2f}s ({(b - a) / a:+.0%})")
+    for name, timing in after['micro'].items():
+        if name in before['micro']:
+            a, b = before['micro'][name]['median'], timing['median']
+            print(f"{name:>20}: {a:.3f}s -> {b:.3f}s ({(b - a) / a:+.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--durations", type=float, nargs="+", default=[30, 240, 3600],
+                        help="seconds of synthetic audio per scenario")
+    parser.add_argument("--clients", type=int, default=2, help="concurrent clients")
+    parser.add_argument("--jobs", type=int, default=4, help="jobs per scenario")
+    parser.add_argument("--workers", type=int, default=1, help="SEPARATION_WORKERS")
+    parser.add_argument("--mode", default="2")
+    parser.add_argument("--streaming", choices=["never", "auto", "always"], default="auto")
+    parser.add_argument("--streaming-above", type=float, default=600,
+                        help="with --streaming auto, tracks longer than this many seconds stream")
+    parser.add_argument("--cache", action="store_true", help="leave the result cache on")
+    parser.add_argument("--tiny", action="store_true", help="use a small random model")
+    parser.add_argument("--micro-seconds", type=float, default=30, help="track length of the micro-benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each micro-benchmark")
+    parser.add_argument("--micro-only", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--endpoint-url")
+    parser.add_argument("--bucket", default=BUCKET)
+    parser.add_argument("--output", help="JSON results path (default temp/bench/service-<commit>-<time>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    s3_server = configure(args)
+    model_patch = patch('utils.separation_engine.get_model', side_effect=tiny_model) if args.tiny else None
+    if model_patch:
+        model_patch.start()
+    from server import app
+    import torch
+
+    report = {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+            'cpus': os.cpu_count()
+        },
+        'scenarios': [],
+        'micro': {}
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        workdir = Path(directory)
+        tracks = workdir / "tracks"
+        tracks.mkdir()
+        file_server, base_url = start_file_server(tracks)
+        try:
+            if not args.micro_only:
+                for seconds in args.durations:
+                    name = f"track_{seconds:g}s.wav"
+                    write_track(tracks / name, seconds)
+                    print(f"Running {args.jobs} jobs of {seconds:g}s audio with {args.clients} clients...")
+                    report['scenarios'].append(run_scenario(app, f"{base_url}/{name}", seconds, args))
+            if not args.skip_micro:
+                name = f"micro_{args.micro_seconds:g}s.wav"
+                write_track(tracks / name, args.micro_seconds, seed=1)
+                print(f"Running micro-benchmarks on {args.micro_seconds:g}s audio...")
+                report['micro'] = run_micro(app, f"{base_url}/{name}", workdir, args)
+        finally:
+            file_server.shutdown()
+            if model_patch:
+                model_patch.stop()
+            if s3_server:
+                s3_server.stop()
+
+    print_report(report)
+    output = Path(args.output) if args.output else (
+        RESULTS_DIR / f"service-{report['commit'] or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+from flask import Flask
+from moto import mock_aws
+
+sys.path.append(str(Path(__file__).parent.parent))
+# Keep the metrics every imported server worker flushes out of the repo
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='metrics-'))
+from utils import separation_engine
+from utils.s3_client import get_s3_client, reset_s3_client
+
+
+class StubModel(torch.nn.Module):
+    """Tiny stand-in for a Demucs model: every source is a fixed share of the mix."""
+    sources = ['drums', 'bass', 'other', 'vocals']
+    samplerate = 44100
+    audio_channels = 2
+    segment = 1.0
+
+    def __init__(self):
+        super().__init__()
+        self.gains = torch.nn.Parameter(torch.tensor([0.1, 0.2, 0.3, 0.4]), requires_grad=False)
+
+    def forward(self, mix):
+        return mix[:, None] * self.gains[None, :, None, None]
+
+
+@pytest.fixture
+def stub_model():
+    """Serve `StubModel` from the separation engine instead of a real checkpoint."""
+    model = StubModel()
+    separation_engine.unload_models()
+    with patch('utils.separation_engine.get_model', return_value=model) as mock_get_model:
+        yield mock_get_model
+    separation_engine.unload_models()
+
+
+@pytest.fixture
+def make_track(tmp_path):
+    """Write a short synthetic stereo track and return its path."""
+    def _make_track(seconds=2.0, samplerate=44100, name="song.wav"):
+        t = np.arange(int(seconds * samplerate)) / samplerate
+        left = 0.5 * np.sin(2 * np.pi * 220 * t)
+        right = 0.5 * np.sin(2 * np.pi * 330 * t)
+        path = tmp_path / name
+        sf.write(str(path), np.stack([left, right], axis=1).astype('float32'), samplerate)
+        return path
+    return _make_track
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """A moto S3 with an empty `test-bucket` behind the shared client."""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_BUCKET_NAME', 'test-bucket')
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with mock_aws():
+        reset_s3_client()
+        client = get_s3_client()
+        client.create_bucket(Bucket='test-bucket')
+        with Flask(__name__).app_context():
+            yield client
+    reset_s3_client()
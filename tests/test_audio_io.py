@@ -0,0 +1,108 @@
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils import audio_io, install_ffmpeg
+from utils.audio_io import decode, encode, probe
+from utils.convert_m4a_to_mp3 import convert_m4a_to_mp3
+from utils.get_audio_info import get_audio_info
+
+
+def test_probe_reads_header_in_process(make_track):
+    track = make_track(seconds=2, samplerate=48000)
+
+    with patch('subprocess.run') as mock_run:
+        info = probe(track)
+
+    mock_run.assert_not_called()
+    assert info.samplerate == 48000
+    assert info.channels == 2
+    assert info.frames == 96000
+    assert info.duration == pytest.approx(2.0)
+
+
+def test_get_audio_info_without_ffprobe(make_track):
+    assert get_audio_info(str(make_track(seconds=1, samplerate=22050))) == 22050
+
+
+def test_decode_returns_channels_first(make_track):
+    data, samplerate = decode(make_track(seconds=1))
+
+    assert samplerate == 44100
+    assert data.shape == (2, 44100)
+    assert data.dtype == np.float32
+    assert data.flags['C_CONTIGUOUS']
+
+
+def test_mp3_round_trip(tmp_path):
+    wav = np.random.uniform(-0.5, 0.5, (2, 44100)).astype(np.float32)
+    path = tmp_path / "stem.mp3"
+
+    encode(path, wav, 44100)
+
+    info = sf.info(str(path))
+    assert info.samplerate == 44100
+    assert info.channels == 2
+    assert info.duration == pytest.approx(1.0, abs=0.1)
+
+
+def test_encode_rescales_loud_audio(tmp_path):
+    path = tmp_path / "stem.flac"
+
+    encode(path, np.full((2, 1000), 2.0, dtype=np.float32), 44100)
+
+    data, _ = sf.read(str(path))
+    assert np.abs(data).max() <= 1.0
+
+
+def test_m4a_is_piped_out_of_one_ffmpeg_process(tmp_path):
+    pcm = np.arange(8, dtype=np.float32).reshape(4, 2)
+    completed = MagicMock(stdout=pcm.tobytes())
+
+    with patch('subprocess.run', return_value=completed) as mock_run:
+        data, samplerate = decode(tmp_path / "song.m4a", samplerate=44100, channels=2)
+
+    mock_run.assert_called_once()
+    command = mock_run.call_args[0][0]
+    assert command[0] == 'ffmpeg'
+    assert command[-1] == '-'
+    assert samplerate == 44100
+    np.testing.assert_array_equal(data, pcm.T)
+
+
+def test_convert_m4a_to_mp3_encodes_in_process(tmp_path):
+    wav = np.zeros((2, 44100), dtype=np.float32)
+    output = tmp_path / "song.mp3"
+
+    with patch.object(audio_io, '_ffmpeg_decode', return_value=(wav, 44100)) as mock_decode:
+        converted, samplerate = convert_m4a_to_mp3(str(tmp_path / "song.m4a"), str(output))
+
+    mock_decode.assert_called_once()
+    assert converted is True
+    assert samplerate == 44100
+    assert sf.info(str(output)).samplerate == 44100
+
+
+def test_convert_m4a_to_mp3_reports_failure(tmp_path):
+    with patch('subprocess.run', side_effect=FileNotFoundError("ffmpeg")):
+        assert convert_m4a_to_mp3(str(tmp_path / "song.m4a"), str(tmp_path / "out.mp3")) == (False, None)
+
+
+def test_check_ffmpeg_runs_once(monkeypatch):
+    monkeypatch.setattr(install_ffmpeg, '_ffmpeg_available', None)
+
+    with patch('subprocess.run') as mock_run:
+        assert install_ffmpeg.check_ffmpeg() is True
+        assert install_ffmpeg.check_ffmpeg() is True
+        mock_run.assert_called_once()
+
+        mock_run.side_effect = FileNotFoundError("ffmpeg")
+        assert install_ffmpeg.check_ffmpeg(refresh=True) is False
+        assert install_ffmpeg.check_ffmpeg() is False
+        assert mock_run.call_count == 2
@@ -0,0 +1,262 @@
+import io
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import batch_routes, separate_routes
+from server.api.batch_routes import add_items, batch_item, parse_manifest, run_batch
+from utils.batch_items import MemoryItemStore, SQLiteItemStore
+from utils.job_queue import MemoryJobStore
+
+LINKS = [f"https://example.com/{name}.wav" for name in ('one', 'broken', 'three')]
+
+
+@pytest.fixture(autouse=True)
+def item_store():
+    with patch.object(batch_routes, 'item_store', MemoryItemStore()) as store:
+        yield store
+
+
+@pytest.fixture(autouse=True)
+def separation_queue():
+    from server import app  # noqa: F401, runs the queue's jobs in the app context
+    queue = separate_routes.separation_queue
+    with patch.object(queue, 'store', MemoryJobStore()), \
+            patch.object(queue, 'poll_interval', 0.01), \
+            patch.object(batch_routes, 'POLL_INTERVAL', 0.01), \
+            patch.object(batch_routes, 'estimate_cost', return_value=None):
+        yield queue
+
+
+def entry(index):
+    return {'index': index, 'link': f"https://example.com/{index}.mp3", 'params': {'i': index, 'model': 'htdemucs'}}
+
+
+def fake_download(make_track):
+    def prepare_audio_file(url, scratch=None):
+        if 'broken' in url:
+            raise RuntimeError("Failed to prepare audio file: 404")
+        return make_track(seconds=1.0, name=url.rsplit('/', 1)[1]), url.rsplit('/', 1)[1], None
+    return prepare_audio_file
+
+
+def test_items_are_validated_like_single_requests(s3):
+    params, error = batch_item({'link': LINKS[0], 'mode': '4', 'format': 'flac', 'start': 10})
+
+    assert error is None
+    assert (params['mode'], params['format'], params['bitrate'], params['window']) == ('4', 'flac', None, [10.0, 30.0])
+    assert batch_item({'mode': '2'}) == (None, "No audio URL provided")
+    assert batch_item({'link': LINKS[0], 'bitrate': 1000})[1] == "mp3 bitrate must be from 96 to 320 kbps"
+
+
+def test_manifest_formats():
+    assert parse_manifest(json.dumps({'items': [LINKS[0]]})) == [LINKS[0]]
+    assert parse_manifest(f"# album\n{LINKS[0]}\n\n{{\"link\": \"{LINKS[1]}\", \"mode\": \"4\"}}\n") == [
+        LINKS[0], {'link': LINKS[1], 'mode': '4'}
+    ]
+
+
+def test_failed_items_do_not_stop_the_batch(s3, stub_model, make_track, item_store):
+    entries = [{'index': i, 'link': link, 'params': batch_item({'link': link})[0]} for i, link in enumerate(LINKS)]
+    entries.append({'index': 3, 'link': None, 'error': "No audio URL provided"})
+    reports = []
+    add_items('batch', entries)
+
+    with patch.object(separate_routes, 'result_cache', None), \
+            patch.object(separate_routes, 'prepare_audio_file', side_effect=fake_download(make_track)):
+        result = run_batch({'batch_id': 'batch', 'items': entries},
+                           lambda stage, progress, **fields: reports.append(progress))
+
+    items = item_store.items('batch')
+    assert [item['status'] for item in items] == ['done', 'failed', 'done', 'failed']
+    assert (result['total'], result['done'], result['failed']) == (4, 2, 2)
+    assert items[1]['error'] == "Failed to prepare audio file: 404"
+    assert items[2]['downloads']['vocals'].endswith('/vocals_three.mp3')
+    assert reports[0] == 0.25 and reports[-1] == 1.0
+
+
+def test_batch_queued_again_only_runs_unfinished_items(item_store, separation_queue):
+    ran = []
+    entries = [entry(i) for i in range(5)]
+    add_items('batch', entries)
+    # A job the dead worker had queued, finished since
+    with patch.object(separation_queue.store, 'claim', return_value=None):
+        job_id = separation_queue.submit({'i': 3})
+        separation_queue.store.update(job_id, status='done', result={'downloads': {'vocals': 'v'}})
+    # Left behind by a worker that died: one item done, one failed, one cut short before its job was queued
+    item_store.update('batch', 0, status='done', downloads={})
+    item_store.update('batch', 1, status='failed', error="boom")
+    item_store.update('batch', 2, status='running')
+    item_store.update('batch', 3, status='running', job_id=job_id)
+
+    with patch.object(separation_queue, 'handler',
+                      side_effect=lambda params, report: ran.append(params['i']) or {'downloads': {}}):
+        result = run_batch({'batch_id': 'batch', 'items': entries}, lambda *args, **kwargs: None)
+
+    assert sorted(ran) == [2, 4]
+    assert (result['done'], result['failed']) == (4, 1)
+    assert item_store.items('batch')[3]['downloads'] == {'vocals': 'v'}
+
+
+def test_sqlite_items_are_updated_one_row_at_a_time(tmp_path):
+    store = SQLiteItemStore(tmp_path / "batches.db")
+    store.add('batch', [{'index': i, 'link': str(i), 'status': 'queued'} for i in range(3)])
+    before = time.time()
+
+    store.update('batch', 1, status='done', downloads={'vocals': 'v'})
+    store.update('batch', 2, status='failed', error="boom")
+
+    assert [item['status'] for item in store.items('batch')] == ['queued', 'done', 'failed']
+    assert [item['index'] for item in store.items('batch', finished_since=before)] == [1, 2]
+    assert store.items('batch')[1]['downloads'] == {'vocals': 'v'}
+    assert store.totals('batch') == {'total': 3, 'done': 1, 'failed': 1}
+    assert SQLiteItemStore(tmp_path / "batches.db").items('batch')[2]['error'] == "boom"
+
+
+def test_items_run_on_the_separation_queue_workers(item_store, separation_queue):
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def separate(params, report):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        return {'downloads': {}}
+
+    entries = [entry(i) for i in range(6)]
+    add_items('batch', entries)
+    with patch.object(batch_routes, 'CONCURRENCY', 3), \
+            patch.object(separation_queue, 'workers', 2), \
+            patch.object(separation_queue, 'handler', side_effect=separate):
+        separation_queue.start()
+        result = run_batch({'batch_id': 'batch', 'items': entries, 'client': 'label'},
+                           lambda *args, **kwargs: None)
+
+    assert result['done'] == 6
+    # Items share the queue's workers instead of running beside them
+    assert peak[0] == 2
+    jobs = [separation_queue.store.get(item['job_id']) for item in item_store.items('batch')]
+    assert {(job['priority'], job['client']) for job in jobs} == {('bulk', 'label')}
+
+
+def test_full_separation_queue_holds_items_back(item_store, separation_queue):
+    entries = [entry(i) for i in range(3)]
+    add_items('batch', entries)
+    with patch.object(batch_routes, 'CONCURRENCY', 3), \
+            patch.object(separation_queue, 'max_per_client', 1), \
+            patch.object(separation_queue, 'handler', side_effect=lambda params, report: {'downloads': {}}):
+        result = run_batch({'batch_id': 'batch', 'items': entries, 'client': 'label'},
+                           lambda *args, **kwargs: None)
+
+    assert result['done'] == 3
+
+
+class TestBatchRoutes:
+
+    @pytest.fixture(autouse=True)
+    def client(self, s3, stub_model, make_track):
+        from server import app
+        self.queue = batch_routes.batch_queue
+        with patch.object(self.queue, 'store', MemoryJobStore()), \
+                patch.object(self.queue, 'poll_interval', 0.01), \
+                patch.object(batch_routes, 'ensure_ffmpeg', return_value=True), \
+                patch.object(separate_routes, 'result_cache', None), \
+                patch.object(separate_routes, 'prepare_audio_file', side_effect=fake_download(make_track)):
+            with app.test_client() as client:
+                self.client = client
+                yield
+
+    def wait(self, response):
+        assert response.status_code == 202, response.json
+        return self.wait_for(response.json['status_url'])
+
+    def wait_for(self, status_url):
+        for _ in range(500):
+            status = self.client.get(status_url).json
+            if status['status'] in ('done', 'failed'):
+                return status
+            time.sleep(0.02)
+        raise AssertionError("batch did not finish")
+
+    def test_json_batch_with_defaults(self):
+        response = self.client.post("/api/separate/batch", json={
+            'mode': '4',
+            'items': [LINKS[0], {'link': LINKS[2], 'mode': '2'}, {'link': LINKS[1]}]
+        })
+
+        assert response.json['items'] == 3 and response.json['invalid'] == 0
+        status = self.wait(response)
+        assert status['status'] == 'done'
+        assert (status['done'], status['failed']) == (2, 1)
+        assert sorted(status['items'][0]['downloads']) == ['bass', 'drums', 'other', 'vocals']
+        assert sorted(status['items'][1]['downloads']) == ['instrumental', 'vocals']
+        assert status['items'][2]['status'] == 'failed'
+
+    def test_invalid_items_are_reported_not_refused(self):
+        response = self.client.post("/api/separate/batch", json={'items': [LINKS[0], {'link': LINKS[2], 'format': 'ogg'}]})
+
+        assert response.json['invalid'] == 1
+        status = self.wait(response)
+        assert [item['status'] for item in status['items']] == ['done', 'failed']
+        assert status['items'][1]['error'].startswith("format must be one of")
+
+    def test_manifest_upload(self, tmp_path):
+        manifest = "\n".join(LINKS[::2]).encode()
+
+        response = self.client.post("/api/separate/batch", data={
+            'manifest': (io.BytesIO(manifest), "album.txt"),
+            'format': 'opus'
+        })
+
+        status = self.wait(response)
+        assert status['done'] == 2
+        assert all(item['format'] == 'opus' for item in status['items'])
+
+    def test_stream_ends_in_time_with_a_status_url(self):
+        release = threading.Event()
+
+        def separate(params, report):
+            release.wait(5)
+            return {'downloads': {}}
+
+        with patch.object(batch_routes, 'STREAM_MAX_SECONDS', 0.2), \
+                patch.object(separate_routes.separation_queue, 'handler', side_effect=separate):
+            start = time.monotonic()
+            response = self.client.post("/api/separate/batch?stream=1", json={'items': LINKS[::2]})
+            lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            release.set()
+
+        assert time.monotonic() - start < 2
+        assert lines[-1]['status'] in ('queued', 'running')
+        assert lines[-1]['status_url'] == f"/api/separate/batch/{lines[-1]['batch_id']}"
+        assert self.wait_for(lines[-1]['status_url'])['done'] == 2
+
+    def test_results_stream_as_ndjson(self):
+        response = self.client.post("/api/separate/batch?stream=1", json={'items': LINKS})
+
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert sorted(line['index'] for line in lines[:-1]) == [0, 1, 2]
+        assert {line['index']: line['status'] for line in lines[:-1]}[1] == 'failed'
+        assert lines[-1]['status'] == 'done'
+        assert (lines[-1]['total'], lines[-1]['done'], lines[-1]['failed']) == (3, 2, 1)
+
+    @pytest.mark.parametrize('body', [{'items': []}, {'items': [{'mode': '2'}]}, {'items': 'nope'}])
+    def test_empty_or_all_invalid_batches_are_refused(self, body):
+        assert self.client.post("/api/separate/batch", json=body).status_code == 400
+
+    def test_batch_size_is_limited(self):
+        with patch.object(batch_routes, 'MAX_ITEMS', 2):
+            assert self.client.post("/api/separate/batch", json={'items': LINKS}).status_code == 400
+
+    def test_unknown_batch(self):
+        assert self.client.get("/api/separate/batch/nope").status_code == 404
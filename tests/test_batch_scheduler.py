@@ -0,0 +1,98 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.batch_scheduler import BatchScheduler
+from utils.separation_engine import run_segments, separate_tensor
+
+
+class RecordingModel:
+    """Stands in for `run_model`: tags each output with the segment it came from."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, model, batch):
+        self.batch_sizes.append(batch.shape[0])
+        return batch * 2
+
+
+def test_segments_from_concurrent_jobs_share_batches():
+    recorder = RecordingModel()
+    scheduler = BatchScheduler(recorder, max_batch_size=4, max_wait=0.5)
+    results = {}
+
+    def job(job_id):
+        segments = [torch.full((2, 8), float(job_id * 10 + i)) for i in range(4)]
+        results[job_id] = list(scheduler.run("htdemucs", None, segments, lookahead=4))
+
+    threads = [threading.Thread(target=job, args=(job_id,)) for job_id in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    for job_id in range(2):
+        assert [output[0, 0].item() for output in results[job_id]] == [
+            2 * (job_id * 10 + i) for i in range(4)
+        ]
+    assert sum(recorder.batch_sizes) == 8
+    assert max(recorder.batch_sizes) == 4
+    assert scheduler.stats()['segments'] == 8
+
+
+def test_partial_batch_runs_after_max_wait():
+    recorder = RecordingModel()
+    scheduler = BatchScheduler(recorder, max_batch_size=8, max_wait=0.01)
+
+    output = scheduler.submit("htdemucs", None, torch.ones(2, 8)).result(timeout=5)
+
+    assert torch.equal(output, torch.full((2, 8), 2.0))
+    assert recorder.batch_sizes == [1]
+
+
+def test_models_are_never_mixed_in_a_batch():
+    batches = []
+
+    def run_batch(model, batch):
+        batches.append(model)
+        return batch
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=2, max_wait=0.05)
+    futures = [
+        scheduler.submit("htdemucs", "htdemucs", torch.ones(2, 8)),
+        scheduler.submit("htdemucs_ft", "htdemucs_ft", torch.ones(2, 8)),
+        scheduler.submit("htdemucs", "htdemucs", torch.ones(2, 8)),
+    ]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert sorted(batches) == ["htdemucs", "htdemucs_ft"]
+
+
+def test_batch_failure_reaches_every_job():
+    def run_batch(model, batch):
+        raise RuntimeError("out of memory")
+
+    scheduler = BatchScheduler(run_batch, max_batch_size=2, max_wait=0.01)
+    future = scheduler.submit("htdemucs", None, torch.ones(2, 8))
+
+    with pytest.raises(RuntimeError, match="out of memory"):
+        future.result(timeout=5)
+
+
+def test_batched_separation_matches_direct(stub_model):
+    model = stub_model.return_value
+    wav = torch.randn(2, int(model.samplerate * 3.3))
+    scheduler = BatchScheduler(lambda model, batch: model(batch), max_batch_size=3, max_wait=0.01)
+
+    direct = separate_tensor(model, wav, run_segments)
+    batched = separate_tensor(
+        model, wav, lambda model, segments: scheduler.run("stub", model, segments)
+    )
+
+    assert torch.allclose(direct, batched, atol=1e-5)
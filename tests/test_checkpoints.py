@@ -0,0 +1,216 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils import separation_engine
+from utils.checkpoints import CheckpointStore, create_checkpoint_store
+from utils.job_queue import JobQueue, SQLiteJobStore
+from utils.separation_engine import (load_track, run_segments, separate_chunks, separate_file,
+                                     separate_file_streaming, separate_tensor)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CheckpointStore(tmp_path / "checkpoints")
+
+
+def dying_runner(after):
+    """Segment runner that kills the job once `after` outputs came out."""
+    outputs = [0]
+
+    def run(model, segments):
+        for output in run_segments(model, segments):
+            if outputs[0] == after:
+                raise RuntimeError("worker killed")
+            outputs[0] += 1
+            yield output
+    return run
+
+
+def saved_chunks(store):
+    return [path for path in store.root.glob('*/*.npy') if '.' not in path.stem]
+
+
+def separate(streaming, track, output_dir, **options):
+    if streaming:
+        return separate_file_streaming(track, output_dir, "4", window_seconds=3, output_format='wav', **options)
+    return separate_file(track, output_dir, "4", output_format='wav', **options)
+
+
+@pytest.mark.parametrize('streaming, chunks, resumed', [
+    # A chunk per segment, finished up to where the next one starts
+    (False, 5, 5 * 0.75),
+    # A chunk per 3 s window, less the segment crossfaded into the next one
+    (True, 1, 2.0)
+])
+def test_killed_job_resumes_to_the_same_stems(stub_model, make_track, store, tmp_path, streaming, chunks, resumed):
+    track = make_track(seconds=10.0)
+    clean, _ = separate(streaming, track, tmp_path / "clean")
+
+    with patch.object(separation_engine, 'segment_runner', return_value=dying_runner(after=5)):
+        with pytest.raises(RuntimeError, match="worker killed"):
+            separate(streaming, track, tmp_path / "killed", checkpoints=store, audio_hash="abc")
+    assert len(saved_chunks(store)) == chunks
+
+    resumed_stems, timings = separate(streaming, track, tmp_path / "resumed", checkpoints=store, audio_hash="abc")
+
+    assert timings['resumed_duration'] == pytest.approx(resumed)
+    for stem, path in clean.items():
+        assert np.array_equal(sf.read(resumed_stems[stem])[0], sf.read(path)[0])
+    assert list(store.root.iterdir()) == []
+
+
+@pytest.mark.parametrize('start', [0, 1000, 33075, 50000, 200000])
+def test_chunks_from_any_sample_match_the_whole_separation(stub_model, make_track, start):
+    model = stub_model.return_value
+    wav = load_track(make_track(seconds=5.0), model.samplerate, model.audio_channels)
+
+    chunks = torch.cat(list(separate_chunks(model, wav, run_segments, start=start)), dim=-1)
+
+    assert torch.equal(chunks, separate_tensor(model, wav, run_segments)[..., start:])
+
+
+def test_checkpoints_keep_only_the_stems_of_the_mode(stub_model, make_track, store, tmp_path):
+    track = make_track(seconds=4.0)
+    with patch.object(separation_engine, 'segment_runner', return_value=dying_runner(after=3)):
+        with pytest.raises(RuntimeError):
+            separate_file(track, tmp_path / "killed", "2", checkpoints=store, audio_hash="abc")
+
+    chunks = [np.load(path) for path in saved_chunks(store)]
+    # Vocals and the rest, stereo float32: 42 MB per minute at 44.1 kHz
+    assert {chunk.shape[:2] for chunk in chunks} == {(2, 2)}
+    assert sum(chunk.nbytes for chunk in chunks) == 2 * 2 * 4 * sum(chunk.shape[-1] for chunk in chunks)
+
+
+def test_checkpoints_are_per_audio_and_model(stub_model, make_track, store, tmp_path):
+    track = make_track(seconds=4.0)
+    with patch.object(separation_engine, 'segment_runner', return_value=dying_runner(after=2)):
+        with pytest.raises(RuntimeError):
+            separate_file(track, tmp_path / "killed", checkpoints=store, audio_hash="abc")
+
+    _, timings = separate_file(track, tmp_path / "other", checkpoints=store, audio_hash="def")
+
+    assert timings['resumed_duration'] == 0
+    assert [path.name.split('-')[0] for path in store.root.iterdir()] == ["abc"]
+
+
+def test_concurrent_jobs_on_the_same_audio_keep_their_own_chunks(stub_model, make_track, store, tmp_path):
+    track = make_track(seconds=4.0)
+    held = store.open(store.key("abc", "htdemucs", "full4"))
+    held.save(torch.zeros(4, 2, 10))
+
+    # A second job on the same audio runs without a checkpoint rather than sharing one
+    _, timings = separate_file(track, tmp_path / "other", "4", checkpoints=store, audio_hash="abc")
+    assert 'resumed_duration' not in timings
+    store.prune(older_than=-1)
+    assert len(saved_chunks(store)) == 1
+
+    held.close()
+    assert store.prune(older_than=-1) == 1
+
+
+def test_checkpoints_are_opt_in(monkeypatch):
+    monkeypatch.delenv('SEPARATION_CHECKPOINTS', raising=False)
+    assert create_checkpoint_store() is None
+    monkeypatch.setenv('SEPARATION_CHECKPOINTS', '1')
+    assert isinstance(create_checkpoint_store(), CheckpointStore)
+
+
+def test_stale_checkpoints_are_pruned(store):
+    old, new = store.root / "old", store.root / "new"
+    old.mkdir(parents=True)
+    new.mkdir()
+    os.utime(old, (time.time() - 7200, time.time() - 7200))
+
+    assert store.prune(older_than=3600) == 1
+    assert [path.name for path in store.root.iterdir()] == ["new"]
+
+
+def test_retried_job_resumes_from_its_checkpoint(s3, stub_model, make_track, store):
+    def prepare_audio_file(url, scratch=None):
+        return make_track(seconds=4.0), "song.wav", None
+
+    with patch.object(separate_routes, 'checkpoint_store', store), \
+            patch.object(separate_routes, 'result_cache', None), \
+            patch.object(separate_routes, 'prepare_audio_file', side_effect=prepare_audio_file):
+        with patch.object(separation_engine, 'segment_runner', return_value=dying_runner(after=3)):
+            with pytest.raises(RuntimeError, match="worker killed"):
+                separate_routes.process_separation_job({'link': 'https://example.com/song.wav', 'mode': '2'},
+                                                       MagicMock())
+        result = separate_routes.process_separation_job({'link': 'https://example.com/song.wav', 'mode': '2'},
+                                                        MagicMock())
+
+    assert result['timings']['resumed_duration'] == pytest.approx(3 * 0.75)
+    assert sorted(result['downloads']) == ['instrumental', 'vocals']
+    assert list(store.root.iterdir()) == []
+
+
+WORKER = """
+import sys, time
+sys.path[:0] = [sys.argv[1], sys.argv[1] + '/tests']
+from unittest.mock import patch
+from conftest import StubModel
+from utils import separation_engine
+from utils.checkpoints import CheckpointStore, create_checkpoint_store
+from utils.job_queue import JobQueue, SQLiteJobStore
+from utils.separation_engine import run_segments, separate_file
+
+def slow_runner(model, segments):
+    for output in run_segments(model, segments):
+        time.sleep(0.2)
+        yield output
+
+def separate(params, report):
+    return separate_file(params['track'], params['output_dir'], output_format='wav',
+                         checkpoints=CheckpointStore(params['checkpoints']), audio_hash='abc')[1]
+
+with patch.object(separation_engine, 'get_model', return_value=StubModel()), \\
+        patch.object(separation_engine, 'segment_runner', return_value=slow_runner):
+    queue = JobQueue(separate, SQLiteJobStore(sys.argv[2]), poll_interval=0.01, stale_after=0.5)
+    print(queue.submit(dict(zip(['track', 'output_dir', 'checkpoints'], sys.argv[3:]))), flush=True)
+    time.sleep(60)
+"""
+
+
+def test_job_of_a_killed_worker_is_queued_again_and_resumes(stub_model, make_track, store, tmp_path):
+    track = make_track(seconds=10.0)
+    path = tmp_path / "jobs.db"
+    worker = subprocess.Popen(
+        [sys.executable, '-c', WORKER, str(Path(__file__).parent.parent), str(path), str(track),
+         str(tmp_path / "killed"), str(store.root)],
+        stdout=subprocess.PIPE, text=True
+    )
+    job_id = worker.stdout.readline().strip()
+    deadline = time.time() + 30
+    while len(saved_chunks(store)) < 3 and time.time() < deadline:
+        time.sleep(0.05)
+    os.kill(worker.pid, signal.SIGKILL)
+    worker.wait()
+
+    def separate(params, report):
+        return separate_file(params['track'], tmp_path / "resumed", output_format='wav', checkpoints=store,
+                             audio_hash='abc')[1]
+
+    queue = JobQueue(separate, SQLiteJobStore(path), poll_interval=0.01, stale_after=0.5)
+    queue.start()
+    deadline = time.time() + 30
+    while queue.status(job_id)['status'] not in ('done', 'failed') and time.time() < deadline:
+        time.sleep(0.05)
+
+    job = queue.status(job_id)
+    assert (job['status'], job['attempts']) == ('done', 2)
+    assert job['resumed_duration'] >= 3 * 0.75
+    clean, _ = separate_file(track, tmp_path / "clean", output_format='wav')
+    for stem, stem_path in clean.items():
+        assert np.array_equal(sf.read(tmp_path / "resumed" / Path(stem_path).name)[0], sf.read(stem_path)[0])
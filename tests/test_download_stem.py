@@ -0,0 +1,213 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+from flask import Flask
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import download_stem_routes as routes
+from utils.s3_client import get_s3_client, reset_s3_client
+
+BUCKET = 'test-bucket'
+KEY = 'stems/abc/song_vocals.mp3'
+URL = f"/api/download_stem/https://{BUCKET}.s3.us-east-1.amazonaws.com/{KEY}"
+
+
+def make_client():
+    app = Flask(__name__)
+    app.register_blueprint(routes.download_stem_routes, url_prefix="/api/download_stem")
+    return app.test_client()
+
+
+@pytest.fixture
+def stem(s3):
+    body = bytes(range(256)) * 4096
+    s3.put_object(Bucket=BUCKET, Key=KEY, Body=body, ContentType='audio/mpeg')
+    return body
+
+
+def test_download_whole_stem(stem):
+    response = make_client().get(URL)
+
+    assert response.status_code == 200
+    assert response.data == stem
+    assert response.headers['Content-Type'] == 'audio/mpeg'
+    assert response.headers['Content-Length'] == str(len(stem))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'filename="song_vocals.mp3"' in response.headers['Content-Disposition']
+
+
+def test_download_range(stem):
+    response = make_client().get(URL, headers={'Range': 'bytes=1000-1999'})
+
+    assert response.status_code == 206
+    assert response.data == stem[1000:2000]
+    assert response.headers['Content-Length'] == '1000'
+    assert response.headers['Content-Range'] == f"bytes 1000-1999/{len(stem)}"
+
+
+def test_download_suffix_range(stem):
+    response = make_client().get(URL, headers={'Range': 'bytes=-500'})
+
+    assert response.status_code == 206
+    assert response.data == stem[-500:]
+
+
+def test_unsatisfiable_range(stem):
+    response = make_client().get(URL, headers={'Range': f'bytes={len(stem) + 10}-'})
+
+    assert response.status_code == 416
+
+
+def test_missing_stem(s3):
+    response = make_client().get(URL)
+
+    assert response.status_code == 404
+    assert 'error' in response.get_json()
+
+
+def test_content_type_guessed_when_not_stored(s3):
+    s3.put_object(Bucket=BUCKET, Key='stems/abc/song.flac', Body=b'fLaC')
+    url = f"/api/download_stem/https://{BUCKET}.s3.us-east-1.amazonaws.com/stems/abc/song.flac"
+
+    response = make_client().get(url)
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] in ('audio/flac', 'audio/x-flac', 'binary/octet-stream')
+
+
+def test_no_list_objects_probe(stem):
+    client = MagicMock(wraps=get_s3_client())
+    with patch.object(routes, 'get_s3_client', return_value=client):
+        response = make_client().get(URL)
+        response.get_data()
+
+    client.list_objects_v2.assert_not_called()
+    client.get_object.assert_called_once()
+
+
+class _RandomFile:
+    """A file-like object of `size` bytes that never holds them all in memory."""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, n=-1):
+        n = self.remaining if n is None or n < 0 else min(n, self.remaining)
+        self.remaining -= n
+        return os.urandom(n)
+
+
+def test_redirect_mode_sends_client_to_storage(stem):
+    client = MagicMock(wraps=get_s3_client())
+    with patch('utils.s3_client.get_s3_client', return_value=client), \
+            patch.object(routes, 'get_s3_client', return_value=client):
+        response = make_client().get(URL + "?mode=redirect")
+
+    assert response.status_code == 302
+    location = response.headers['Location']
+    assert 'X-Amz-Signature=' in location
+    assert 'song_vocals.mp3' in location
+    client.get_object.assert_not_called()
+    assert requests.get(location).content == stem
+
+
+def test_url_mode_returns_presigned_link(stem, monkeypatch):
+    monkeypatch.setattr(routes, 'DOWNLOAD_MODE', 'url')
+    monkeypatch.setattr(routes, 'PRESIGN_EXPIRY', 120)
+
+    response = make_client().get(URL)
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['filename'] == 'song_vocals.mp3'
+    assert body['expires_in'] == 120
+    assert requests.get(body['url']).content == stem
+
+
+@pytest.mark.parametrize('mode', ['stream', 'redirect', 'url'])
+@pytest.mark.parametrize('url', [
+    f"https://other-bucket.s3.us-east-1.amazonaws.com/{KEY}",
+    f"https://{BUCKET}.s3.us-east-1.amazonaws.com/private/keys.json",
+    f"https://{BUCKET}.s3.us-east-1.amazonaws.com/stems/../private/keys.json",
+])
+def test_only_stems_of_the_service_are_served(s3, url, mode):
+    s3.put_object(Bucket=BUCKET, Key='private/keys.json', Body=b'secret')
+
+    response = make_client().get(f"/api/download_stem/{url}?mode={mode}")
+
+    assert response.status_code == 403
+    assert b'secret' not in response.data
+
+
+def test_unknown_mode(stem):
+    assert make_client().get(URL + "?mode=ftp").status_code == 400
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def moto_server(monkeypatch):
+    """A moto S3 server in its own process, so its memory is not traced here."""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'moto.server', '-p', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    endpoint = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while True:
+        try:
+            requests.get(endpoint, timeout=1)
+            break
+        except requests.ConnectionError:
+            if time.time() > deadline:
+                process.kill()
+                pytest.skip("moto server did not start")
+            time.sleep(0.2)
+
+    monkeypatch.setenv('AWS_ENDPOINT_URL', endpoint)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_BUCKET_NAME', BUCKET)
+    reset_s3_client()
+    get_s3_client().create_bucket(Bucket=BUCKET)
+    yield get_s3_client()
+    reset_s3_client()
+    process.terminate()
+    process.wait()
+
+
+def test_large_stem_streams_in_constant_memory(moto_server):
+    size = 64 * 1024 * 1024
+    moto_server.upload_fileobj(
+        _RandomFile(size), BUCKET, KEY, ExtraArgs={'ContentType': 'audio/mpeg'}
+    )
+
+    tracemalloc.start()
+    try:
+        response = make_client().get(URL, buffered=False)
+        received = 0
+        for chunk in response.response:
+            received += len(chunk)
+        response.close()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert received == size
+    assert response.headers['Content-Length'] == str(size)
+    assert peak < 8 * 1024 * 1024
+
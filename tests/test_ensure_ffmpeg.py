@@ -5,7 +5,8 @@ from pathlib import Path
 from flask import Flask
 
 sys.path.append(str(Path(__file__).parent.parent))
-from server.api.separate_routes import ensure_ffmpeg
+from server.api.separate_routes import ensure_ffmpeg, needs_ffmpeg
+from utils import install_ffmpeg as install_ffmpeg_module
 
 
 @patch('server.api.separate_routes.check_ffmpeg')
@@ -49,6 +50,39 @@ def test_ffmpeg_installation_fails(mock_install_ffmpeg, mock_check_ffmpeg):
         mock_check_ffmpeg.assert_called_once()
         mock_install_ffmpeg.assert_called_once()
 
+@patch('server.api.separate_routes.check_ffmpeg')
+@patch('server.api.separate_routes.install_ffmpeg')
+def test_ffmpeg_not_installed_for_audio_decoded_in_process(mock_install_ffmpeg, mock_check_ffmpeg):
+    mock_check_ffmpeg.return_value = False
+
+    assert ensure_ffmpeg(needs_ffmpeg("https://example.com/song.mp3?x=1")) is True
+    assert needs_ffmpeg("song.m4a") and needs_ffmpeg("https://example.com/a/song.webm")
+    mock_install_ffmpeg.assert_not_called()
+
+@patch('server.api.separate_routes.check_ffmpeg')
+@patch('server.api.separate_routes.install_ffmpeg')
+def test_unavailable_ffmpeg_refuses_the_request(mock_install_ffmpeg, mock_check_ffmpeg):
+    mock_check_ffmpeg.return_value = False
+    mock_install_ffmpeg.return_value = False
+
+    app = Flask(__name__)
+    with app.app_context():
+        result = ensure_ffmpeg()
+
+    assert result[1] == 503
+
+@patch('utils.install_ffmpeg.check_ffmpeg', return_value=False)
+def test_failed_install_is_not_retried_right_away(mock_check_ffmpeg):
+    with patch.object(install_ffmpeg_module, '_install', return_value=False) as install, \
+            patch.object(install_ffmpeg_module, '_install_failed_at', None):
+        assert install_ffmpeg_module.install_ffmpeg() is False
+        assert install_ffmpeg_module.install_ffmpeg() is False
+        install.assert_called_once()
+
+        with patch.object(install_ffmpeg_module, 'INSTALL_RETRY_INTERVAL', 0):
+            install_ffmpeg_module.install_ffmpeg()
+        assert install.call_count == 2
+
 if __name__ == '__main__':
     import pytest
     pytest.main([__file__])
\ No newline at end of file
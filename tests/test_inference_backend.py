@@ -0,0 +1,90 @@
+import math
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.inference_backend import TracedModel, build_model, model_variant, parse_backend
+from utils.separation_engine import run_segments, separate_tensor
+
+
+def tiny_htdemucs(name):
+    from demucs.htdemucs import HTDemucs
+    torch.manual_seed(0)
+    return HTDemucs(sources=['drums', 'bass', 'other', 'vocals'], channels=16, depth=4,
+                    t_layers=2, t_layer_scale=False, segment=4).eval()
+
+
+def fixed_clip(seconds=8, samplerate=44100):
+    """A fixed stereo clip: a chord, a bass line and noise bursts for drums."""
+    generator = torch.Generator().manual_seed(1)
+    t = torch.arange(int(seconds * samplerate)) / samplerate
+    chord = sum(0.1 * torch.sin(2 * math.pi * f * t) for f in (261.6, 329.6, 392.0))
+    bass = 0.2 * torch.sin(2 * math.pi * 55 * t) * (1 + torch.sin(2 * math.pi * 0.5 * t)) / 2
+    hits = (torch.remainder(t, 0.5) < 0.05).float()
+    drums = 0.3 * hits * torch.randn(len(t), generator=generator)
+    return torch.stack([chord + bass + drums, 0.8 * chord + bass + drums])
+
+
+def sdr(reference, estimate):
+    """Signal to distortion ratio in dB of `estimate` against `reference`."""
+    return 10 * torch.log10(reference.pow(2).sum() / (reference - estimate).pow(2).sum()).item()
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return separate_tensor(tiny_htdemucs('tiny'), fixed_clip(), run_segments)
+
+
+def test_parse_backend():
+    assert parse_backend('eager') == set()
+    assert parse_backend('INT8+torchscript') == {'int8', 'torchscript'}
+    with pytest.raises(ValueError):
+        parse_backend('onnx')
+    with pytest.raises(ValueError):
+        parse_backend('torchscript+compile')
+
+
+def test_backends_have_their_own_cache_keys():
+    assert model_variant('htdemucs', 'eager') == 'htdemucs'
+    assert model_variant('htdemucs', 'torchscript+int8') == 'htdemucs+int8+torchscript'
+
+
+@pytest.mark.parametrize('backend, min_sdr', [
+    ('int8', 25.0),
+    ('torchscript', 60.0),
+    ('int8+torchscript', 25.0),
+])
+def test_quality_against_the_float_model(backend, min_sdr, reference, tmp_path):
+    model = build_model('tiny', tiny_htdemucs, backend, tmp_path)
+
+    separated = separate_tensor(model, fixed_clip(), run_segments)
+
+    quality = sdr(reference, separated)
+    print(f"{backend}: SDR {quality:.1f} dB against the float model")
+    assert quality > min_sdr
+
+
+def test_quantized_model_is_loaded_from_disk(tmp_path):
+    build_model('tiny', tiny_htdemucs, 'int8', tmp_path)
+
+    with patch(f'{__name__}.tiny_htdemucs') as loader:
+        model = build_model('tiny', loader, 'int8', tmp_path)
+
+    loader.assert_not_called()
+    assert isinstance(model.crosstransformer.layers[0].linear1,
+                      torch.ao.nn.quantized.dynamic.Linear)
+
+
+def test_trace_is_loaded_from_disk(tmp_path):
+    build_model('tiny', tiny_htdemucs, 'torchscript', tmp_path)
+
+    with patch('torch.jit.trace') as trace:
+        model = build_model('tiny', tiny_htdemucs, 'torchscript', tmp_path)
+
+    trace.assert_not_called()
+    assert isinstance(model, TracedModel)
+    assert model.valid_length(1000) == 4 * 44100
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils import separation_engine
+from utils.inference_pool import (
+    InferencePool, InferenceWorkerError, ModelInfo, claim_slot, parse_affinity, threads_per_process, worker_cpus
+)
+from utils.separation_engine import run_model, run_segments, separate_tensor
+
+
+def stub_loader(name):
+    # Runs in the pool processes, which import this module afresh
+    from conftest import StubModel
+    if name != 'stub':
+        raise KeyError(name)
+    return StubModel().eval()
+
+
+def slow_runner(model, segments):
+    time.sleep(0.5)
+    return run_model(model, segments)
+
+
+def shared_blocks():
+    return {entry for entry in os.listdir('/dev/shm') if entry.startswith('psm_')}
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = InferencePool(stub_loader, run_model, processes=2, threads=1)
+    yield pool
+    pool.close()
+
+
+def test_parse_affinity():
+    assert parse_affinity('', 2) is None
+    assert parse_affinity('auto', 2, cpus=[0, 1, 2, 3, 4]) == [{0, 1, 2}, {3, 4}]
+    assert parse_affinity('auto', 3, cpus=[0, 1]) == [{0}, {1}, {0}]
+    assert parse_affinity('0-3;4,6', 3) == [{0, 1, 2, 3}, {4, 6}, {0, 1, 2, 3}]
+
+
+def test_threads_per_process():
+    assert threads_per_process(2, threads=3) == 3
+    assert threads_per_process(2, affinity=[{0, 1, 2}, {3, 4}], threads=0) == 2
+    assert threads_per_process(64, threads=0) == 1
+
+
+def test_web_workers_get_their_own_cpus(tmp_path):
+    slots = [claim_slot(2, tmp_path) for _ in range(2)]
+    cpus = [worker_cpus(slot, 2, cpus=list(range(8))) for slot in slots]
+
+    assert slots == [0, 1]
+    assert cpus == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    # The pools of both workers pin to, and thread over, their own share only
+    assert [parse_affinity('auto', 2, share) for share in cpus] == [[{0, 1}, {2, 3}], [{4, 5}, {6, 7}]]
+    assert parse_affinity('0;1;2;3', 2, offset=slots[1] * 2) == [{2}, {3}]
+    assert threads_per_process(2, threads=0, cpus=cpus[1]) == 2
+
+
+def test_model_info_comes_from_the_pool(pool):
+    info = pool.model_info('stub')
+
+    assert info.sources == ['drums', 'bass', 'other', 'vocals']
+    assert (info.samplerate, info.audio_channels, info.segment) == (44100, 2, 1.0)
+
+
+def test_pool_separation_matches_in_process(pool, stub_model):
+    before = shared_blocks()
+    model, _ = separation_engine.load_model('stub')
+    wav = torch.randn(2, 44100 * 3)
+
+    expected = separate_tensor(model, wav, run_segments)
+    info = pool.model_info('stub')
+    separated = separate_tensor(info, wav, lambda model, segments: pool.run('stub', model, segments))
+
+    assert torch.allclose(separated, expected, atol=1e-5)
+    # Every shared memory block was handed back
+    assert shared_blocks() <= before
+
+
+def test_engine_routes_segments_through_the_pool(pool, monkeypatch):
+    monkeypatch.setattr(separation_engine, '_inference_pool', pool)
+    separation_engine.unload_models()
+
+    model, _ = separation_engine.load_model('stub')
+    runner = separation_engine.segment_runner('stub')
+    wav = torch.randn(2, 44100)
+    separated = separate_tensor(model, wav, runner)
+
+    separation_engine.unload_models()
+    assert isinstance(model, ModelInfo)
+    mean = wav.mean()
+    assert torch.allclose(separated[3], 0.4 * (wav - mean) + mean, atol=1e-4)
+
+
+def test_worker_errors_reach_the_job(pool):
+    with pytest.raises(InferenceWorkerError, match='KeyError'):
+        pool.model_info('missing')
+
+
+def test_dead_process_is_replaced():
+    pool = InferencePool(stub_loader, slow_runner, processes=1, threads=1)
+    try:
+        info = pool.model_info('stub')
+        future = pool.submit('stub', info, torch.zeros(1, 2, 44100))
+        time.sleep(0.2)
+        pool._workers[0].kill()
+
+        with pytest.raises(InferenceWorkerError, match='exited'):
+            future.result(timeout=10)
+        outputs = pool.submit('stub', info, torch.ones(1, 2, 44100)).result(timeout=30)
+        assert outputs.shape == (1, 4, 2, 44100)
+    finally:
+        pool.close()
+
+
+def test_dead_process_is_noticed_while_results_keep_coming():
+    pool = InferencePool(stub_loader, slow_runner, processes=2, threads=1)
+    try:
+        info = pool.model_info('stub')
+        pool.submit('stub', info, torch.zeros(1, 2, 4410)).result(timeout=30)
+        futures = [pool.submit('stub', info, torch.zeros(1, 2, 4410)) for _ in range(20)]
+        time.sleep(0.2)
+        killed = time.perf_counter()
+        pool._workers[0].kill()
+
+        failed = next(future for future in futures if future.exception(timeout=30) is not None)
+
+        # Well before the other process drains its half of the queue
+        assert time.perf_counter() - killed < 3
+        assert isinstance(failed.exception(), InferenceWorkerError)
+        outcomes = [future.exception(timeout=30) is None for future in futures]
+        assert outcomes.count(True) >= 10 and outcomes.count(False) >= 9
+    finally:
+        pool.close()
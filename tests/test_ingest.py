@@ -0,0 +1,187 @@
+import hashlib
+import io
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils import scratch
+from utils.ingest import Download, DownloadTooLarge, get_http_session
+from utils.result_cache import ResultCache
+from utils.separation_engine import track_windows
+
+
+class AudioHandler(BaseHTTPRequestHandler):
+    """Serves `server.body`, optionally slowly, without ranges or breaking off once."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body, status = server.body, 200
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and server.ranges:
+            start = int(range_header.split('=')[1].rstrip('-'))
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'audio/wav')
+        if server.send_length:
+            self.send_header('Content-Length', str(len(body) - start))
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+
+        drop_at = server.drop_at if len(server.requests) == 1 else None
+        for offset in range(start, len(body), server.chunk_size):
+            if drop_at is not None and offset >= drop_at:
+                return
+            try:
+                self.wfile.write(body[offset:offset + server.chunk_size])
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            server.bytes_sent += min(server.chunk_size, len(body) - offset)
+            time.sleep(server.delay)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), AudioHandler)
+    server.body = b''
+    server.requests = []
+    server.bytes_sent = 0
+    server.ranges = True
+    server.send_length = True
+    server.drop_at = None
+    server.chunk_size = 64 * 1024
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/song.wav"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wav_bytes(seconds, samplerate=44100):
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    tone = 0.3 * np.sin(2 * np.pi * 220 * t)
+    buffer = io.BytesIO()
+    sf.write(buffer, np.stack([tone, tone], axis=1).astype('float32'), samplerate,
+             format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def test_download_reuses_session(http_server, tmp_path):
+    http_server.body = b"x" * 300_000
+
+    download = Download(http_server.url, tmp_path / "song.wav").start()
+    download.wait()
+
+    assert (tmp_path / "song.wav").read_bytes() == http_server.body
+    assert download.sha256() == hashlib.sha256(http_server.body).hexdigest()
+    assert download.session is get_http_session()
+
+
+def test_refuses_oversized_source_from_content_length(http_server, tmp_path):
+    http_server.body = b"x" * 1_000_000
+    http_server.delay = 0.01
+
+    download = Download(http_server.url, tmp_path / "song.wav", max_bytes=100_000).start()
+
+    with pytest.raises(DownloadTooLarge):
+        download.wait()
+    assert download.bytes_written == 0
+
+
+def test_refuses_oversized_source_without_content_length(http_server, tmp_path):
+    http_server.body = b"x" * 1_000_000
+    http_server.send_length = False
+
+    download = Download(http_server.url, tmp_path / "song.wav", max_bytes=100_000).start()
+
+    with pytest.raises(DownloadTooLarge):
+        download.wait()
+    assert download.bytes_written <= 100_000
+
+
+def test_resumes_with_range_request(http_server, tmp_path):
+    http_server.body = bytes(range(256)) * 2000
+    http_server.drop_at = 200_000
+
+    download = Download(http_server.url, tmp_path / "song.wav").start()
+    download.wait()
+
+    assert (tmp_path / "song.wav").read_bytes() == http_server.body
+    assert download.resumes == 1
+    assert 'Range' not in http_server.requests[0]
+    resumed_at = int(http_server.requests[1]['Range'][len('bytes='):-1])
+    assert 0 < resumed_at < len(http_server.body)
+
+
+def test_resumes_from_servers_without_ranges(http_server, tmp_path):
+    http_server.body = bytes(range(256)) * 2000
+    http_server.drop_at = 200_000
+    http_server.ranges = False
+
+    download = Download(http_server.url, tmp_path / "song.wav").start()
+    download.wait()
+
+    assert (tmp_path / "song.wav").read_bytes() == http_server.body
+    assert download.sha256() == hashlib.sha256(http_server.body).hexdigest()
+
+
+def test_decoding_starts_before_download_ends(http_server, tmp_path):
+    # 10 s of audio trickling in over about two seconds
+    http_server.body = wav_bytes(10)
+    http_server.chunk_size = len(http_server.body) // 40
+    http_server.delay = 0.05
+
+    start = time.perf_counter()
+    download = Download(http_server.url, tmp_path / "progressive.wav").start()
+    reader = download.reader()
+    windows = track_windows(reader, 44100, 2, window=44100, overlap=4410)
+    first = next(windows)
+    first_frame_time = time.perf_counter() - start
+    rest = list(windows)
+    reader.close()
+
+    start = time.perf_counter()
+    Download(http_server.url, tmp_path / "whole.wav").start().wait()
+    full_download_time = time.perf_counter() - start
+
+    print(f"time to first decoded frame: {first_frame_time:.2f}s while streaming, "
+          f"{full_download_time:.2f}s after a full download")
+    assert first.shape == (2, 44100)
+    assert sum(w.shape[-1] for w in [first] + rest) >= 10 * 44100
+    assert first_frame_time < full_download_time / 2
+
+
+def test_streaming_job_separates_while_downloading(http_server, s3, stub_model, tmp_path, monkeypatch):
+    http_server.body = wav_bytes(4)
+    monkeypatch.setattr(scratch, 'SCRATCH_DIR', str(tmp_path))
+    cache = ResultCache(tmp_path / "cache.db")
+
+    with patch.object(separate_routes, 'result_cache', cache), \
+            patch.object(separate_routes, 'prepare_audio_file') as mock_prepare:
+        result = separate_routes.process_separation_job(
+            {'link': http_server.url, 'mode': '2', 'streaming': True}, MagicMock()
+        )
+
+    mock_prepare.assert_not_called()
+    assert set(result['downloads']) == {'vocals', 'instrumental'}
+    assert 'first_bytes_time' in result['timings']
+    audio_hash = hashlib.sha256(http_server.body).hexdigest()
+    assert cache.get(ResultCache.key(audio_hash, 'htdemucs', '2'))['downloads'] == result['downloads']
+    assert list(tmp_path.glob('stem-splitter-*')) == []
@@ -0,0 +1,243 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.job_queue import JobQueue, MemoryJobStore, QueueFullError, SQLiteJobStore
+
+
+def wait_for(queue, job_id, status, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.status(job_id)
+        if job['status'] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} never reached {status}: {job}")
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryJobStore()
+    return SQLiteJobStore(tmp_path / "jobs.db")
+
+
+def test_job_runs_and_reports_result(store):
+    def handler(params, report):
+        report("separating", 0.5, timings={"inference_time": 1.0})
+        return {"downloads": {"vocals": params['link']}}
+
+    queue = JobQueue(handler, store, poll_interval=0.01)
+    job_id = queue.submit({'link': 'https://example.com/a.mp3', 'mode': '2'})
+
+    job = wait_for(queue, job_id, 'done')
+    assert job['progress'] == 1.0
+    assert job['timings'] == {"inference_time": 1.0}
+    assert job['downloads'] == {"vocals": 'https://example.com/a.mp3'}
+
+
+def test_failed_job_keeps_error(store):
+    def handler(params, report):
+        raise RuntimeError("Separation failed: boom")
+
+    queue = JobQueue(handler, store, poll_interval=0.01)
+    job_id = queue.submit({'link': 'x', 'mode': '2'})
+
+    job = wait_for(queue, job_id, 'failed')
+    assert job['error'] == "Separation failed: boom"
+
+
+def test_queue_full_raises(store):
+    release = threading.Event()
+
+    def handler(params, report):
+        release.wait(5)
+        return {}
+
+    queue = JobQueue(handler, store, workers=1, max_depth=2, retry_after=7, poll_interval=0.01)
+    running = queue.submit({})
+    wait_for(queue, running, 'running')
+    queue.submit({})
+    queue.submit({})
+
+    with pytest.raises(QueueFullError) as excinfo:
+        queue.submit({})
+    assert excinfo.value.retry_after == 7
+    release.set()
+
+
+def test_unknown_job_status_is_none(store):
+    queue = JobQueue(lambda params, report: {}, store)
+    assert queue.status("missing") is None
+
+
+def test_sqlite_jobs_survive_a_new_store(tmp_path):
+    first = SQLiteJobStore(tmp_path / "jobs.db")
+    job = first.add({'link': 'x'}, max_depth=8)
+
+    second = SQLiteJobStore(tmp_path / "jobs.db")
+    assert second.get(job['id'])['params'] == {'link': 'x'}
+    assert second.claim()['id'] == job['id']
+
+
+class TestSeparateRoutes:
+
+    @pytest.fixture(autouse=True)
+    def client(self):
+        from server import app
+        from server.api.separate_routes import separation_queue
+        self.queue = separation_queue
+        with patch.object(separation_queue, 'store', MemoryJobStore()), \
+                patch('server.api.separate_routes.ensure_ffmpeg', return_value=True), \
+                patch('server.api.separate_routes.estimate_cost', return_value=None):
+            with app.test_client() as client:
+                self.client = client
+                yield
+
+    def test_post_returns_job_id(self):
+        with patch.object(self.queue, 'handler', return_value={"downloads": {}}):
+            response = self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3'})
+
+            assert response.status_code == 202
+            job_id = response.json["job_id"]
+            assert response.headers["Location"] == f"/api/separate/{job_id}"
+            wait_for(self.queue, job_id, 'done')
+
+            status = self.client.get(f"/api/separate/{job_id}")
+        assert status.status_code == 200
+        assert status.json["downloads"] == {}
+
+    def test_post_sets_priority_and_client(self):
+        # Keep the jobs queued
+        with patch.object(self.queue.store, 'claim', return_value=None):
+            preview = self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3'})
+            bulk = self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3', 'mode': '4'},
+                                    headers={'X-API-Key': 'secret'})
+
+            assert self.client.get(f"/api/separate/{preview.json['job_id']}").json["priority"] == 'interactive'
+            job = self.queue.store.get(bulk.json['job_id'])
+            assert job['priority'] == 'bulk'
+            assert job['client'].startswith('key:') and 'secret' not in job['client']
+            stats = self.client.get("/api/separate/queue").json
+        assert stats['interactive']['queued'] == 1
+        assert stats['bulk']['queued'] == 1
+
+    def test_post_without_link(self):
+        response = self.client.post("/api/separate", data={})
+        assert response.status_code == 400
+
+    def test_queue_full_returns_429(self):
+        with patch.object(self.queue, 'submit', side_effect=QueueFullError(8, 30)):
+            response = self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3'})
+
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "30"
+
+    def test_unknown_job_returns_404(self):
+        assert self.client.get("/api/separate/missing").status_code == 404
+
+    def test_job_handler_reports_stage_errors(self):
+        from server import app
+        from server.api.separate_routes import process_separation_job
+
+        with app.app_context():
+            with pytest.raises(RuntimeError) as excinfo:
+                process_separation_job({'link': None, 'mode': '2'}, lambda *args, **kwargs: None)
+        assert str(excinfo.value) == "No audio URL provided"
+
+
+def claim_and_die(store):
+    """Claim the next job the way a worker does, then never beat or finish it, as a killed worker would."""
+    return store.claim(lambda queued, service, now: queued[0], 3600)
+
+
+def test_init_app_starts_workers_for_jobs_already_queued(store):
+    job = store.add({'link': 'x'}, max_depth=8)
+    queue = JobQueue(lambda params, report: {'link': params['link']}, store, poll_interval=0.01)
+
+    queue.init_app(Flask(__name__))
+
+    assert wait_for(queue, job['id'], 'done')['link'] == 'x'
+
+
+def test_abandoned_job_is_queued_again_and_runs(store):
+    job = store.add({}, max_depth=8)
+    claim_and_die(store)
+    queue = JobQueue(lambda params, report: {}, store, poll_interval=0.01, stale_after=0.2)
+
+    queue.start()
+
+    done = wait_for(queue, job['id'], 'done')
+    assert done['attempts'] == 2
+
+
+def test_abandoned_job_fails_after_max_attempts(store):
+    job = store.add({}, max_depth=8)
+    claim_and_die(store)
+    queue = JobQueue(lambda params, report: {}, store, poll_interval=0.01, stale_after=0.2, max_attempts=1)
+
+    queue.start()
+
+    failed = wait_for(queue, job['id'], 'failed')
+    assert "abandoned by its worker" in failed['error']
+
+
+def test_long_running_job_keeps_its_lease(store):
+    runs = []
+
+    def handler(params, report):
+        runs.append(1)
+        time.sleep(1.0)
+        return {}
+
+    queue = JobQueue(handler, store, workers=2, poll_interval=0.01, stale_after=0.2)
+    job_id = queue.submit({})
+
+    assert wait_for(queue, job_id, 'done')['attempts'] == 1
+    assert len(runs) == 1
+
+
+def test_orphaned_running_job_is_pruned(store):
+    job = store.add({}, max_depth=8)
+    claim_and_die(store)
+
+    store.prune(time.time() + 1)
+
+    assert store.get(job['id']) is None
+
+
+WORKER = """
+import sys, time
+sys.path.append(sys.argv[2])
+from utils.job_queue import JobQueue, SQLiteJobStore
+queue = JobQueue(lambda params, report: time.sleep(60), SQLiteJobStore(sys.argv[1]), poll_interval=0.01, stale_after=0.4)
+print(queue.submit({}), flush=True)
+time.sleep(60)
+"""
+
+
+def test_job_of_a_killed_worker_process_is_run_by_another(tmp_path):
+    path = tmp_path / "jobs.db"
+    worker = subprocess.Popen([sys.executable, '-c', WORKER, str(path), str(Path(__file__).parent.parent)],
+                              stdout=subprocess.PIPE, text=True)
+    job_id = worker.stdout.readline().strip()
+    queue = JobQueue(lambda params, report: {'by': os.getpid()}, SQLiteJobStore(path), poll_interval=0.01,
+                     stale_after=0.4)
+    wait_for(queue, job_id, 'running')
+
+    os.kill(worker.pid, signal.SIGKILL)
+    worker.wait()
+    queue.start()
+
+    done = wait_for(queue, job_id, 'done')
+    assert done['by'] == os.getpid()
+    assert done['attempts'] == 2
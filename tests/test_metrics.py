@@ -0,0 +1,182 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils.job_queue import FAILED, JobQueue, MemoryJobStore
+from utils.metrics import Registry, jobs_total, realtime_factor, s3_bytes, stage_seconds
+from utils.tracing import start_trace
+
+JOB_STAGES = ['download', 'model_load', 'decode', 'inference', 'encode', 'upload', 'cleanup']
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.histogram('stage_seconds', 'Stage time', ['stage'], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, stage='encode')
+    registry.counter('bytes_total', 'Bytes').inc(5)
+    registry.gauge('depth', 'Depth', ['priority'], function=lambda: {('bulk',): 2})
+
+    lines = registry.render().splitlines()
+
+    assert 'stage_seconds_bucket{stage="encode",le="0.1"} 1.0' in lines
+    assert 'stage_seconds_bucket{stage="encode",le="1.0"} 3.0' in lines
+    assert 'stage_seconds_bucket{stage="encode",le="+Inf"} 4.0' in lines
+    assert 'stage_seconds_count{stage="encode"} 4.0' in lines
+    assert 'stage_seconds_sum{stage="encode"} 4.25' in lines
+    assert '# TYPE bytes_total counter' in lines and 'bytes_total 5.0' in lines
+    assert 'depth{priority="bulk"} 2.0' in lines
+
+
+def test_labels_must_match():
+    histogram = Registry().histogram('stage_seconds', 'Stage time', ['stage'])
+
+    with pytest.raises(ValueError):
+        histogram.observe(1.0, model='htdemucs')
+
+
+# A gunicorn worker: records some metrics, writes them to the shared directory and
+# waits for its stdin to close, or exits right away with `exit`
+WORKER_SCRIPT = """
+import sys
+sys.path.append({root!r})
+from utils.metrics import Registry
+
+registry = Registry({directory!r})
+jobs = registry.counter('jobs_total', 'Jobs', ['outcome'])
+in_flight = registry.gauge('in_flight', 'Jobs running')
+seconds = registry.histogram('stage_seconds', 'Stage time', buckets=(1,))
+jobs.inc({jobs}, outcome='done')
+in_flight.set(1)
+seconds.observe(0.5)
+registry.flush()
+print('ready', flush=True)
+if sys.argv[1] != 'exit':
+    sys.stdin.read()
+"""
+
+
+def start_worker(directory, jobs, mode):
+    script = WORKER_SCRIPT.format(root=str(Path(__file__).parent.parent), directory=str(directory), jobs=jobs)
+    worker = subprocess.Popen([sys.executable, '-c', script, mode], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              text=True)
+    assert worker.stdout.readline().strip() == 'ready'
+    return worker
+
+
+def test_every_worker_is_counted_whichever_answers(tmp_path):
+    exited = start_worker(tmp_path, 2, 'exit')
+    exited.wait()
+    running = [start_worker(tmp_path, jobs, 'wait') for jobs in (3, 4)]
+    registry = Registry(tmp_path)
+    registry.counter('jobs_total', 'Jobs', ['outcome']).inc(1, outcome='done')
+    registry.gauge('in_flight', 'Jobs running')
+    registry.histogram('stage_seconds', 'Stage time', buckets=(1,))
+    registry.gauge('queue_depth', 'Queued jobs', function=lambda: 5, shared=True)
+    try:
+        lines = registry.render().splitlines()
+    finally:
+        for worker in running:
+            worker.communicate('')
+
+    assert 'jobs_total{outcome="done"} 10.0' in lines
+    # Gauges only count the workers still running
+    assert 'in_flight 2.0' in lines
+    assert 'stage_seconds_count 3.0' in lines
+    assert 'queue_depth 5.0' in lines
+    assert not (tmp_path / f"{exited.pid}.json").exists()
+
+    # Once they exit, their counters stay
+    lines = registry.render().splitlines()
+    assert 'jobs_total{outcome="done"} 10.0' in lines
+    assert 'in_flight 2.0' not in lines
+    assert sorted(path.name for path in tmp_path.glob('*.json')) == ['exited.json']
+
+
+def test_flushes_stay_where_the_registry_was_made(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    registry = Registry("metrics")
+    (tmp_path / "work").mkdir()
+    monkeypatch.chdir(tmp_path / "work")
+
+    registry.flush()
+
+    assert (tmp_path / "metrics" / f"{os.getpid()}.json").exists()
+    assert list((tmp_path / "work").iterdir()) == []
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_job_records_every_stage(s3, stub_model, make_track, streaming):
+    counts = {stage: stage_seconds.count(stage=stage) for stage in JOB_STAGES}
+    observed = realtime_factor.count()
+    uploaded = s3_bytes.value(direction='upload')
+    done = jobs_total.value(outcome='done')
+
+    with patch.object(separate_routes, 'result_cache', None), \
+            patch.object(separate_routes, 'PROGRESSIVE_DECODE', False), \
+            patch.object(separate_routes, 'prepare_audio_file',
+                         side_effect=lambda url, scratch=None: (make_track(seconds=3.0), "song.wav", None)), \
+            start_trace('test', log=False) as trace:
+        result = separate_routes.process_separation_job(
+            {'link': 'https://example.com/song.wav', 'mode': '2', 'streaming': streaming}, MagicMock()
+        )
+
+    spans = {span['span']: span for span in trace.spans}
+    for stage in JOB_STAGES:
+        assert stage_seconds.count(stage=stage) == counts[stage] + 1, stage
+        assert spans[stage]['trace_id'] == trace.trace_id
+        assert spans[stage]['duration'] >= 0
+    assert spans['inference']['audio_duration'] == pytest.approx(3.0)
+    assert spans['inference']['duration'] == result['timings']['inference_time']
+    assert realtime_factor.count() == observed + 1
+    assert jobs_total.value(outcome='done') == done + 1
+    assert s3_bytes.value(direction='upload') - uploaded == spans['upload']['bytes'] > 0
+
+
+def test_failed_job_is_counted_and_traced():
+    failed = jobs_total.value(outcome='failed')
+    error = (MagicMock(get_json=lambda: {"error": "Not found"}), 404)
+
+    with patch.object(separate_routes, 'prepare_audio_file', return_value=(None, None, error)), \
+            pytest.raises(RuntimeError), start_trace('test', log=False) as trace:
+        separate_routes.process_separation_job({'link': 'https://example.com/a.mp3', 'mode': '2'}, MagicMock())
+
+    assert jobs_total.value(outcome='failed') == failed + 1
+    assert [span['span'] for span in trace.spans] == ['cleanup', 'test']
+    assert trace.spans[-1]['error'] == "Not found"
+
+
+def test_queue_traces_jobs_under_their_id(capsys):
+    def fail(params, report):
+        raise ValueError("broken input")
+
+    queue = JobQueue(fail, MemoryJobStore(), poll_interval=0.01)
+    job_id = queue.submit({})
+    for _ in range(100):
+        if queue.status(job_id)['status'] == FAILED:
+            break
+        time.sleep(0.01)
+
+    line = [line for line in capsys.readouterr().out.splitlines() if job_id in line][-1]
+    assert '"span": "job"' in line and '"error": "broken input"' in line
+
+
+def test_metrics_endpoint():
+    from server import app
+
+    with app.test_client() as client:
+        response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    body = response.get_data(as_text=True)
+    assert '# TYPE separation_stage_seconds histogram' in body
+    assert 'separation_queue_depth{priority="interactive"}' in body
+    assert 'process_resident_memory_bytes ' in body
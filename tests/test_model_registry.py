@@ -0,0 +1,135 @@
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from conftest import StubModel
+from server.api import separate_routes
+from utils import model_registry, separation_engine
+from utils.job_queue import MemoryJobStore
+from utils.model_registry import ResidentModels, UnknownModelError, choose_model, model_bytes
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(model_registry, 'AVAILABLE_MODELS', ['htdemucs', 'htdemucs_ft', 'hdemucs_mmi'])
+    monkeypatch.setattr(model_registry, 'DEFAULT_MODEL', 'htdemucs')
+    monkeypatch.setattr(model_registry, 'FAST_MODEL', 'hdemucs_mmi')
+    monkeypatch.setattr(model_registry, 'QUALITY_MODEL', 'htdemucs_ft')
+    monkeypatch.setattr(model_registry, 'LONG_TRACK_SECONDS', 1200)
+
+
+def test_policy(registry):
+    assert choose_model() == 'htdemucs'
+    assert choose_model(quality='high') == 'htdemucs_ft'
+    assert choose_model(preview=True) == 'hdemucs_mmi'
+    assert choose_model(duration=3600) == 'hdemucs_mmi'
+    assert choose_model(duration=3600, quality='standard') == 'htdemucs'
+    assert choose_model(duration=3600, quality='high') == 'htdemucs_ft'
+    assert choose_model('htdemucs_ft', quality='fast') == 'htdemucs_ft'
+
+
+def test_unknown_models_are_refused(registry):
+    with pytest.raises(UnknownModelError):
+        choose_model('mdx_extra_q')
+
+
+def test_policy_falls_back_to_the_default(registry, monkeypatch):
+    monkeypatch.setattr(model_registry, 'QUALITY_MODEL', 'not_deployed')
+    assert choose_model(quality='high') == 'htdemucs'
+
+
+def test_least_recently_used_model_is_unloaded():
+    size = model_bytes(StubModel())
+    models = ResidentModels(budget=2 * size)
+
+    models.add('a', StubModel())
+    models.add('b', StubModel())
+    models.get('a')
+    models.add('c', StubModel())
+
+    assert models.names() == ['a', 'c']
+    assert models.total_bytes() == 2 * size
+
+
+def test_a_model_over_the_budget_still_loads():
+    models = ResidentModels(budget=1)
+
+    models.add('a', StubModel())
+    models.add('b', StubModel())
+
+    assert models.names() == ['b']
+
+
+def test_engine_keeps_models_within_the_budget(monkeypatch):
+    monkeypatch.setattr(separation_engine, '_models', ResidentModels(2 * model_bytes(StubModel())))
+    with patch('utils.separation_engine.get_model', side_effect=lambda name: StubModel()) as get_model:
+        for name in ['htdemucs', 'htdemucs_ft', 'htdemucs', 'hdemucs_mmi', 'htdemucs', 'htdemucs_ft']:
+            separation_engine.load_model(name)
+
+    assert [call.args[0] for call in get_model.call_args_list] == [
+        'htdemucs', 'htdemucs_ft', 'hdemucs_mmi', 'htdemucs_ft'
+    ]
+    assert separation_engine.resident_models() == ['htdemucs', 'htdemucs_ft']
+
+
+def test_job_runs_on_its_model(s3, stub_model, make_track):
+    track = make_track(seconds=2.0)
+
+    with patch.object(separate_routes, 'result_cache', None), \
+            patch.object(separate_routes, 'prepare_audio_file', return_value=(track, "song.wav", None)):
+        result = separate_routes.process_separation_job(
+            {'link': 'https://example.com/song.wav', 'mode': '2', 'model': 'htdemucs_ft'}, MagicMock()
+        )
+
+    assert result['model'] == 'htdemucs_ft'
+    stub_model.assert_called_once_with('htdemucs_ft')
+
+
+class TestModelRoutes:
+
+    @pytest.fixture(autouse=True)
+    def client(self, registry):
+        from server import app
+        queue = separate_routes.separation_queue
+        self.store = MemoryJobStore()
+        with patch.object(queue, 'store', self.store), \
+                patch.object(self.store, 'claim', return_value=None), \
+                patch('server.api.separate_routes.ensure_ffmpeg', return_value=True), \
+                patch('server.api.separate_routes.estimate_cost', return_value=240.0):
+            with app.test_client() as client:
+                self.client = client
+                yield
+
+    def post(self, **data):
+        return self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3', **data})
+
+    def queued(self, response):
+        return self.store.get(response.json['job_id'])
+
+    def test_model_is_chosen_per_request(self):
+        assert self.queued(self.post())['params']['model'] == 'htdemucs'
+        assert self.queued(self.post(model='hdemucs_mmi'))['params']['model'] == 'hdemucs_mmi'
+        assert self.queued(self.post(start='30'))['params']['model'] == 'hdemucs_mmi'
+
+    def test_slower_models_cost_more(self):
+        standard = self.queued(self.post())
+        premium = self.queued(self.post(quality='high'))
+
+        assert premium['params']['model'] == 'htdemucs_ft'
+        assert premium['cost'] == 4 * standard['cost']
+
+    def test_bad_model_or_quality_is_rejected(self):
+        assert self.post(model='nope').status_code == 400
+        assert self.post(quality='ultra').status_code == 400
+
+    def test_lists_models(self):
+        response = self.client.get("/api/separate/models")
+
+        assert response.status_code == 200
+        assert [model['name'] for model in response.json['models']] == [
+            'htdemucs', 'htdemucs_ft', 'hdemucs_mmi'
+        ]
+        assert isinstance(response.json['resident'], list)
@@ -0,0 +1,159 @@
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import julius
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils.audio_io import StreamResampler, content_type, decode, encode, output_tag
+from utils.job_queue import MemoryJobStore
+from utils.result_cache import ResultCache
+from utils.separation_engine import separate_file, separate_file_streaming
+
+BUCKET = 'test-bucket'
+
+
+def tone(seconds=2.0, samplerate=44100):
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    return np.stack([0.5 * np.sin(2 * np.pi * 440 * t), 0.5 * np.sin(2 * np.pi * 660 * t)]).astype(np.float32)
+
+
+def test_chunked_resampling_matches_the_whole_signal():
+    wav = np.random.default_rng(0).standard_normal((2, 100000)).astype(np.float32)
+    resampler = StreamResampler(44100, 48000)
+
+    chunks = [resampler.process(wav[:, start:start + 7919]) for start in range(0, wav.shape[1], 7919)]
+    chunks.append(resampler.flush())
+
+    whole = julius.resample_frac(torch.from_numpy(wav), 44100, 48000).numpy()
+    np.testing.assert_allclose(np.concatenate(chunks, axis=-1), whole, atol=1e-6)
+
+
+@pytest.mark.parametrize('extension, samplerate, subtype', [
+    ('.flac', 44100, 'PCM_24'), ('.wav', 44100, 'PCM_24'), ('.opus', 48000, 'OPUS')
+])
+def test_formats_round_trip(tmp_path, extension, samplerate, subtype):
+    path = tmp_path / f"stem{extension}"
+
+    encode(path, tone(), 44100, bitrate=96)
+
+    info = sf.info(str(path))
+    assert (info.samplerate, info.subtype) == (samplerate, subtype)
+    assert info.duration == pytest.approx(2.0, abs=0.03)
+    decoded, _ = decode(path, samplerate=44100)
+    assert np.abs(decoded).max() == pytest.approx(0.5, abs=0.05)
+
+
+def test_opus_bitrate_sets_the_file_size(tmp_path):
+    sizes = {}
+    for bitrate in (48, 160):
+        encode(tmp_path / f"{bitrate}.opus", tone(10.0), 44100, bitrate=bitrate)
+        sizes[bitrate] = (tmp_path / f"{bitrate}.opus").stat().st_size * 8 / 10 / 1000
+    encode(tmp_path / "320.mp3", tone(10.0), 44100, bitrate=320)
+
+    assert sizes[48] == pytest.approx(48, rel=0.3)
+    assert sizes[160] == pytest.approx(160, rel=0.3)
+    assert (tmp_path / "320.mp3").stat().st_size > 4 * (tmp_path / "48.opus").stat().st_size
+
+
+def test_content_types_and_tags():
+    assert content_type("a/vocals.opus") == 'audio/ogg'
+    assert content_type("vocals.FLAC") == 'audio/flac'
+    assert content_type("vocals.txt", default='audio/mpeg') == 'audio/mpeg'
+    assert output_tag('mp3') == 'mp3-320'
+    assert output_tag('opus', 96) == 'opus-96'
+    assert output_tag('wav', 320) == 'wav'
+    assert ResultCache.key("abc", "htdemucs", "2", output='mp3-320') == "abc:htdemucs:2"
+    assert ResultCache.key("abc", "htdemucs", "2", output='flac') == "abc:htdemucs:2:flac"
+
+
+@pytest.mark.parametrize('separate', [separate_file, separate_file_streaming])
+def test_every_stem_is_written_in_the_format(stub_model, make_track, tmp_path, separate):
+    finished = []
+
+    stems, _ = separate(make_track(seconds=3.0), tmp_path / "out", "4", output_format='flac',
+                        on_stem=lambda stem, path: finished.append(stem))
+
+    assert sorted(finished) == ['bass', 'drums', 'other', 'vocals']
+    for path in stems.values():
+        assert Path(path).suffix == '.flac'
+        assert sf.info(path).duration == pytest.approx(3.0, abs=0.05)
+
+
+def test_job_uploads_stems_with_their_content_type(s3, stub_model, make_track, tmp_path):
+    cache = ResultCache(tmp_path / "cache.db")
+
+    # Every job deletes its download, so each gets a fresh copy of the same track
+    with patch.object(separate_routes, 'result_cache', cache), \
+            patch.object(separate_routes, 'prepare_audio_file',
+                         side_effect=lambda url, scratch=None: (make_track(seconds=2.0), "song.wav", None)):
+        results = [separate_routes.process_separation_job(
+            {'link': 'https://example.com/song.wav', 'mode': '2', 'format': output_format, 'bitrate': bitrate},
+            MagicMock()
+        ) for output_format, bitrate in [('opus', 64), ('flac', None), ('opus', 64)]]
+
+    opus, flac, cached = results
+    assert (opus['format'], opus['bitrate'], flac['format']) == ('opus', 64, 'flac')
+    assert 'bitrate' not in flac
+    assert opus['downloads']['vocals'].endswith('/opus-64/vocals_song.opus')
+    assert flac['downloads']['vocals'].endswith('/flac/vocals_song.flac')
+    assert cached['cached'] and cached['downloads'] == opus['downloads']
+    keys = [obj['Key'] for obj in s3.list_objects_v2(Bucket=BUCKET)['Contents']]
+    types = {Path(key).suffix: s3.head_object(Bucket=BUCKET, Key=key)['ContentType'] for key in keys}
+    assert types == {'.opus': 'audio/ogg', '.flac': 'audio/flac', '.dat': 'application/octet-stream'}
+
+
+def test_partial_files_are_only_streamed_for_append_only_formats(s3, tmp_path):
+    uploader = separate_routes.StemUploader("song.wav", "stems/abc")
+    flac = tmp_path / "vocals.flac"
+    opus = tmp_path / "no_vocals.opus"
+    flac.write_bytes(b"\0" * 1024)
+    opus.write_bytes(b"\0" * 1024)
+
+    uploader.on_chunk({'vocals': str(flac), 'instrumental': str(opus)})
+
+    assert list(uploader.streams) == ['instrumental']
+    uploader.abort()
+
+
+class TestFormatRoute:
+
+    @pytest.fixture(autouse=True)
+    def client(self):
+        from server import app
+        queue = separate_routes.separation_queue
+        self.store = MemoryJobStore()
+        with patch.object(queue, 'store', self.store), \
+                patch.object(self.store, 'claim', return_value=None), \
+                patch('server.api.separate_routes.ensure_ffmpeg', return_value=True), \
+                patch('server.api.separate_routes.estimate_cost', return_value=None):
+            with app.test_client() as client:
+                self.client = client
+                yield
+
+    def output(self, **data):
+        response = self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3', **data})
+        params = self.store.get(response.json['job_id'])['params']
+        return params['format'], params['bitrate']
+
+    def test_defaults(self):
+        assert self.output() == ('mp3', 320)
+        assert self.output(start='10') == ('opus', 96)
+        assert self.output(start='10', format='mp3') == ('mp3', 320)
+
+    def test_format_and_bitrate_are_chosen_per_request(self):
+        assert self.output(format='OPUS', bitrate='64') == ('opus', 64)
+        assert self.output(format='flac', bitrate='128') == ('flac', None)
+        assert self.output(format='wav') == ('wav', None)
+
+    @pytest.mark.parametrize('data', [
+        {'format': 'aac'}, {'format': 'mp3', 'bitrate': '64'}, {'format': 'opus', 'bitrate': 'high'}
+    ])
+    def test_bad_output_is_rejected(self, data):
+        response = self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3', **data})
+        assert response.status_code == 400
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+
+import moto.s3.models
+import pytest
+from flask import Flask
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from server.api.separate_routes import StemUploader
+from utils.s3_client import StreamingUpload
+from utils.separation_engine import separate_file
+
+BUCKET = 'test-bucket'
+PART_SIZE = 64 * 1024
+
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    monkeypatch.setattr(moto.s3.models, 'S3_UPLOAD_PART_MIN_SIZE', PART_SIZE)
+
+
+def test_streaming_upload_of_growing_file(s3, small_parts, tmp_path):
+    path = tmp_path / "vocals.mp3"
+    upload = StreamingUpload(s3, BUCKET, "stems/vocals.mp3", {'ContentType': 'audio/mpeg'},
+                             ThreadPoolExecutor(2), part_size=PART_SIZE)
+    data = os.urandom(PART_SIZE * 3 + 100)
+
+    with open(path, 'wb') as f:
+        for start in range(0, len(data), 50_000):
+            f.write(data[start:start + 50_000])
+            f.flush()
+            upload.feed(path)
+        assert upload.offset == PART_SIZE * 3
+    upload.finish(path)
+
+    obj = s3.get_object(Bucket=BUCKET, Key="stems/vocals.mp3")
+    assert obj['Body'].read() == data
+    assert obj['ETag'].endswith('-4"')
+    assert obj['ContentType'] == 'audio/mpeg'
+
+
+def test_small_file_is_sent_in_one_request(s3, tmp_path):
+    path = tmp_path / "vocals.mp3"
+    path.write_bytes(b"tiny")
+    upload = StreamingUpload(s3, BUCKET, "stems/vocals.mp3", {}, ThreadPoolExecutor(1))
+
+    upload.feed(path)
+    upload.finish(path)
+
+    assert s3.get_object(Bucket=BUCKET, Key="stems/vocals.mp3")['Body'].read() == b"tiny"
+
+
+def test_uploads_start_before_separation_ends(stub_model, make_track, tmp_path):
+    started = []
+    mock_s3 = MagicMock()
+    mock_s3.upload_fileobj.side_effect = lambda *args, **kwargs: started.append(time.perf_counter())
+
+    with patch('server.api.separate_routes.get_s3_client', return_value=mock_s3):
+        uploader = StemUploader("song.wav")
+        separate_file(make_track(seconds=4.0), tmp_path / "out", "4", on_stem=uploader.on_stem)
+        separation_end = time.perf_counter()
+        with Flask(__name__).app_context():
+            download_links, error = uploader.result()
+
+    assert error is None
+    assert set(download_links) == {'vocals', 'drums', 'bass', 'other'}
+    assert min(started) < separation_end
+
+
+def test_streaming_job_uploads_parts_during_separation(s3, small_parts, stub_model, make_track,
+                                                       tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('utils.s3_client.TRANSFER_CONFIG.multipart_chunksize', PART_SIZE)
+    track = make_track(seconds=12.0)
+
+    with patch.object(separate_routes, 'result_cache', None), \
+            patch.object(separate_routes, 'PROGRESSIVE_DECODE', False), \
+            patch.object(separate_routes, 'prepare_audio_file', return_value=(track, "song.wav", None)):
+        result = separate_routes.process_separation_job(
+            {'link': 'https://example.com/song.wav', 'mode': '2', 'streaming': True}, MagicMock()
+        )
+
+    for key in ('download_time', 'inference_time', 'encode_time', 'upload_time', 'upload_wait_time'):
+        assert key in result['timings']
+    key = result['downloads']['vocals'].split('.amazonaws.com/')[1]
+    assert '-' in s3.head_object(Bucket=BUCKET, Key=key)['ETag']
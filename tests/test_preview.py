@@ -0,0 +1,128 @@
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+import soundfile as sf
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils.job_queue import MemoryJobStore
+from utils.result_cache import ResultCache
+from utils.segment_store import SegmentStore
+from utils.separation_engine import (
+    load_model, load_track, run_segments, separate_blocks, separate_file, separate_tensor
+)
+
+SR = 44100
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SegmentStore(tmp_path / "segments")
+
+
+def test_load_track_decodes_only_the_window(make_track):
+    track = make_track(seconds=5.0)
+
+    whole = load_track(track, SR, 2)
+    window = load_track(track, SR, 2, 2 * SR, 3 * SR)
+
+    assert window.shape == (2, SR)
+    assert torch.allclose(window, whole[:, 2 * SR:3 * SR], atol=1e-6)
+
+
+def test_window_matches_the_full_separation(stub_model, make_track):
+    track = make_track(seconds=30.0)
+    model, _ = load_model()
+    full = separate_tensor(model, load_track(track, SR, 2), run_segments)
+
+    window = separate_blocks(model, track, 12 * SR, 25 * SR, 30 * SR)
+
+    assert window.shape == (4, 2, 13 * SR)
+    assert torch.allclose(window, full[..., 12 * SR:25 * SR], atol=1e-3)
+
+
+def test_overlapping_previews_and_full_track_reuse_blocks(stub_model, make_track, store, tmp_path):
+    track = make_track(seconds=30.0)
+    audio_hash = "0" * 64
+
+    _, first = separate_file(track, tmp_path / "a", "4", window=(12, 8),
+                             segment_store=store, audio_hash=audio_hash)
+    _, second = separate_file(track, tmp_path / "b", "4", window=(15, 10),
+                              segment_store=store, audio_hash=audio_hash)
+    stems, full = separate_file(track, tmp_path / "c", "4", segment_store=store, audio_hash=audio_hash)
+
+    assert (first['blocks_separated'], first['blocks_reused']) == (1, 0)
+    assert (second['blocks_separated'], second['blocks_reused']) == (1, 1)
+    assert (full['blocks_separated'], full['blocks_reused']) == (1, 2)
+    assert sf.info(stems['vocals']).duration == pytest.approx(30.0, abs=0.1)
+
+
+def test_preview_stems_cover_the_window(stub_model, make_track, tmp_path):
+    track = make_track(seconds=20.0)
+
+    stems, timings = separate_file(track, tmp_path / "out", "2", window=(5, 4))
+
+    assert sf.info(stems['vocals']).duration == pytest.approx(4.0, abs=0.1)
+    assert timings['blocks_separated'] == 1
+
+
+def test_preview_past_the_end_fails(stub_model, make_track, tmp_path):
+    with pytest.raises(ValueError, match='after the end'):
+        separate_file(make_track(seconds=2.0), tmp_path / "out", "2", window=(10, 5))
+
+
+def test_preview_job_has_its_own_cache_entry(s3, stub_model, make_track, store, tmp_path):
+    track = make_track(seconds=20.0)
+    cache = ResultCache(tmp_path / "cache.db")
+
+    with patch.object(separate_routes, 'result_cache', cache), \
+            patch.object(separate_routes, 'segment_store', store), \
+            patch.object(separate_routes, 'prepare_audio_file', return_value=(track, "song.wav", None)):
+        result = separate_routes.process_separation_job(
+            {'link': 'https://example.com/song.wav', 'mode': '2', 'window': [5, 4]}, MagicMock()
+        )
+
+    assert result['preview'] == {'start': 5, 'duration': 4}
+    assert '/preview-5-4/' in result['downloads']['vocals']
+    assert cache.stats()['entries'] == 1
+    assert store.has(next(path.name for path in store.root.iterdir()))
+
+
+class TestPreviewRoute:
+
+    @pytest.fixture(autouse=True)
+    def client(self):
+        from server import app
+        queue = separate_routes.separation_queue
+        self.store = MemoryJobStore()
+        with patch.object(queue, 'store', self.store), \
+                patch.object(self.store, 'claim', return_value=None), \
+                patch('server.api.separate_routes.ensure_ffmpeg', return_value=True), \
+                patch('server.api.separate_routes.estimate_cost', return_value=None):
+            with app.test_client() as client:
+                self.client = client
+                yield
+
+    def post(self, **data):
+        return self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3', **data})
+
+    def test_window_is_queued_as_interactive(self):
+        response = self.post(start='60', duration='30', mode='4')
+
+        assert response.status_code == 202
+        job = self.store.get(response.json['job_id'])
+        assert job['params']['window'] == [60.0, 30.0]
+        assert job['priority'] == 'interactive'
+
+    def test_start_alone_uses_the_default_duration(self):
+        job = self.store.get(self.post(start='10').json['job_id'])
+        assert job['params']['window'] == [10.0, separate_routes.PREVIEW_DURATION]
+
+    @pytest.mark.parametrize('data', [
+        {'start': 'soon'}, {'start': '-1'}, {'duration': '0'}, {'duration': '100000'}
+    ])
+    def test_bad_windows_are_rejected(self, data):
+        assert self.post(**data).status_code == 400
@@ -0,0 +1,96 @@
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.result_cache import ResultCache, hash_file
+
+DOWNLOADS = {'vocals': 'https://bucket/stems/vocals.mp3'}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(tmp_path / "cache.db", max_bytes=1000, max_age=3600)
+
+
+def test_key_depends_on_model_and_mode():
+    assert ResultCache.key("abc", "htdemucs", "2") == "abc:htdemucs:2"
+    assert ResultCache.key("abc", "htdemucs", "4") == ResultCache.key("abc", "htdemucs", "other")
+    assert ResultCache.key("abc", "htdemucs", "2") != ResultCache.key("abc", "htdemucs_ft", "2")
+
+
+def test_hash_file_is_content_addressed(tmp_path):
+    first = tmp_path / "a.mp3"
+    second = tmp_path / "download.mp3"
+    first.write_bytes(b"same audio")
+    second.write_bytes(b"same audio")
+
+    assert hash_file(first) == hash_file(second)
+
+
+def test_hit_and_miss_counters(cache):
+    assert cache.get("k") is None
+    cache.put("k", DOWNLOADS, 300, separation_time=12.5)
+
+    entry = cache.get("k")
+
+    assert entry['downloads'] == DOWNLOADS
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 0.5
+    assert stats['bytes_saved'] == 300
+    assert stats['seconds_saved'] == 12.5
+
+
+def test_index_survives_restart(tmp_path):
+    ResultCache(tmp_path / "cache.db").put("k", DOWNLOADS, 10)
+
+    assert ResultCache(tmp_path / "cache.db").get("k")['downloads'] == DOWNLOADS
+
+
+def test_size_eviction_drops_least_recently_used(cache):
+    cache.put("old", DOWNLOADS, 400)
+    cache.put("used", DOWNLOADS, 400)
+    cache.get("old")
+
+    cache.put("new", DOWNLOADS, 400)
+
+    assert cache.get("used") is None
+    assert cache.get("old") is not None
+    assert cache.stats()['size_bytes'] == 800
+
+
+@patch('utils.result_cache.time.time')
+def test_age_eviction(mock_time, cache):
+    mock_time.return_value = 1000.0
+    cache.put("k", DOWNLOADS, 10)
+
+    mock_time.return_value = 1000.0 + 3601
+    assert cache.get("k") is None
+
+    cache.put("other", DOWNLOADS, 10)
+    assert cache.stats()['entries'] == 1
+
+
+def test_job_skips_separation_on_hit(cache, tmp_path):
+    from server import app
+    from server.api import separate_routes
+
+    track = tmp_path / "song.mp3"
+    track.write_bytes(b"audio bytes")
+    cache.put(ResultCache.key(hash_file(track), "htdemucs", "2"), DOWNLOADS, 10)
+
+    with patch.object(separate_routes, 'result_cache', cache), \
+            patch.object(separate_routes, 'prepare_audio_file', return_value=(track, "song.mp3", None)), \
+            patch.object(separate_routes, 'run_separation') as mock_run_separation, \
+            app.app_context():
+        result = separate_routes.process_separation_job(
+            {'link': 'https://example.com/song.mp3', 'mode': '2'}, MagicMock()
+        )
+
+    mock_run_separation.assert_not_called()
+    assert result['cached'] is True
+    assert result['downloads'] == DOWNLOADS
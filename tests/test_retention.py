@@ -0,0 +1,173 @@
+import sys
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import clean_bucket_routes, separate_routes
+from utils.job_queue import MemoryJobStore
+from utils.result_cache import ResultCache
+from utils.retention import ALL, RetentionIndex, Sweeper
+
+BUCKET = 'test-bucket'
+
+
+@pytest.fixture
+def index(tmp_path):
+    return RetentionIndex(tmp_path / "retention.db", ttl=3600)
+
+
+def put_objects(s3, index, count, prefix="stems", ttl=0):
+    for i in range(count):
+        key = f"{prefix}/{i:05d}.mp3"
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"x" * 10)
+        index.record(key, 10, ttl=ttl)
+
+
+def bucket_keys(s3):
+    paginator = s3.get_paginator('list_objects_v2')
+    return [obj['Key'] for page in paginator.paginate(Bucket=BUCKET) for obj in page.get('Contents', [])]
+
+
+def test_index_tracks_expiry(index):
+    index.record("stems/a.mp3", 100, ttl=0)
+    index.record("stems/b.mp3", 200)
+
+    assert index.expired() == [("stems/a.mp3", 100)]
+    assert index.expired(now=time.time() + 7200) == [("stems/a.mp3", 100), ("stems/b.mp3", 200)]
+    index.forget(["stems/a.mp3"])
+    assert index.stats() == {'objects': 1, 'size_bytes': 200, 'expired': 0, 'expired_bytes': 0, 'ttl': 3600}
+
+
+def test_only_one_worker_claims_a_periodic_sweep(index):
+    assert index.claim_sweep(60, now=1000)
+    assert not index.claim_sweep(60, now=1030)
+    assert index.claim_sweep(60, now=1060)
+
+
+def test_expired_objects_are_deleted_in_batches_of_1000(s3, index):
+    put_objects(s3, index, 2500, "old")
+    put_objects(s3, index, 5, "new", ttl=3600)
+    sweeper = Sweeper(index, s3, BUCKET, concurrency=2, max_rate=0)
+
+    with patch.object(s3, 'delete_objects', wraps=s3.delete_objects) as delete_objects:
+        totals = sweeper.sweep()
+
+    assert totals == {'deleted': 2500, 'bytes_freed': 25000, 'errors': 0, 'resumed': False}
+    assert [len(call.kwargs['Delete']['Objects']) for call in delete_objects.call_args_list] == [1000, 1000, 500]
+    assert sorted(bucket_keys(s3)) == [f"new/{i:05d}.mp3" for i in range(5)]
+    assert index.stats()['objects'] == 5
+
+
+def test_failed_deletes_stay_in_the_index(s3, index):
+    put_objects(s3, index, 3)
+    sweeper = Sweeper(index, s3, BUCKET, max_rate=0)
+
+    with patch.object(s3, 'delete_objects', return_value={
+        'Errors': [{'Key': "stems/00001.mp3", 'Code': 'AccessDenied'}]
+    }):
+        totals = sweeper.sweep()
+
+    assert (totals['deleted'], totals['errors']) == (2, 1)
+    assert index.expired() == [("stems/00001.mp3", 10)]
+
+
+def test_interrupted_bucket_sweep_resumes(s3, index):
+    put_objects(s3, index, 35)
+    sweeper = Sweeper(index, s3, BUCKET, batch_size=10, concurrency=1, max_rate=0)
+
+    def interrupt(totals):
+        if totals['deleted'] == 20:
+            raise RuntimeError("worker restarted")
+
+    with pytest.raises(RuntimeError):
+        sweeper.sweep(ALL, interrupt)
+    assert len(bucket_keys(s3)) == 15
+    assert index.get_state('sweep_cursor') == "stems/00019.mp3"
+
+    with patch.object(s3, 'delete_objects', wraps=s3.delete_objects) as delete_objects:
+        totals = sweeper.sweep(ALL)
+
+    assert totals == {'deleted': 15, 'bytes_freed': 150, 'errors': 0, 'resumed': True}
+    assert delete_objects.call_args_list[0].kwargs['Delete']['Objects'][0] == {'Key': "stems/00020.mp3"}
+    assert bucket_keys(s3) == []
+    assert index.get_state('sweep_cursor') is None
+    assert index.stats()['objects'] == 0
+
+
+def test_deletes_are_rate_limited(s3, index):
+    put_objects(s3, index, 30)
+    sweeper = Sweeper(index, s3, BUCKET, batch_size=10, concurrency=1, max_rate=100)
+
+    start = time.perf_counter()
+    sweeper.sweep()
+
+    # 30 deletes at 100 per second
+    assert time.perf_counter() - start >= 0.3
+
+
+def test_uploads_are_indexed(s3, index, tmp_path):
+    path = tmp_path / "vocals.mp3"
+    path.write_bytes(b"\0" * 2048)
+
+    with patch.object(separate_routes, 'retention_index', index):
+        separate_routes.upload_stems_to_s3({'vocals': str(path)}, "song.mp3", prefix="stems/abc")
+
+    assert index.expired(now=time.time() + 3600) == [("stems/abc/vocals_song.mp3", 2048)]
+
+
+class TestSweepRoute:
+
+    @pytest.fixture(autouse=True)
+    def client(self, s3, index, tmp_path):
+        from server import app
+        self.s3 = s3
+        self.index = index
+        self.cache = ResultCache(tmp_path / "cache.db")
+        with patch.object(clean_bucket_routes.sweep_queue, 'store', MemoryJobStore()), \
+                patch.object(clean_bucket_routes, 'retention_index', index), \
+                patch.object(clean_bucket_routes, 'result_cache', self.cache):
+            with app.test_client() as client:
+                self.client = client
+                yield
+
+    def wait(self, response):
+        assert response.status_code == 202
+        for _ in range(100):
+            status = self.client.get(response.json['status_url']).json
+            if status['status'] in ('done', 'failed'):
+                return status
+            time.sleep(0.05)
+        raise AssertionError("sweep did not finish")
+
+    def test_delete_queues_a_sweep_of_expired_stems(self):
+        put_objects(self.s3, self.index, 3, "old")
+        put_objects(self.s3, self.index, 2, "new", ttl=3600)
+        self.cache.put("key", {'vocals': 'url'}, 10)
+
+        status = self.wait(self.client.delete("/api/clean_bucket"))
+
+        assert status['status'] == 'done'
+        assert (status['scope'], status['deleted'], status['bytes_freed']) == ('expired', 3, 30)
+        assert len(bucket_keys(self.s3)) == 2
+        # The cache entry is newer than the TTL, its stems are still there
+        assert self.cache.stats()['entries'] == 1
+
+    def test_scope_all_empties_the_bucket(self):
+        self.s3.put_object(Bucket=BUCKET, Key="untracked.mp3", Body=b"x")
+        put_objects(self.s3, self.index, 2, ttl=3600)
+        self.cache.put("key", {'vocals': 'url'}, 10)
+
+        status = self.wait(self.client.delete("/api/clean_bucket?scope=all"))
+
+        assert status['deleted'] == 3
+        assert bucket_keys(self.s3) == []
+        assert self.cache.stats()['entries'] == 0
+
+    def test_bad_scope_is_rejected(self):
+        assert self.client.delete("/api/clean_bucket?scope=some").status_code == 400
+
+    def test_unknown_sweep(self):
+        assert self.client.get("/api/clean_bucket/nope").status_code == 404
@@ -0,0 +1,104 @@
+import sys
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+
+sys.path.append(str(Path(__file__).parent.parent))
+import requests
+from server.api import separate_routes
+from server.api.separate_routes import upload_stems_to_s3
+from utils import s3_client
+from utils.s3_client import MB, get_s3_client, object_key
+
+BUCKET = 'test-bucket'
+
+
+def write_stems(tmp_path, sizes):
+    stems_files = {}
+    for stem, size in sizes.items():
+        path = tmp_path / f"{stem}.mp3"
+        path.write_bytes(b"\0" * size)
+        stems_files[stem] = str(path)
+    return stems_files
+
+
+def test_client_is_shared(s3):
+    assert get_s3_client() is s3
+    assert s3.meta.config.max_pool_connections >= 8
+
+
+@pytest.fixture
+def private_stems(monkeypatch):
+    monkeypatch.setattr(s3_client, 'PRIVATE_OBJECTS', True)
+    monkeypatch.setattr(separate_routes, 'PRIVATE_OBJECTS', True)
+
+
+def test_object_key_of_public_and_path_style_urls():
+    assert object_key(f"https://{BUCKET}.s3.us-east-1.amazonaws.com/stems/a%20b.mp3", BUCKET) == "stems/a b.mp3"
+    assert object_key(f"http://localhost:9000/{BUCKET}/stems/a.mp3?X-Amz-Signature=x", BUCKET) == "stems/a.mp3"
+
+
+def test_private_stems_get_presigned_links(s3, tmp_path, private_stems):
+    stems_files = write_stems(tmp_path, {'vocals': 1024, 'instrumental': 10})
+
+    download_links, error = upload_stems_to_s3(stems_files, "song.mp3", prefix="stems/abc")
+
+    assert error is None
+    assert 'X-Amz-Signature=' in download_links['vocals']
+    assert object_key(download_links['vocals'], BUCKET) == "stems/abc/vocals_song.mp3"
+    grants = s3.get_object_acl(Bucket=BUCKET, Key="stems/abc/vocals_song.mp3")['Grants']
+    assert not any(grant['Grantee'].get('URI', '').endswith('AllUsers') for grant in grants)
+    assert requests.get(download_links['vocals']).content == b"\0" * 1024
+
+
+def test_cached_private_links_are_resigned(s3, private_stems, monkeypatch):
+    monkeypatch.setattr(s3_client, 'PRESIGN_EXPIRY', 60)
+    old = s3_client.presigned_url(BUCKET, "stems/abc/vocals_song.mp3", expires_in=1)
+
+    refreshed = separate_routes.refresh_links({'vocals': old})
+
+    assert refreshed['vocals'] != old
+    assert 'X-Amz-Expires=60' in refreshed['vocals']
+    assert object_key(refreshed['vocals'], BUCKET) == "stems/abc/vocals_song.mp3"
+
+
+def test_stems_land_in_bucket(s3, tmp_path):
+    stems_files = write_stems(tmp_path, {'vocals': 1024, 'drums': 2048, 'bass': 10, 'other': 10})
+
+    download_links, error = upload_stems_to_s3(stems_files, "song.mp3", prefix="stems/abc")
+
+    assert error is None
+    assert download_links['vocals'] == f"https://{BUCKET}.s3.us-east-1.amazonaws.com/stems/abc/vocals_song.mp3"
+    head = s3.head_object(Bucket=BUCKET, Key="stems/abc/drums_song.mp3")
+    assert head['ContentType'] == 'audio/mpeg'
+    assert head['ContentLength'] == 2048
+    assert not any(Path(path).exists() for path in stems_files.values())
+
+
+def test_large_stems_use_multipart(s3, tmp_path):
+    stems_files = write_stems(tmp_path, {'vocals': 20 * MB})
+
+    upload_stems_to_s3(stems_files, "song.wav")
+
+    etag = s3.head_object(Bucket=BUCKET, Key="stems/vocals_song.mp3")['ETag']
+    assert '-' in etag  # multipart ETags end in -<part count>
+
+
+@patch('server.api.separate_routes.get_s3_client')
+def test_upload_time_follows_slowest_stem(mock_get_s3_client, tmp_path):
+    mock_s3 = MagicMock()
+    mock_s3.upload_fileobj.side_effect = lambda *args, **kwargs: time.sleep(0.2)
+    mock_get_s3_client.return_value = mock_s3
+    stems_files = write_stems(tmp_path, {'vocals': 1, 'drums': 1, 'bass': 1, 'other': 1})
+
+    start = time.perf_counter()
+    with Flask(__name__).app_context():
+        download_links, error = upload_stems_to_s3(stems_files, "song.mp3")
+    elapsed = time.perf_counter() - start
+
+    assert error is None
+    assert len(download_links) == 4
+    assert elapsed < 0.6
@@ -0,0 +1,189 @@
+import heapq
+import socket
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils import job_queue
+from utils.job_queue import (
+    BULK, INTERACTIVE, JobQueue, MemoryJobStore, QueueFullError, SQLiteJobStore, pick_next
+)
+
+
+def fifo(queued, service, now):
+    return min(queued, key=lambda job: job['created_at'])
+
+
+def mixed_workload():
+    """`(arrival, client, priority, cost)` of a few hours of traffic.
+
+    One client dumps eight half-hour bulk jobs at once, two users send
+    3 minute previews every quarter hour and a third user sends a couple of
+    short bulk jobs.
+    """
+    workload = [(0.0, 'bulk-bot', BULK, 1800.0) for _ in range(8)]
+    for start in range(60, 14400, 900):
+        workload.append((float(start), 'alice', INTERACTIVE, 180.0))
+        workload.append((float(start + 30), 'bob', INTERACTIVE, 180.0))
+    workload += [(120.0, 'carol', BULK, 300.0), (5000.0, 'carol', BULK, 300.0)]
+    return sorted(workload, key=lambda job: job[0])
+
+
+def simulate(store, workload, pick, workers=1):
+    """Replay `workload` through `store` on a virtual clock; jobs run for their cost."""
+    clock = SimpleNamespace(now=0.0)
+    arrivals = list(workload)
+    finishing = []
+    jobs = {}
+    with patch.object(job_queue, 'time', SimpleNamespace(time=lambda: clock.now)):
+        while arrivals or finishing or store.count('queued'):
+            next_times = [arrivals[0][0]] if arrivals else []
+            if finishing:
+                next_times.append(finishing[0][0])
+            clock.now = max(clock.now, min(next_times))
+            while finishing and finishing[0][0] <= clock.now:
+                _, job_id = heapq.heappop(finishing)
+                store.update(job_id, status='done', finished_at=clock.now)
+            while arrivals and arrivals[0][0] <= clock.now:
+                _, client, priority, cost = arrivals.pop(0)
+                job = store.add({}, max_depth=1000, priority=priority, client=client, cost=cost)
+                jobs[job['id']] = job
+            while len(finishing) < workers:
+                job = store.claim(pick)
+                if job is None:
+                    break
+                jobs[job['id']] = job
+                heapq.heappush(finishing, (clock.now + job['cost'], job['id']))
+    return list(jobs.values())
+
+
+def waits(jobs, **match):
+    return sorted(
+        job['started_at'] - job['created_at'] for job in jobs
+        if all(job[key] == value for key, value in match.items())
+    )
+
+
+def p95(samples):
+    return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+
+def test_mixed_workload_simulation():
+    fair = simulate(MemoryJobStore(), mixed_workload(), pick_next)
+    baseline = simulate(MemoryJobStore(), mixed_workload(), fifo)
+
+    assert all(job['started_at'] is not None for job in fair)
+    # Previews no longer wait behind the whole bulk dump, at most behind the one job running
+    interactive = waits(fair, priority=INTERACTIVE)
+    baseline_interactive = waits(baseline, priority=INTERACTIVE)
+    assert interactive[len(interactive) // 2] < baseline_interactive[len(baseline_interactive) // 2] / 5
+    assert max(interactive) <= 1800 + 2 * 180
+    assert p95(interactive) < p95(baseline_interactive) / 5
+    print(f"interactive p95 wait: {p95(interactive):.0f}s with the scheduler, "
+          f"{p95(baseline_interactive):.0f}s first come first served")
+    # The light bulk user isn't stuck behind the heavy one
+    assert max(waits(fair, client='carol')) < min(waits(baseline, client='carol'))
+    # Nothing starves: the heavy client's jobs are all served
+    assert len(waits(fair, client='bulk-bot')) == 8
+
+
+def test_aging_promotes_long_waiting_bulk_jobs():
+    queued = [
+        {'id': 'bulk', 'priority': BULK, 'client': 'a', 'cost': 60.0, 'created_at': 0.0},
+        {'id': 'preview', 'priority': INTERACTIVE, 'client': 'b', 'cost': 600.0, 'created_at': 500.0},
+    ]
+
+    assert pick_next(queued, {}, now=550.0, aging=600)['id'] == 'preview'
+    assert pick_next(queued, {}, now=650.0, aging=600)['id'] == 'bulk'
+
+
+def test_short_jobs_and_light_clients_go_first():
+    queued = [
+        {'id': 'hour', 'priority': BULK, 'client': 'a', 'cost': 3600.0, 'created_at': 0.0},
+        {'id': 'song', 'priority': BULK, 'client': 'a', 'cost': 240.0, 'created_at': 1.0},
+        {'id': 'other', 'priority': BULK, 'client': 'b', 'cost': 240.0, 'created_at': 2.0},
+    ]
+
+    assert pick_next(queued, {}, now=3.0)['id'] == 'song'
+    assert pick_next(queued, {'a': 500.0}, now=3.0)['id'] == 'other'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryJobStore()
+    return SQLiteJobStore(tmp_path / "jobs.db")
+
+
+def test_stores_agree_on_the_schedule(store):
+    workload = mixed_workload()[:20]
+
+    jobs = simulate(store, workload, pick_next)
+    reference = simulate(MemoryJobStore(), workload, pick_next)
+
+    order = lambda jobs: [(job['client'], job['priority'], job['cost']) for job in
+                          sorted(jobs, key=lambda job: job['started_at'])]
+    assert order(jobs) == order(reference)
+
+
+def test_per_client_queue_cap(store):
+    queue = JobQueue(lambda params, report: {}, store, max_depth=10, max_per_client=2, retry_after=5)
+    queue.start = lambda: None
+
+    queue.submit({}, client='greedy')
+    queue.submit({}, client='greedy')
+    with pytest.raises(QueueFullError) as excinfo:
+        queue.submit({}, client='greedy')
+    assert excinfo.value.retry_after == 5
+    assert queue.submit({}, client='polite')
+
+
+def test_wait_stats_per_class(store):
+    simulate(store, mixed_workload(), pick_next)
+    queue = JobQueue(lambda params, report: {}, store, job_ttl=10 ** 10)
+
+    stats = queue.stats()
+
+    assert stats[INTERACTIVE]['started'] == 2 * len(range(60, 14400, 900))
+    assert stats[BULK]['started'] == 10
+    assert stats[INTERACTIVE]['wait_p95'] < stats[BULK]['wait_p95']
+    assert stats[BULK]['wait_max'] >= stats[BULK]['wait_p95'] >= stats[BULK]['wait_p50']
+
+
+def test_old_sqlite_database_gains_scheduling_columns(tmp_path):
+    path = tmp_path / "jobs.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE jobs (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, stage TEXT NOT NULL,
+                progress REAL NOT NULL, params TEXT NOT NULL, result TEXT NOT NULL,
+                error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL
+            )
+        """)
+        conn.execute("INSERT INTO jobs VALUES ('old', 'queued', 'queued', 0, '{}', '{}', NULL, 1, NULL, NULL)")
+
+    store = SQLiteJobStore(path)
+
+    job = store.claim()
+    assert job['id'] == 'old'
+    assert job['priority'] == BULK
+
+
+def test_link_cost_probe_gives_up_quickly_on_a_slow_host():
+    # Accepts connections but never answers
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(8)
+        url = f"http://127.0.0.1:{server.getsockname()[1]}/song.mp3"
+
+        with patch.object(separate_routes, 'COST_PROBE_TIMEOUT', 0.2):
+            start = time.perf_counter()
+            assert separate_routes.estimate_cost(url) is None
+            assert time.perf_counter() - start < 1.0
@@ -0,0 +1,99 @@
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils import scratch
+from utils.scratch import job_scratch
+
+BUCKET = 'test-bucket'
+
+
+def test_job_scratch_is_unique_and_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(scratch, 'SCRATCH_DIR', str(tmp_path))
+
+    with job_scratch() as first, job_scratch() as second:
+        assert first != second
+        assert first.parent == second.parent == tmp_path
+        (first / "download.mp3").write_bytes(b"audio")
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_job_scratch_removed_on_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(scratch, 'SCRATCH_DIR', str(tmp_path))
+
+    with pytest.raises(RuntimeError):
+        with job_scratch() as path:
+            (path / "stems").mkdir()
+            raise RuntimeError("separation failed")
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_scratch_prefers_memory_backed_dir(monkeypatch):
+    monkeypatch.setattr(scratch, 'SCRATCH_DIR', None)
+    monkeypatch.setattr(scratch, 'MEMORY_MIN_FREE', 0)
+    with patch('shutil.disk_usage', return_value=MagicMock(free=10)):
+        assert scratch.scratch_root() == scratch.MEMORY_DIR
+
+    monkeypatch.setattr(scratch, 'MEMORY_MIN_FREE', 100)
+    with patch('shutil.disk_usage', return_value=MagicMock(free=10)):
+        assert scratch.scratch_root() != scratch.MEMORY_DIR
+
+
+def test_debug_layout_uses_fixed_paths(monkeypatch):
+    monkeypatch.setattr(scratch, 'DEBUG_LAYOUT', True)
+
+    with job_scratch() as path:
+        assert path is None
+
+
+def test_same_named_jobs_do_not_collide(s3, stub_model, make_track, tmp_path, monkeypatch):
+    root = tmp_path / "scratch"
+    root.mkdir()
+    work = tmp_path / "work"
+    work.mkdir()
+    monkeypatch.chdir(work)
+    monkeypatch.setattr(scratch, 'SCRATCH_DIR', str(root))
+    tracks = {
+        'https://a.example.com/download.mp3': make_track(seconds=1.0, name="a.wav"),
+        'https://b.example.com/download.mp3': make_track(seconds=2.0, name="b.wav"),
+    }
+    output_dirs = []
+    run_separation = separate_routes.run_separation
+
+    def download(url, download_path):
+        shutil.copy(tracks[url], download_path)
+        return download_path
+
+    def record_run_separation(temp_path, *args, **kwargs):
+        output_dirs.append(kwargs['output_dir'])
+        return run_separation(temp_path, *args, **kwargs)
+
+    def run_job(url):
+        with Flask(__name__).app_context():
+            return separate_routes.process_separation_job({'link': url, 'mode': '2'}, MagicMock())
+
+    with patch.object(separate_routes, 'result_cache', None), \
+            patch.object(separate_routes, 'download_file_from_url', side_effect=download), \
+            patch.object(separate_routes, 'run_separation', side_effect=record_run_separation):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(run_job, tracks))
+
+    assert len(set(output_dirs)) == 2
+    assert all(Path(output_dir).parent.parent == root for output_dir in output_dirs)
+    assert results[0]['downloads']['vocals'] != results[1]['downloads']['vocals']
+    sizes = {
+        s3.head_object(Bucket=BUCKET, Key=result['downloads']['vocals'].split('.amazonaws.com/')[1])['ContentLength']
+        for result in results
+    }
+    assert len(sizes) == 2
+    assert list(root.iterdir()) == []
+    assert list(work.iterdir()) == []
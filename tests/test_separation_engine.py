@@ -0,0 +1,65 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+import torch
+from demucs.apply import apply_model
+
+from utils.separation_engine import load_model, separate_file, separate_tensor
+
+
+def test_model_is_loaded_once(stub_model, make_track, tmp_path):
+    track = make_track()
+
+    _, first_timings = separate_file(track, tmp_path / "first", "2")
+    _, second_timings = separate_file(track, tmp_path / "second", "2")
+
+    stub_model.assert_called_once_with("htdemucs")
+    assert second_timings["model_load_time"] == 0.0
+    assert load_model()[0] is stub_model.return_value
+
+
+def test_two_stem_layout(stub_model, make_track, tmp_path):
+    stems_files, timings = separate_file(make_track(), tmp_path / "out", "2")
+
+    assert stems_files == {
+        'vocals': str(tmp_path / "out" / "vocals.mp3"),
+        'instrumental': str(tmp_path / "out" / "no_vocals.mp3")
+    }
+    for stem_path in stems_files.values():
+        assert Path(stem_path).stat().st_size > 0
+    for key in ("model_load_time", "decode_time", "inference_time", "encode_time"):
+        assert timings[key] >= 0
+
+
+def test_four_stem_layout(stub_model, make_track, tmp_path):
+    stems_files, _ = separate_file(make_track(), tmp_path / "out", "4")
+
+    assert set(stems_files) == {'vocals', 'drums', 'bass', 'other'}
+    for stem, stem_path in stems_files.items():
+        assert Path(stem_path).name == f"{stem}.mp3"
+        assert Path(stem_path).exists()
+
+
+def test_run_separation_returns_timings(stub_model, make_track, tmp_path, monkeypatch):
+    from server.api.separate_routes import run_separation
+    monkeypatch.chdir(tmp_path)
+
+    stems_files, output_dir, separation_time, timings = run_separation(make_track(), "2")
+
+    assert output_dir == Path("separated/htdemucs/song")
+    assert set(stems_files) == {'vocals', 'instrumental'}
+    assert separation_time > 0
+    assert timings["inference_time"] >= 0
+
+
+def test_separate_tensor_matches_apply_model(stub_model):
+    model = stub_model.return_value
+    wav = torch.randn(2, int(model.samplerate * 2.7))
+    ref = wav.mean(0)
+
+    expected = apply_model(
+        model, ((wav - ref.mean()) / ref.std())[None], shifts=0, split=True, overlap=0.25
+    )[0] * ref.std() + ref.mean()
+
+    assert torch.allclose(separate_tensor(model, wav), expected, atol=1e-5)
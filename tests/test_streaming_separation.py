@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from utils.separation_engine import (load_track, separate_file_streaming, separate_tensor,
+                                     stream_sources, track_windows, window_bounds)
+
+# Runs in a fresh interpreter so ru_maxrss only reflects one streamed separation
+PEAK_RSS_SCRIPT = """
+import resource, sys
+sys.path[:0] = [{root!r}, {root!r} + '/tests']
+from unittest.mock import patch
+from conftest import StubModel
+from utils import separation_engine
+
+with patch.object(separation_engine, 'get_model', return_value=StubModel()):
+    separation_engine.separate_file_streaming({track!r}, {out!r}, "2", window_seconds=10)
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def write_long_track(path, seconds, samplerate=44100):
+    """Write a noise track block by block so the test process never holds it whole."""
+    rng = np.random.default_rng(0)
+    with sf.SoundFile(str(path), 'w', samplerate=samplerate, channels=2, subtype='PCM_16') as f:
+        for _ in range(int(seconds)):
+            f.write((0.1 * rng.standard_normal((samplerate, 2))).astype('float32'))
+    return path
+
+
+def peak_rss_kb(track, out):
+    script = PEAK_RSS_SCRIPT.format(root=str(Path(__file__).parent.parent), track=str(track), out=str(out))
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True, text=True, check=True,
+        env={**os.environ, 'STEM_MP3_PRESET': '7'}
+    )
+    return int(result.stdout.strip().splitlines()[-1])
+
+
+def test_window_bounds_cover_track_with_overlap():
+    bounds = list(window_bounds(100, 40, 10))
+
+    assert bounds == [(0, 40), (30, 70), (60, 100)]
+    assert list(window_bounds(20, 40, 10)) == [(0, 20)]
+
+
+def test_windows_read_resampled_audio(make_track):
+    track = make_track(seconds=3.0, samplerate=48000)
+    full = load_track(track, 44100, 2)
+
+    windows = list(track_windows(track, 44100, 2, 44100, 4410))
+    start = 44100 - 4410
+
+    assert sum(window.shape[-1] for window in windows) - 4410 * (len(windows) - 1) == full.shape[-1]
+    assert torch.allclose(windows[1][..., 100:-100], full[..., start + 100:start + 44100 - 100], atol=1e-3)
+
+
+def test_stream_matches_whole_track(stub_model, make_track):
+    model = stub_model.return_value
+    wav = load_track(make_track(seconds=5.0), model.samplerate, model.audio_channels)
+    windows = (wav[..., start:stop] for start, stop in window_bounds(wav.shape[-1], 2 * 44100, 44100))
+
+    streamed = torch.cat([chunk for chunk, _ in stream_sources(model, windows)], dim=-1)
+
+    assert streamed.shape == (4, 2, wav.shape[-1])
+    assert torch.allclose(streamed, separate_tensor(model, wav), atol=1e-3)
+
+
+def test_streaming_writes_every_stem(stub_model, make_track, tmp_path):
+    stems_files, timings = separate_file_streaming(make_track(seconds=3.0), tmp_path / "out", "4",
+                                                   window_seconds=2)
+
+    assert set(stems_files) == {'vocals', 'drums', 'bass', 'other'}
+    for stem_path in stems_files.values():
+        info = sf.info(stem_path)
+        assert abs(info.duration - 3.0) < 0.1
+    assert timings['inference_time'] >= 0
+
+
+def test_peak_rss_does_not_grow_with_track_length(tmp_path):
+    short = write_long_track(tmp_path / "short.wav", 60)
+    long = write_long_track(tmp_path / "long.wav", 8 * 60)
+
+    short_rss = peak_rss_kb(short, tmp_path / "short_out")
+    long_rss = peak_rss_kb(long, tmp_path / "long_out")
+
+    # A whole-track decode of 8 minutes alone would add ~150 MB, plus ~600 MB of stems
+    assert long_rss - short_rss < 50 * 1024
@@ -0,0 +1,187 @@
+import io
+import os
+import sys
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils import uploads
+from utils.job_queue import MemoryJobStore, QueueFullError
+from utils.model_registry import model_spec
+from utils.uploads import UploadTooLarge, new_upload_path, prune_uploads, save_stream
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    with patch.object(uploads, 'UPLOAD_DIR', str(tmp_path / "uploads")):
+        yield tmp_path / "uploads"
+
+
+def uploaded_files(upload_dir):
+    return sorted(path for path in upload_dir.rglob("*") if path.is_file()) if upload_dir.exists() else []
+
+
+def test_save_stream_stops_past_the_limit(upload_dir):
+    path = new_upload_path("song.wav")
+
+    with pytest.raises(UploadTooLarge):
+        save_stream(io.BytesIO(b"x" * 1000), path, max_bytes=999, chunk_size=100)
+
+    assert not path.parent.exists()
+
+
+def test_stale_uploads_are_pruned(upload_dir):
+    old, new = new_upload_path("old.wav"), new_upload_path("new.wav")
+    os.utime(old.parent, (time.time() - 7200, time.time() - 7200))
+
+    assert prune_uploads(older_than=3600) == 1
+    assert not old.parent.exists() and new.parent.exists()
+
+
+def test_m4a_upload_is_converted(upload_dir, tmp_path):
+    path = new_upload_path("song.m4a")
+    path.write_bytes(b"m4a")
+
+    def convert(input_path, output_path):
+        Path(output_path).write_bytes(b"mp3")
+        return True, 44100
+
+    with patch.object(separate_routes, 'convert_m4a_to_mp3', side_effect=convert):
+        temp_path, safe_filename, error = separate_routes.take_upload(str(path), tmp_path / "scratch")
+
+    assert error is None
+    assert (temp_path.name, safe_filename) == ("song.mp3", "song.mp3")
+    assert temp_path.read_bytes() == b"mp3"
+    assert not (tmp_path / "scratch" / "song.m4a").exists()
+    # Kept for a retry until the job is over
+    assert path.read_bytes() == b"m4a"
+
+
+def test_uploaded_job_runs_without_a_download(s3, stub_model, make_track, upload_dir):
+    path = new_upload_path("song.wav")
+    path.write_bytes(make_track(seconds=2.0).read_bytes())
+
+    with patch.object(separate_routes, 'result_cache', None), \
+            patch.object(separate_routes, 'Download', side_effect=AssertionError("downloaded")):
+        result = separate_routes.process_separation_job({'upload': str(path), 'mode': '2'}, MagicMock())
+
+    assert sorted(result['downloads']) == ['instrumental', 'vocals']
+    assert result['downloads']['vocals'].endswith('/vocals_song.mp3')
+    assert uploaded_files(upload_dir) == []
+
+
+class TestUploadRoutes:
+
+    @pytest.fixture(autouse=True)
+    def client(self, upload_dir):
+        from server import app
+        self.queue = separate_routes.separation_queue
+        self.upload_dir = upload_dir
+        # Keep the jobs queued
+        with patch.object(self.queue, 'store', MemoryJobStore()), \
+                patch.object(self.queue.store, 'claim', return_value=None), \
+                patch.object(separate_routes, 'ensure_ffmpeg', return_value=True):
+            with app.test_client() as client:
+                self.client = client
+                yield
+
+    def params(self, response):
+        assert response.status_code == 202, response.json
+        return self.queue.store.get(response.json['job_id'])['params']
+
+    def test_multipart_file_goes_straight_to_the_upload_dir(self):
+        with patch.object(separate_routes, 'save_stream') as save_stream:
+            response = self.client.post("/api/separate", data={
+                'file': (io.BytesIO(b"RIFF" * 1000), "My Song.wav"),
+                'mode': '4'
+            })
+
+        params = self.params(response)
+        save_stream.assert_not_called()
+        assert 'link' not in params and params['mode'] == '4'
+        assert Path(params['upload']).name == "My_Song.wav"
+        assert Path(params['upload']).read_bytes() == b"RIFF" * 1000
+        assert uploaded_files(self.upload_dir) == [Path(params['upload'])]
+
+    def test_only_the_audio_part_is_kept(self):
+        response = self.client.post("/api/separate", data={
+            'file': (io.BytesIO(b"RIFF"), "song.wav"),
+            'cover': (io.BytesIO(b"JPEG"), "cover.jpg")
+        })
+
+        assert uploaded_files(self.upload_dir) == [Path(self.params(response)['upload'])]
+
+    def test_other_routes_keep_their_files_out_of_the_upload_dir(self):
+        response = self.client.post("/api/separate/batch", data={'manifest': (io.BytesIO(b""), "manifest.txt")})
+
+        assert response.status_code == 400
+        assert uploaded_files(self.upload_dir) == []
+
+    def test_raw_body_with_fields_in_the_query(self):
+        response = self.client.post("/api/separate?mode=4&format=flac", data=b"ID3" * 1000,
+                                    content_type='audio/mpeg', headers={'X-Filename': 'track.mp3'})
+
+        params = self.params(response)
+        assert (params['mode'], params['format']) == ('4', 'flac')
+        assert Path(params['upload']).name == "track.mp3"
+        assert Path(params['upload']).read_bytes() == b"ID3" * 1000
+
+    def test_raw_body_is_named_by_its_content_type(self):
+        response = self.client.post("/api/separate", data=b"m4a", content_type='audio/x-m4a')
+
+        assert Path(self.params(response)['upload']).name == "upload.m4a"
+
+    @pytest.mark.parametrize('request_options', [
+        {'data': {'file': (io.BytesIO(b"x"), "notes.txt")}},
+        {'data': b"x", 'content_type': 'application/octet-stream'},
+        {'data': b"x", 'content_type': 'audio/ogg', 'query_string': {'filename': 'song.exe'}},
+    ])
+    def test_other_files_are_rejected(self, request_options):
+        response = self.client.post("/api/separate", **request_options)
+
+        assert response.status_code == 400
+        assert uploaded_files(self.upload_dir) == []
+
+    def test_empty_upload_is_rejected(self):
+        response = self.client.post("/api/separate", data={'file': (io.BytesIO(b""), "song.wav")})
+
+        assert response.status_code == 400
+        assert uploaded_files(self.upload_dir) == []
+
+    @pytest.mark.parametrize('multipart', [True, False])
+    def test_oversized_upload_is_refused(self, multipart):
+        body = b"x" * 2000
+        options = ({'data': {'file': (io.BytesIO(body), "song.wav")}} if multipart
+                   else {'data': body, 'content_type': 'audio/wav'})
+
+        with patch.object(separate_routes, 'MAX_BYTES', 1000):
+            response = self.client.post("/api/separate", **options)
+
+        assert response.status_code == 413
+        assert uploaded_files(self.upload_dir) == []
+
+    def test_upload_is_dropped_when_the_queue_is_full(self):
+        with patch.object(self.queue, 'submit', side_effect=QueueFullError(8, 30)):
+            response = self.client.post("/api/separate", data={'file': (io.BytesIO(b"RIFF"), "song.wav")})
+
+        assert response.status_code == 429
+        assert uploaded_files(self.upload_dir) == []
+
+    def test_upload_cost_is_its_probed_duration(self, make_track):
+        track = make_track(seconds=3.0).read_bytes()
+
+        response = self.client.post("/api/separate", data={'file': (io.BytesIO(track), "song.wav")})
+
+        job = self.queue.store.get(response.json['job_id'])
+        assert job['cost'] == pytest.approx(3.0 * model_spec(job['params']['model']).relative_cost)
+
+    def test_links_still_work(self):
+        with patch.object(separate_routes, 'estimate_cost', return_value=None):
+            response = self.client.post("/api/separate", data={'link': 'https://example.com/a.mp3'})
+
+        params = self.params(response)
+        assert params['link'] == 'https://example.com/a.mp3' and 'upload' not in params
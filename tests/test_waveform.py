@@ -0,0 +1,123 @@
+import math
+import sqlite3
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+sys.path.append(str(Path(__file__).parent.parent))
+from server.api import separate_routes
+from utils.result_cache import ResultCache
+from utils.s3_client import object_key
+from utils.separation_engine import separate_file, separate_file_streaming, write_stem
+from utils.waveform import PeakBuilder, peaks_path, read_peaks
+
+BUCKET = 'test-bucket'
+
+
+def test_peaks_of_every_level_match_a_direct_computation():
+    wav = np.random.default_rng(0).uniform(-1, 1, (2, 10000)).astype(np.float32)
+
+    builder = PeakBuilder(44100, levels=[64, 256])
+    for start in range(0, wav.shape[1], 777):
+        builder.add(wav[:, start:start + 777])
+    peaks = builder.peaks()
+
+    for level in (64, 256):
+        mins, maxs = peaks[level]
+        assert len(mins) == math.ceil(10000 / level)
+        for index in (0, len(mins) // 2, len(mins) - 1):
+            block = wav[:, index * level:(index + 1) * level]
+            assert (mins[index], maxs[index]) == (block.min(), block.max())
+
+
+def test_levels_must_share_the_finest_block():
+    with pytest.raises(ValueError):
+        PeakBuilder(44100, levels=[256, 1000])
+
+
+def test_sidecar_round_trip(tmp_path):
+    t = np.arange(44100) / 44100
+    wav = np.stack([0.5 * np.sin(2 * np.pi * 5 * t), -0.25 * np.ones_like(t)])
+    builder = PeakBuilder(44100, levels=[256, 1024])
+    builder.add(wav)
+
+    builder.write(tmp_path / "vocals.peaks.dat")
+    levels = read_peaks(tmp_path / "vocals.peaks.dat")
+
+    assert list(levels) == [256, 1024]
+    mins, maxs = levels[1024]
+    assert len(mins) == 44
+    assert mins.min() == pytest.approx(-0.5, abs=0.01)
+    assert maxs.max() == pytest.approx(0.5, abs=0.01)
+    # 8 bit min/max pairs: a second of audio at 256 samples per peak is about 350 bytes
+    assert (tmp_path / "vocals.peaks.dat").stat().st_size < 500
+
+
+@pytest.mark.parametrize('separate', [separate_file, separate_file_streaming])
+def test_stems_get_peaks_sidecars(stub_model, make_track, tmp_path, separate):
+    sidecars = []
+
+    stems, _ = separate(make_track(seconds=3.0), tmp_path / "out", "2",
+                        on_stem=lambda stem, path: sidecars.append(peaks_path(path).exists()))
+
+    assert sidecars == [True, True]
+    for path in stems.values():
+        mins, maxs = read_peaks(peaks_path(path))[256]
+        assert len(mins) == math.ceil(3 * 44100 / 256)
+        assert (mins <= maxs).all()
+
+
+def test_peaks_follow_stems_scaled_below_full_scale(tmp_path):
+    t = np.arange(44100) / 44100
+    wav = np.stack([2.0 * np.sin(2 * np.pi * 5 * t)] * 2)
+
+    write_stem(tmp_path / "vocals.wav", wav, 44100)
+
+    audio, _ = sf.read(str(tmp_path / "vocals.wav"))
+    mins, maxs = read_peaks(peaks_path(tmp_path / "vocals.wav"))[256]
+    assert maxs.max() == pytest.approx(audio.max(), abs=0.01)
+    assert mins.min() == pytest.approx(audio.min(), abs=0.01)
+
+
+def test_no_sidecars_when_disabled(stub_model, make_track, tmp_path):
+    stems, _ = separate_file(make_track(seconds=2.0), tmp_path / "out", "2", peaks=False)
+
+    assert not any(peaks_path(path).exists() for path in stems.values())
+
+
+def test_job_returns_waveform_urls(s3, stub_model, make_track, tmp_path):
+    cache = ResultCache(tmp_path / "cache.db")
+
+    with patch.object(separate_routes, 'result_cache', cache), \
+            patch.object(separate_routes, 'prepare_audio_file',
+                         side_effect=lambda url, scratch=None: (make_track(seconds=2.0), "song.wav", None)):
+        fresh, cached = [separate_routes.process_separation_job(
+            {'link': 'https://example.com/song.wav', 'mode': '2'}, MagicMock()
+        ) for _ in range(2)]
+
+    assert sorted(fresh['waveforms']) == ['instrumental', 'vocals']
+    assert fresh['waveforms']['vocals'].endswith('/vocals_song.peaks.dat')
+    assert cached['cached'] and cached['waveforms'] == fresh['waveforms']
+    body = s3.get_object(Bucket=BUCKET, Key=object_key(fresh['waveforms']['vocals'], BUCKET))['Body'].read()
+    assert body[:4] == (2).to_bytes(4, 'little')
+
+
+def test_cache_written_before_waveforms_still_opens(tmp_path):
+    path = tmp_path / "cache.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE results (key TEXT PRIMARY KEY, downloads TEXT NOT NULL, size_bytes INTEGER NOT NULL,
+                                  separation_time REAL NOT NULL, created_at REAL NOT NULL,
+                                  last_used_at REAL NOT NULL)
+        """)
+        conn.execute("INSERT INTO results VALUES ('old', '{}', 1, 0, 9e9, 9e9)")
+
+    cache = ResultCache(path)
+
+    assert cache.get('old')['waveforms'] == {}
+    cache.put('new', {'vocals': 'a'}, 1, waveforms={'vocals': 'b'})
+    assert cache.get('new')['waveforms'] == {'vocals': 'b'}
@@ -0,0 +1,265 @@
+import json
+import math
+import subprocess
+from collections import namedtuple
+from pathlib import Path
+
+import julius
+import lameenc
+import numpy as np
+import soundfile as sf
+import torch
+
+AudioInfo = namedtuple('AudioInfo', ['samplerate', 'channels', 'frames', 'duration', 'format'])
+
+# Containers libsndfile has no decoder for and that always need ffmpeg
+FFMPEG_ONLY = {'.m4a', '.mp4', '.aac', '.wma', '.webm'}
+
+# Stem output format -> (file extension, content type)
+OUTPUT_FORMATS = {
+    'mp3': ('.mp3', 'audio/mpeg'),
+    'opus': ('.opus', 'audio/ogg'),
+    'flac': ('.flac', 'audio/flac'),
+    'wav': ('.wav', 'audio/wav'),
+}
+CONTENT_TYPES = dict(OUTPUT_FORMATS.values())
+# Bitrate range and default in kbps of the lossy formats
+BITRATES = {'mp3': (96, 320), 'opus': (32, 256)}
+DEFAULT_BITRATES = {'mp3': 320, 'opus': 128}
+# Formats whose files are never rewritten once written, so partial files can be uploaded
+APPEND_ONLY = {'.mp3', '.opus'}
+DEFAULT_OUTPUT = 'mp3-320'
+OPUS_SAMPLERATE = 48000
+
+
+def _sf_source(path):
+    """What libsndfile opens: file objects as they are, anything else as a path string."""
+    return path if hasattr(path, 'read') else str(path)
+
+
+def _needs_ffmpeg(path):
+    return not hasattr(path, 'read') and Path(path).suffix.lower() in FFMPEG_ONLY
+
+
+def content_type(path, default='application/octet-stream'):
+    """Content type of an audio file from its extension."""
+    return CONTENT_TYPES.get(Path(path).suffix.lower(), default)
+
+
+def output_tag(output_format, bitrate=None):
+    """Short name of an output format and bitrate, like `mp3-320` or `flac`."""
+    if output_format not in BITRATES:
+        return output_format
+    return f"{output_format}-{bitrate or DEFAULT_BITRATES[output_format]}"
+
+
+def probe(path):
+    """Return the `AudioInfo` of `path`, read in-process when libsndfile knows the format."""
+    if not _needs_ffmpeg(path):
+        try:
+            info = sf.info(_sf_source(path))
+            return AudioInfo(info.samplerate, info.channels, info.frames, info.duration,
+                             info.format.lower())
+        except RuntimeError:
+            if hasattr(path, 'read'):
+                raise
+    return _ffprobe(path)
+
+
+def decode(path, samplerate=None, channels=None, offset=None, duration=None):
+    """Decode `path` into a float32 `[channels, frames]` array.
+
+    Returns `(wav, samplerate)`. libsndfile decodes in-process at the file's
+    own rate; other formats are piped out of a single ffmpeg process, which
+    converts to `samplerate` and `channels` on the way when they are given.
+    File objects, e.g. a download still in progress, only go through libsndfile.
+    `offset` and `duration`, in seconds, decode only that part of the track.
+    """
+    if not _needs_ffmpeg(path):
+        try:
+            with sf.SoundFile(_sf_source(path)) as f:
+                if offset:
+                    f.seek(min(int(offset * f.samplerate), f.frames))
+                frames = -1 if duration is None else int(round(duration * f.samplerate))
+                data = f.read(frames, dtype='float32', always_2d=True)
+                return np.ascontiguousarray(data.T), f.samplerate
+        except RuntimeError:
+            if hasattr(path, 'read'):
+                raise
+    return _ffmpeg_decode(path, samplerate, channels, offset, duration)
+
+
+def fit_full_scale(wav):
+    """Return `wav` as float32, scaled down when it peaks above full scale rather than clipped."""
+    wav = np.asarray(wav, dtype=np.float32)
+    peak = np.abs(wav).max() if wav.size else 0.0
+    return wav / max(1.01 * peak, 1)
+
+
+def encode(path, wav, samplerate, bitrate=320, preset=2):
+    """Write a float `[channels, frames]` array to `path`, in the format of its extension.
+
+    Audio peaking above full scale is scaled down rather than clipped.
+    """
+    wav = fit_full_scale(wav)
+    writer = open_stem_writer(path, samplerate, wav.shape[0], bitrate, preset)
+    writer.write(wav)
+    writer.close()
+
+
+def open_stem_writer(path, samplerate, channels, bitrate=None, preset=2):
+    """Incremental stem writer for the format of `path`'s extension."""
+    if Path(path).suffix.lower() == '.mp3':
+        return Mp3StemWriter(path, samplerate, channels, bitrate or DEFAULT_BITRATES['mp3'], preset)
+    return SoundFileStemWriter(path, samplerate, channels, bitrate)
+
+
+class Mp3StemWriter:
+    """Encodes a stem to MP3 chunk by chunk as it is produced."""
+
+    def __init__(self, path, samplerate, channels, bitrate=320, preset=2):
+        self.encoder = lameenc.Encoder()
+        self.encoder.set_bit_rate(bitrate)
+        self.encoder.set_in_sample_rate(samplerate)
+        self.encoder.set_channels(channels)
+        self.encoder.set_quality(preset)
+        self.encoder.silence()
+        self.file = open(path, 'wb')
+
+    def write(self, wav):
+        # No global peak is known while streaming, so clamp instead of rescaling
+        pcm = (np.clip(np.asarray(wav), -1, 1) * (2 ** 15 - 1)).astype(np.int16)
+        self.file.write(self.encoder.encode(np.ascontiguousarray(pcm.T).tobytes()))
+        self.file.flush()
+
+    def close(self):
+        self.file.write(self.encoder.flush())
+        self.file.close()
+
+
+def opus_compression_level(bitrate, channels):
+    """libsndfile compression level giving about `bitrate` kbps of Opus."""
+    # libsndfile spreads the level linearly from 256 kbps per channel down to 6 kbps
+    highest = 256000 * channels
+    level = 1 - (bitrate * 1000 - 6000) / (highest - 6000)
+    return min(max(level, 0.0), 1.0)
+
+
+class SoundFileStemWriter:
+    """Writes a stem chunk by chunk through libsndfile.
+
+    FLAC and WAV are 24 bit. Opus only takes 48 kHz, so other rates are
+    resampled on the way with a `StreamResampler`.
+    """
+
+    def __init__(self, path, samplerate, channels, bitrate=None):
+        self.resampler = None
+        if Path(path).suffix.lower() == '.opus':
+            options = {
+                'format': 'OGG',
+                'subtype': 'OPUS',
+                'compression_level': opus_compression_level(bitrate or DEFAULT_BITRATES['opus'], channels)
+            }
+            if samplerate != OPUS_SAMPLERATE:
+                self.resampler = StreamResampler(samplerate, OPUS_SAMPLERATE)
+                samplerate = OPUS_SAMPLERATE
+        else:
+            options = {'subtype': 'PCM_24'}
+        self.file = sf.SoundFile(str(path), 'w', samplerate, channels, **options)
+
+    def write(self, wav):
+        wav = np.clip(np.asarray(wav, dtype=np.float32), -1, 1)
+        if self.resampler:
+            wav = self.resampler.process(wav)
+        self.file.write(wav.T)
+        self.file.flush()
+
+    def close(self):
+        if self.resampler:
+            self.file.write(self.resampler.flush().T)
+        self.file.close()
+
+
+class StreamResampler:
+    """Resamples `[channels, frames]` chunks with the same result as resampling the whole.
+
+    Input is consumed in whole blocks of the rate ratio, and every block is
+    resampled with `context` samples of the signal on either side, so the
+    output lags the input by `context` samples until `flush`.
+    """
+
+    def __init__(self, old_sr, new_sr, context=1024):
+        gcd = math.gcd(old_sr, new_sr)
+        self.old = old_sr // gcd
+        self.new = new_sr // gcd
+        self.context = self.old * math.ceil(context / self.old)
+        self.history = None
+        self.pending = None
+
+    def process(self, wav, final=False):
+        wav = np.asarray(wav, dtype=np.float32)
+        data = wav if self.pending is None else np.concatenate([self.pending, wav], axis=-1)
+        history = self.history if self.history is not None else data[:, :0]
+        if final:
+            ready, end = data.shape[-1], data.shape[-1]
+        else:
+            ready = max(data.shape[-1] - self.context, 0)
+            ready -= ready % self.old
+            end = ready + self.context
+        if ready == 0:
+            self.pending = data
+            return data[:, :0]
+
+        window = np.concatenate([history, data[:, :end]], axis=-1)
+        out = julius.resample_frac(torch.from_numpy(window), self.old, self.new).numpy()
+        skip = history.shape[-1] * self.new // self.old
+        count = out.shape[-1] - skip if final else ready * self.new // self.old
+        self.history = np.concatenate([history, data[:, :ready]], axis=-1)[:, -self.context:]
+        self.pending = data[:, ready:]
+        return out[:, skip:skip + count]
+
+    def flush(self):
+        if self.pending is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self.process(self.pending[:, :0], final=True)
+
+
+def _ffprobe(path):
+    command = [
+        'ffprobe', '-v', 'error', '-print_format', 'json',
+        '-show_streams', '-show_format', '-select_streams', 'a:0', str(path)
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        raise RuntimeError(f"Could not probe {path}: {e}") from e
+    data = json.loads(result.stdout)
+    if not data.get('streams'):
+        raise RuntimeError(f"No audio stream in {path}")
+    stream = data['streams'][0]
+    samplerate = int(stream['sample_rate'])
+    duration = float(stream.get('duration') or data.get('format', {}).get('duration') or 0)
+    return AudioInfo(samplerate, int(stream['channels']), int(duration * samplerate), duration,
+                     data.get('format', {}).get('format_name', stream.get('codec_name', '')))
+
+
+def _ffmpeg_decode(path, samplerate=None, channels=None, offset=None, duration=None):
+    if samplerate is None or channels is None:
+        info = _ffprobe(path)
+        samplerate = samplerate or info.samplerate
+        channels = channels or info.channels
+    window = []
+    if offset:
+        window += ['-ss', f"{offset:.6f}"]
+    if duration is not None:
+        window += ['-t', f"{duration:.6f}"]
+    command = [
+        'ffmpeg', '-v', 'error', '-nostdin', *window, '-i', str(path), '-map', '0:a:0',
+        '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(channels), '-ar', str(samplerate), '-'
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        raise RuntimeError(f"Could not decode {path}: {e}") from e
+    wav = np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, channels)
+    return np.ascontiguousarray(wav.T), samplerate
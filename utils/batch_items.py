@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from utils.job_queue import DONE, FAILED
+
+load_dotenv()
+
+
+def _finished_at(status, now):
+    return now if status in (DONE, FAILED) else None
+
+
+def _totals(statuses):
+    return {
+        'total': len(statuses),
+        'done': sum(1 for status in statuses if status == DONE),
+        'failed': sum(1 for status in statuses if status == FAILED)
+    }
+
+
+class MemoryItemStore:
+    """Keeps batch items in this process only; fine for a single worker.
+
+    `items(batch_id, finished_since)` returns the items that finished since
+    that time only, for streaming what is new.
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._finished = {}
+        self._created = {}
+        self._lock = threading.Lock()
+
+    def add(self, batch_id, items):
+        with self._lock:
+            now = time.time()
+            self._items[batch_id] = {item['index']: dict(item) for item in items}
+            self._finished[batch_id] = {item['index']: _finished_at(item['status'], now) for item in items}
+            self._created[batch_id] = now
+
+    def update(self, batch_id, index, **fields):
+        with self._lock:
+            item = self._items[batch_id][index]
+            item.update(fields)
+            self._finished[batch_id][index] = _finished_at(item['status'], time.time())
+
+    def items(self, batch_id, finished_since=None):
+        with self._lock:
+            items = self._items.get(batch_id, {})
+            finished = self._finished.get(batch_id, {})
+            return [dict(item) for index, item in sorted(items.items())
+                    if finished_since is None or (finished[index] is not None and finished[index] >= finished_since)]
+
+    def totals(self, batch_id):
+        with self._lock:
+            return _totals([item['status'] for item in self._items.get(batch_id, {}).values()])
+
+    def batches(self, created_before):
+        with self._lock:
+            return [batch_id for batch_id, created in self._created.items() if created < created_before]
+
+    def delete(self, batch_id):
+        with self._lock:
+            self._items.pop(batch_id, None)
+            self._finished.pop(batch_id, None)
+            self._created.pop(batch_id, None)
+
+
+class SQLiteItemStore:
+    """Keeps batch items in a SQLite file, one row each, shared by every gunicorn worker.
+
+    Finishing an item rewrites its own row only, whatever the size of its batch.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS batch_items (
+                    batch_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    finished_at REAL,
+                    PRIMARY KEY (batch_id, idx)
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return closing(conn)
+
+    def add(self, batch_id, items):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO batch_items (batch_id, idx, status, item, created_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(batch_id, item['index'], item['status'], json.dumps(item), now, _finished_at(item['status'], now))
+                 for item in items]
+            )
+            conn.execute("COMMIT")
+
+    def update(self, batch_id, index, **fields):
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT item FROM batch_items WHERE batch_id = ? AND idx = ?", (batch_id, index)
+            ).fetchone()
+            item = {**json.loads(row['item']), **fields}
+            conn.execute(
+                "UPDATE batch_items SET status = ?, item = ?, finished_at = ? WHERE batch_id = ? AND idx = ?",
+                (item['status'], json.dumps(item), _finished_at(item['status'], time.time()), batch_id, index)
+            )
+            conn.execute("COMMIT")
+
+    def items(self, batch_id, finished_since=None):
+        query = "SELECT item FROM batch_items WHERE batch_id = ?"
+        args = [batch_id]
+        if finished_since is not None:
+            query += " AND finished_at >= ?"
+            args.append(finished_since)
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY idx", args).fetchall()
+        return [json.loads(row['item']) for row in rows]
+
+    def totals(self, batch_id):
+        with self._lock, self._connect() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM batch_items WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall())
+        return {'total': sum(counts.values()), 'done': counts.get(DONE, 0), 'failed': counts.get(FAILED, 0)}
+
+    def batches(self, created_before):
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT batch_id FROM batch_items WHERE created_at < ?", (created_before,)
+            ).fetchall()
+        return [row['batch_id'] for row in rows]
+
+    def delete(self, batch_id):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM batch_items WHERE batch_id = ?", (batch_id,))
+
+
+def create_item_store(path=None):
+    """Build the batch item store matching `JOB_QUEUE_BACKEND` (sqlite or memory).
+
+    SQLite stores live at `path`, by default `SEPARATION_BATCH_DB`.
+    """
+    if os.getenv('JOB_QUEUE_BACKEND', 'sqlite') == 'memory':
+        return MemoryItemStore()
+    return SQLiteItemStore(path or os.getenv('SEPARATION_BATCH_DB', 'temp/batches.db'))
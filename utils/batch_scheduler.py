@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+
+class BatchScheduler:
+    """Runs inference segments from concurrent jobs through the model in shared batches.
+
+    Jobs submit equal length segments under a key naming the model. A single
+    background thread stacks up to `max_batch_size` segments with the same key,
+    runs them with `run_batch(model, batch)` and hands every output back to the
+    job that submitted it. A partial batch is run once its oldest segment has
+    waited `max_wait` seconds.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.05):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.segments = 0
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, key, model, segment):
+        """Queue one `[channels, samples]` segment and return a Future of its output."""
+        future = Future()
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            self._pending.setdefault(key, deque()).append((model, segment, future, time.monotonic()))
+            self._condition.notify()
+        return future
+
+    def run(self, key, model, segments, lookahead=None):
+        """Yield the outputs of `segments` in order.
+
+        Up to `lookahead` segments (twice the batch size by default) are kept
+        in flight, so a lone job still fills batches while the memory held by
+        one job stays bounded.
+        """
+        lookahead = lookahead or 2 * self.max_batch_size
+        in_flight = deque()
+        for segment in segments:
+            in_flight.append(self.submit(key, model, segment))
+            if len(in_flight) >= lookahead:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def stats(self):
+        """Return how many batches ran and their mean size."""
+        return {
+            'batches': self.batches,
+            'segments': self.segments,
+            'mean_batch_size': self.segments / self.batches if self.batches else 0.0
+        }
+
+    def _next_batch(self):
+        """Pop the next ready batch, or return the seconds until one is due."""
+        now = time.monotonic()
+        next_due = None
+        for key, queue in self._pending.items():
+            due = queue[0][3] + self.max_wait
+            if len(queue) >= self.max_batch_size or due <= now:
+                batch = [queue.popleft() for _ in range(min(self.max_batch_size, len(queue)))]
+                if not queue:
+                    del self._pending[key]
+                return batch, None
+            next_due = due if next_due is None else min(next_due, due)
+        return None, (None if next_due is None else next_due - now)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                batch, timeout = self._next_batch()
+                while batch is None:
+                    self._condition.wait(timeout)
+                    batch, timeout = self._next_batch()
+
+            model = batch[0][0]
+            futures = [future for _, _, future, _ in batch]
+            try:
+                outputs = self.run_batch(model, torch.stack([segment for _, segment, _, _ in batch]))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.segments += len(batch)
+            for future, output in zip(futures, outputs):
+                future.set_result(output)
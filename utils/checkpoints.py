@@ -0,0 +1,174 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Seconds a checkpoint no job touched is kept for a retry
+CHECKPOINT_TTL = int(os.getenv('SEPARATION_CHECKPOINT_TTL', str(24 * 3600)))
+
+
+def _claim(path):
+    """Lock the file at `path` without waiting; return its handle, or None while another job holds it."""
+    while True:
+        handle = open(path, 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return None
+        # The holder deletes the file before letting go, so only a lock on the file still there counts
+        try:
+            if os.stat(path).st_ino == os.fstat(handle.fileno()).st_ino:
+                return handle
+        except FileNotFoundError:
+            pass
+        handle.close()
+
+
+def _release(path, handle):
+    """Delete the lock file at `path` and let go of it."""
+    Path(path).unlink(missing_ok=True)
+    handle.close()
+
+
+class Checkpoint:
+    """Finished audio of one separation, saved chunk by chunk as it comes out.
+
+    Chunks hold the job's stems after overlap-add, `[stems, channels,
+    samples]` arrays under `<directory>/<index>.npy`, and `samples` counts
+    the audio they cover. A job that was cut short replays them and only
+    separates the rest. `save` can keep a `state` with a chunk, such as the
+    crossfade tail a streamed separation carries into its next window; only
+    the state of the last chunk is kept. Audio stays at full precision so a
+    resumed job writes the same stems as an uninterrupted one.
+
+    With a `lock` handle from `CheckpointStore.open` the checkpoint is the
+    job's own until `finish` or `close`.
+    """
+
+    def __init__(self, directory, lock=None):
+        self.directory = Path(directory)
+        self.lock = lock
+        self.saved = 0
+        self.samples = 0
+        while self._path(self.saved).exists():
+            self.samples += np.load(self._path(self.saved), mmap_mode='r').shape[-1]
+            self.saved += 1
+        self.resumed = 0
+
+    def _path(self, index, kind=''):
+        return self.directory / f"{index}{kind}.npy"
+
+    def _write(self, path, array):
+        partial = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(partial, 'wb') as f:
+            np.save(f, array.detach().cpu().numpy())
+        os.replace(partial, path)
+
+    def chunks(self):
+        """Yield the chunks saved so far as tensors, in order."""
+        for index in range(self.saved):
+            chunk = torch.from_numpy(np.load(self._path(index)))
+            self.resumed += chunk.shape[-1]
+            yield chunk
+
+    def state(self):
+        """Return the state saved with the last chunk, or None."""
+        path = self._path(self.saved - 1, '.state')
+        return torch.from_numpy(np.load(path)) if self.saved and path.exists() else None
+
+    def save(self, chunk, state=None):
+        """Save the next `chunk`, with the `state` needed to carry on after it."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # The chunk is what marks the state as current, so the state goes first
+        if state is not None:
+            self._write(self._path(self.saved, '.state'), state)
+        self._write(self._path(self.saved), chunk)
+        self._path(self.saved - 1, '.state').unlink(missing_ok=True)
+        self.saved += 1
+        self.samples += chunk.shape[-1]
+        # Keeps the checkpoint of a running job from being pruned
+        os.utime(self.directory)
+
+    def finish(self):
+        """Delete the checkpoint once its separation is complete."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.close()
+
+    def close(self):
+        """Leave the checkpoint to the next job on the same audio."""
+        if self.lock:
+            _release(self.lock.name, self.lock)
+            self.lock = None
+
+
+class CheckpointStore:
+    """Checkpoints of separations in progress, under `<root>/<key>/`.
+
+    A job that dies, whether it failed, hit the gunicorn timeout or went
+    down with a redeploy, leaves its checkpoint behind; the next job on the
+    same audio and model picks it up. A job holds `<root>/<key>.lock` while
+    it uses a checkpoint, so concurrent jobs on the same audio never write
+    or delete each other's chunks. Checkpoints nobody touched for `ttl`
+    seconds are pruned.
+    """
+
+    def __init__(self, root, ttl=CHECKPOINT_TTL):
+        self.root = Path(os.path.abspath(root))
+        self.ttl = ttl
+
+    @staticmethod
+    def key(audio_hash, model_name, layout):
+        """Checkpoint key: chunks only line up for the same audio, model and stems, cut the same way."""
+        return f"{audio_hash}-{model_name}-{layout}"
+
+    def open(self, key):
+        """Return the checkpoint of `key`, with whatever an earlier attempt saved.
+
+        Returns None while another job holds it; that job keeps it and this
+        one runs without a checkpoint.
+        """
+        self.prune()
+        self.root.mkdir(parents=True, exist_ok=True)
+        lock = _claim(self.root / f"{key}.lock")
+        return Checkpoint(self.root / key, lock) if lock else None
+
+    def prune(self, older_than=None):
+        """Delete checkpoints untouched for `ttl` seconds and return how many."""
+        cutoff = time.time() - (self.ttl if older_than is None else older_than)
+        pruned = 0
+        try:
+            directories = list(self.root.iterdir())
+        except FileNotFoundError:
+            return 0
+        for directory in directories:
+            if directory.suffix == '.lock':
+                continue
+            try:
+                if directory.stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            # Checkpoints a job still holds are left alone
+            lock_path = directory.with_name(f"{directory.name}.lock")
+            lock = _claim(lock_path)
+            if lock:
+                shutil.rmtree(directory, ignore_errors=True)
+                _release(lock_path, lock)
+                pruned += 1
+        return pruned
+
+
+def create_checkpoint_store():
+    """Build the store configured by the `SEPARATION_CHECKPOINT_*` env vars, or None unless enabled."""
+    if os.getenv('SEPARATION_CHECKPOINTS', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    return CheckpointStore(os.getenv('SEPARATION_CHECKPOINT_DIR', 'temp/checkpoints'))
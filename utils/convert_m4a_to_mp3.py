@@ -1,25 +1,13 @@
-from utils.get_audio_info import get_audio_info
+from utils.audio_io import decode, encode
 
 def convert_m4a_to_mp3(input_path, output_path):
-    """Convert M4A file to MP3 format using ffmpeg"""
-    import subprocess
-        
-    # Get original sample rate
-    original_sample_rate = get_audio_info(input_path)
-    print(f"Detected original sample rate: {original_sample_rate} Hz")
-    
+    """Convert M4A file to MP3 format, keeping the original sample rate"""
     try:
-        # Use ffmpeg to convert M4A to MP3
-        subprocess.run([
-            'ffmpeg',
-            '-i', input_path,  # Input file
-            '-acodec', 'libmp3lame',  # Use MP3 codec
-            '-ab', '320k',  # Set bitrate to 320kbps
-            '-ar', str(original_sample_rate),
-            '-y',  # Overwrite output file if it exists
-            output_path
-        ], check=True)
+        # A single ffmpeg process decodes the M4A; the MP3 is encoded in-process
+        wav, original_sample_rate = decode(input_path)
+        print(f"Detected original sample rate: {original_sample_rate} Hz")
+        encode(output_path, wav, original_sample_rate, bitrate=320)
         return True, original_sample_rate
-    except subprocess.CalledProcessError as e:
+    except RuntimeError as e:
         print(f"Error converting file: {str(e)}")
-        return False, None
\ No newline at end of file
+        return False, None
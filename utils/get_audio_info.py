@@ -1,21 +1,29 @@
+from utils.audio_io import probe
+
 def get_audio_info(input_path):
-    """Get audio sample rate using ffprobe"""
-    import subprocess
-    import json
-    
-    cmd = [
-        'ffprobe',
-        '-v', 'quiet',
-        '-print_format', 'json',
-        '-show_streams',
-        input_path
-    ]
-    
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    data = json.loads(result.stdout)
-    
-    for stream in data['streams']:
-        if stream['codec_type'] == 'audio':
-            return int(stream['sample_rate'])
-    
-    return 44100  # fallback to CD quality if detection fails
\ No newline at end of file
+    """Get audio sample rate, read in-process unless the format needs ffprobe"""
+    try:
+        return probe(input_path).samplerate
+    except RuntimeError:
+        return 44100  # fallback to CD quality if detection fails
+
+# Typical bytes per second of audio, to guess a duration from a file size
+BYTES_PER_SECOND = {
+    '.wav': 176400,
+    '.flac': 100000,
+    '.mp3': 24000,
+    '.ogg': 20000,
+    '.m4a': 24000
+}
+
+def get_audio_duration(input_path):
+    """Get audio duration in seconds, or None when it can't be read"""
+    try:
+        return probe(input_path).duration
+    except RuntimeError:
+        return None
+
+def estimate_duration(size_bytes, filename):
+    """Guess the duration of a file from its size and extension, before it is downloaded"""
+    extension = '.' + filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return size_bytes / BYTES_PER_SECOND.get(extension, BYTES_PER_SECOND['.mp3'])
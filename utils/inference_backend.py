@@ -0,0 +1,146 @@
+import os
+from pathlib import Path
+
+import demucs
+import torch
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# '+' separated optimizations applied to loaded models:
+#  - int8: dynamic int8 quantization of the Linear and LSTM layers, which
+#    covers the transformer of htdemucs (CPU only)
+#  - torchscript: a TorchScript trace for the inference segment length
+#  - compile: torch.compile, with inductor's on-disk cache under the cache dir
+# There is no ONNX option: Demucs runs its spectrogram branch through complex
+# STFT/ISTFT, which the ONNX exporter can't express.
+BACKEND = os.getenv('INFERENCE_BACKEND', 'eager')
+# Built backends are kept here so later starts only load them
+CACHE_DIR = os.getenv('INFERENCE_BACKEND_CACHE', 'temp/backends')
+
+OPTIMIZATIONS = ('int8', 'torchscript', 'compile')
+QUANTIZED_LAYERS = {torch.nn.Linear, torch.nn.LSTM}
+
+
+def parse_backend(spec):
+    """Return the set of optimizations in a backend spec like `int8+torchscript`."""
+    parts = {part.strip() for part in (spec or '').lower().split('+')} - {'', 'eager'}
+    unknown = parts - set(OPTIMIZATIONS)
+    if unknown:
+        raise ValueError(f"Unknown inference backend {', '.join(sorted(unknown))}, "
+                         f"combine {', '.join(OPTIMIZATIONS)} with '+'")
+    if {'torchscript', 'compile'} <= parts:
+        raise ValueError("torchscript and compile can't be combined")
+    return frozenset(parts)
+
+
+def backend_name(spec=BACKEND):
+    """Canonical name of a backend spec, `eager` when nothing is optimized."""
+    return '+'.join(part for part in OPTIMIZATIONS if part in parse_backend(spec)) or 'eager'
+
+
+def model_variant(name, spec=BACKEND):
+    """Name of `name` as built by the backend, for cache keys: outputs differ per backend."""
+    backend = backend_name(spec)
+    return name if backend == 'eager' else f"{name}+{backend}"
+
+
+def _cache_path(cache_dir, name, label, suffix):
+    versions = f"torch{torch.__version__}-demucs{demucs.__version__}".replace('+', '_')
+    path = Path(cache_dir) / f"{name}-{label}-{versions}{suffix}"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _save(save, obj, path):
+    partial = path.with_suffix(f".{os.getpid()}.tmp")
+    save(obj, str(partial))
+    os.replace(partial, path)
+
+
+def _map_models(model, build):
+    """Apply `build(sub_model, index)` to each model of a bag, or to the model itself."""
+    if hasattr(model, 'models'):
+        model.models = torch.nn.ModuleList([build(sub_model, index)
+                                            for index, sub_model in enumerate(model.models)])
+        return model
+    return build(model, 0)
+
+
+def quantize(model):
+    """Dynamic int8 quantization of the Linear and LSTM layers."""
+    return torch.ao.quantization.quantize_dynamic(model, QUANTIZED_LAYERS, dtype=torch.qint8)
+
+
+class TracedModel(torch.nn.Module):
+    """TorchScript trace of a Demucs model with the attributes the engine reads.
+
+    The trace only runs inputs of the length it was traced for, which is what
+    `valid_length` pads every segment to.
+    """
+
+    def __init__(self, traced, model, length):
+        super().__init__()
+        self.traced = traced
+        self.sources = list(model.sources)
+        self.samplerate = model.samplerate
+        self.audio_channels = model.audio_channels
+        self.segment = model.segment
+        self.length = length
+
+    def valid_length(self, length):
+        if length > self.length:
+            raise ValueError(f"Given length {length} is longer than traced length {self.length}")
+        return self.length
+
+    def forward(self, mix):
+        return self.traced(mix)
+
+
+def trace(model, path):
+    """Trace `model` for its segment length, or load the trace saved at `path`."""
+    length = int(float(model.segment) * model.samplerate)
+    if hasattr(model, 'valid_length'):
+        length = model.valid_length(length)
+    if path.exists():
+        traced = torch.jit.load(str(path))
+    else:
+        example = torch.randn(1, model.audio_channels, length, generator=torch.Generator().manual_seed(0))
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example, check_trace=False)
+        _save(torch.jit.save, traced, path)
+    return TracedModel(traced, model, length).eval()
+
+
+def build_model(name, loader, spec=BACKEND, cache_dir=CACHE_DIR):
+    """Load `name` with `loader(name)` and apply the optimizations of `spec`.
+
+    Quantized models and traces are saved under `cache_dir` the first time,
+    so later starts skip quantizing and tracing; a quantized model is loaded
+    from its file without going through `loader` at all.
+    """
+    parts = parse_backend(spec)
+    if not parts:
+        return loader(name)
+    label = backend_name(spec)
+
+    if 'int8' in parts and 'torchscript' not in parts:
+        path = _cache_path(cache_dir, name, 'int8', '.pt')
+        if path.exists():
+            model = torch.load(str(path), weights_only=False)
+        else:
+            model = quantize(loader(name))
+            _save(torch.save, model, path)
+    else:
+        model = loader(name)
+        if 'int8' in parts:
+            model = quantize(model)
+
+    if 'torchscript' in parts:
+        model = _map_models(model, lambda sub_model, index: trace(
+            sub_model, _cache_path(cache_dir, f"{name}-{index}", label, '.ts')))
+    if 'compile' in parts:
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR',
+                              os.path.abspath(os.path.join(cache_dir, 'inductor')))
+        model = _map_models(model, lambda sub_model, index: torch.compile(sub_model))
+    return model.eval()
@@ -0,0 +1,375 @@
+import atexit
+import fcntl
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+import torch
+from dotenv import load_dotenv
+
+from utils.model_registry import MEMORY_BUDGET, ResidentModels
+
+load_dotenv()
+
+# 0 keeps inference in the web worker process
+PROCESSES = int(os.getenv('INFERENCE_PROCESSES', '0'))
+# Torch threads per inference process, 0 splits the usable CPUs evenly
+THREADS = int(os.getenv('INFERENCE_THREADS', '0'))
+# '' leaves scheduling to the OS, 'auto' gives each process its own slice of
+# the CPUs, or explicit per-process CPU lists like '0-3;4-7'
+CPU_AFFINITY = os.getenv('INFERENCE_CPU_AFFINITY', '')
+START_METHOD = os.getenv('INFERENCE_START_METHOD', 'spawn')
+# Web worker processes on the host, gunicorn's own default for --workers;
+# each starts a pool, so they split the CPUs between them
+HOST_WORKERS = int(os.getenv('WEB_CONCURRENCY', '1'))
+# Where web workers claim their share of the CPUs
+SLOT_DIR = os.path.abspath(os.getenv('INFERENCE_SLOT_DIR', 'temp/inference_slots'))
+# Longest the result thread waits for a message before it looks for processes that died
+WATCHDOG_INTERVAL = 1.0
+
+
+class InferenceWorkerError(RuntimeError):
+    """An inference process failed or died while running a segment."""
+
+
+class ModelInfo:
+    """What the separation code needs to know about a model that lives in another process."""
+
+    def __init__(self, sources, samplerate, audio_channels, segment):
+        self.sources = list(sources)
+        self.samplerate = samplerate
+        self.audio_channels = audio_channels
+        self.segment = segment
+
+    @classmethod
+    def of(cls, model):
+        models = getattr(model, 'models', [model])
+        segment = min(float(sub_model.segment) for sub_model in models)
+        return cls(model.sources, model.samplerate, model.audio_channels, segment)
+
+
+def usable_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpu_list(spec):
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _split(cpus, parts):
+    """Cut `cpus` into `parts` contiguous groups, sharing CPUs round robin when there are too few."""
+    if len(cpus) < parts:
+        return [{cpus[index % len(cpus)]} for index in range(parts)]
+    share, extra = divmod(len(cpus), parts)
+    groups, start = [], 0
+    for index in range(parts):
+        stop = start + share + (index < extra)
+        groups.append(set(cpus[start:stop]))
+        start = stop
+    return groups
+
+
+_slots = []
+
+
+def claim_slot(workers=HOST_WORKERS, directory=SLOT_DIR):
+    """Index of this process among the `workers` web workers of the host.
+
+    Each slot is a lock file held until the process exits, so a restarted
+    worker takes over the slot of the one it replaces. Past `workers`
+    processes, slots are shared.
+    """
+    if workers <= 1:
+        return 0
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for index in range(workers):
+        handle = open(os.path.join(directory, f"slot-{index}.lock"), 'w')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        _slots.append(handle)
+        return index
+    return os.getpid() % workers
+
+
+def worker_cpus(slot, workers=HOST_WORKERS, cpus=None):
+    """The CPUs of web worker `slot`, its share of the usable ones."""
+    cpus = cpus if cpus is not None else usable_cpus()
+    return sorted(_split(cpus, workers)[slot % workers]) if workers > 1 else cpus
+
+
+def parse_affinity(spec, processes, cpus=None, offset=0):
+    """Return one CPU set per process for `spec`, or None to leave scheduling to the OS.
+
+    `auto` splits `cpus`, by default the usable ones. Explicit lists are
+    taken from `offset` on, so the pools of several web workers can be
+    given their own.
+    """
+    spec = (spec or '').strip()
+    if not spec:
+        return None
+    if spec == 'auto':
+        return _split(cpus if cpus is not None else usable_cpus(), processes)
+    groups = [_parse_cpu_list(group) for group in spec.split(';') if group.strip()]
+    return [groups[(offset + index) % len(groups)] for index in range(processes)]
+
+
+def threads_per_process(processes, affinity=None, threads=THREADS, cpus=None):
+    """Torch threads for each process: `threads` if set, else its share of `cpus`, by default the usable ones."""
+    if threads:
+        return threads
+    if affinity:
+        return max(1, min(len(group) for group in affinity))
+    return max(1, len(cpus if cpus is not None else usable_cpus()) // processes)
+
+
+def _worker(index, loader, runner, threads, cpus, tasks, results):
+    """Main loop of an inference process."""
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    models = ResidentModels(MEMORY_BUDGET)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, name, request = task
+        try:
+            model = models.get(name)
+            if model is None:
+                model = loader(name)
+                models.add(name, model)
+            if request == 'info':
+                results.put(('done', index, task_id, ModelInfo.of(model)))
+                continue
+
+            in_name, out_name, shape, out_shape = request
+            # The processes share the pool's resource tracker, so attaching
+            # doesn't hand ownership over; the pool unlinks the blocks
+            source = shared_memory.SharedMemory(name=in_name)
+            try:
+                segments = torch.from_numpy(np.ndarray(shape, dtype=np.float32, buffer=source.buf).copy())
+            finally:
+                source.close()
+            outputs = runner(model, segments).cpu().numpy()
+            target = shared_memory.SharedMemory(name=out_name)
+            try:
+                np.ndarray(out_shape, dtype=np.float32, buffer=target.buf)[...] = outputs
+            finally:
+                target.close()
+            results.put(('done', index, task_id, None))
+        except Exception as e:
+            results.put(('error', index, task_id, f"{type(e).__name__}: {e}"))
+
+
+class InferencePool:
+    """Runs model inference in a fixed set of worker processes.
+
+    Each process pins itself to its CPUs, fixes its torch thread count and
+    keeps its own resident models, loaded with `loader(name)` on first use
+    and unloaded least recently used first past `MODEL_MEMORY_BUDGET_MB`.
+    Segments travel to and from the processes through shared memory blocks;
+    only their names and shapes go over the task queues. Every process has
+    a queue of its own and tasks go to the one with the fewest outstanding,
+    so segments of one job are spread over every process and a lone job is
+    parallelised too. When a process dies, the tasks it held fail right away
+    and it is replaced.
+
+    The pool belongs to one web worker process: each gunicorn worker starts
+    its own, with its own copies of the models. `cpus` is the worker's share
+    of the host (see `claim_slot`), which its processes' threads split.
+    """
+
+    def __init__(self, loader, runner, processes=2, threads=None, affinity=None,
+                 start_method=START_METHOD, cpus=None):
+        self.loader = loader
+        self.runner = runner
+        self.processes = processes
+        self.affinity = affinity
+        self.threads = threads or threads_per_process(processes, affinity, cpus=cpus)
+        self._context = multiprocessing.get_context(start_method)
+        self._results = self._context.Queue()
+        self._workers = [None] * processes
+        self._queues = [None] * processes
+        # Ids of the tasks sent to each process and not answered yet
+        self._assigned = [set() for _ in range(processes)]
+        self._pending = {}
+        self._ids = itertools.count()
+        self._infos = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        for index in range(processes):
+            self._spawn(index)
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _spawn(self, index):
+        cpus = self.affinity[index] if self.affinity else None
+        # A fresh queue, so the replacement of a dead process doesn't run the tasks that failed with it
+        tasks = self._context.Queue()
+        process = self._context.Process(
+            target=_worker,
+            args=(index, self.loader, self.runner, self.threads, cpus, tasks, self._results),
+            name=f"inference-{index}",
+            daemon=True
+        )
+        process.start()
+        self._workers[index] = process
+        self._queues[index] = tasks
+
+    def model_info(self, name):
+        """Return the `ModelInfo` of `name`, loading it in one of the processes."""
+        info = self._infos.get(name)
+        if info is None:
+            info = self._infos[name] = self._submit(name, 'info').result()
+        return info
+
+    def submit(self, name, model, segments):
+        """Queue a `[batch, channels, samples]` stack and return a Future of its outputs."""
+        segments = np.ascontiguousarray(segments.cpu().numpy(), dtype=np.float32)
+        out_shape = (segments.shape[0], len(model.sources)) + segments.shape[1:]
+        source = shared_memory.SharedMemory(create=True, size=max(segments.nbytes, 1))
+        target = shared_memory.SharedMemory(create=True, size=max(4 * int(np.prod(out_shape)), 1))
+        np.ndarray(segments.shape, dtype=np.float32, buffer=source.buf)[...] = segments
+        request = (source.name, target.name, segments.shape, out_shape)
+        return self._submit(name, request, (source, target, out_shape))
+
+    def run(self, name, model, segments, lookahead=None):
+        """Yield the outputs of `segments` in order, keeping up to `lookahead` in flight."""
+        lookahead = lookahead or 2 * self.processes
+        in_flight = deque()
+        try:
+            for segment in segments:
+                in_flight.append(self.submit(name, model, segment[None]))
+                if len(in_flight) >= lookahead:
+                    yield in_flight.popleft().result()[0]
+            while in_flight:
+                yield in_flight.popleft().result()[0]
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def close(self):
+        """Stop the processes and release any shared memory still held."""
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            for tasks in self._queues:
+                tasks.put(None)
+        for process in self._workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._results.put(None)
+        self._thread.join(timeout=5)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, blocks in pending.values():
+            self._release(blocks)
+            if not future.done():
+                future.set_exception(InferenceWorkerError("Inference pool closed"))
+        atexit.unregister(self.close)
+
+    def _submit(self, name, request, blocks=None):
+        if self._closed:
+            raise InferenceWorkerError("Inference pool closed")
+        future = Future()
+        task_id = next(self._ids)
+        with self._lock:
+            self._pending[task_id] = (future, blocks)
+            index = min(range(self.processes), key=lambda index: len(self._assigned[index]))
+            self._assigned[index].add(task_id)
+            self._queues[index].put((task_id, name, request))
+        return future
+
+    def _collect(self):
+        """Resolve futures as results arrive and replace processes that died.
+
+        Liveness is checked on every pass, so a dead process is noticed
+        while the others keep results flowing too.
+        """
+        while True:
+            try:
+                message = self._results.get(timeout=WATCHDOG_INTERVAL)
+            except queue.Empty:
+                message = False
+            if message is None:
+                return
+            if message:
+                kind, index, task_id, payload = message
+                with self._lock:
+                    self._assigned[index].discard(task_id)
+                if kind == 'done':
+                    self._finish(task_id, payload)
+                else:
+                    self._fail(task_id, InferenceWorkerError(payload))
+            self._check_workers()
+
+    def _check_workers(self):
+        failed = []
+        with self._lock:
+            if self._closed:
+                return
+            for index, process in enumerate(self._workers):
+                if process.is_alive():
+                    continue
+                print(f"Inference process {index} exited with {process.exitcode}, restarting it")
+                failed.extend((task_id, process.exitcode) for task_id in self._assigned[index])
+                self._assigned[index] = set()
+                self._spawn(index)
+        for task_id, exitcode in failed:
+            self._fail(task_id, InferenceWorkerError(f"Inference process exited with {exitcode}"))
+
+    def _finish(self, task_id, info):
+        with self._lock:
+            future, blocks = self._pending.pop(task_id, (None, None))
+        if future is None:
+            return
+        if blocks is None:
+            future.set_result(info)
+            return
+        _, target, out_shape = blocks
+        outputs = torch.from_numpy(np.ndarray(out_shape, dtype=np.float32, buffer=target.buf).copy())
+        self._release(blocks)
+        if future.set_running_or_notify_cancel():
+            future.set_result(outputs)
+
+    def _fail(self, task_id, error):
+        with self._lock:
+            future, blocks = self._pending.pop(task_id, (None, None))
+        if future is None:
+            return
+        self._release(blocks)
+        if future.set_running_or_notify_cancel():
+            future.set_exception(error)
+
+    @staticmethod
+    def _release(blocks):
+        if not blocks:
+            return
+        for block in blocks[:2]:
+            block.close()
+            block.unlink()
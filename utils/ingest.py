@@ -0,0 +1,260 @@
+import hashlib
+import io
+import os
+import threading
+from time import perf_counter
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+load_dotenv()
+
+MB = 1024 * 1024
+
+CONNECT_TIMEOUT = float(os.getenv('INGEST_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('INGEST_READ_TIMEOUT', '30'))
+MAX_BYTES = int(os.getenv('INGEST_MAX_MB', '1024')) * MB
+# Times a dropped transfer is picked up again where it stopped
+RESUME_ATTEMPTS = int(os.getenv('INGEST_RESUME_ATTEMPTS', '3'))
+CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_KB', '256')) * 1024
+POOL_SIZE = int(os.getenv('INGEST_POOL_SIZE', '16'))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class DownloadTooLarge(Exception):
+    """The source is bigger than the ingestion size limit."""
+
+    def __init__(self, max_bytes):
+        super().__init__(f"Audio file is larger than the {max_bytes / MB:g} MB limit")
+        self.max_bytes = max_bytes
+
+
+class IncompleteDownload(Exception):
+    """The connection ended before the whole body arrived."""
+
+
+class DownloadCancelled(Exception):
+    """`Download.cancel` was called before the transfer finished."""
+
+
+RESUMABLE_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    IncompleteDownload
+)
+
+
+def get_http_session():
+    """Return the process-wide HTTP session, so downloads reuse pooled connections."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # Retries failed connects only; interrupted bodies are resumed by `Download`
+                adapter = HTTPAdapter(
+                    pool_connections=POOL_SIZE,
+                    pool_maxsize=POOL_SIZE,
+                    max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5)
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+class Download:
+    """Fetches a URL into a file in a background thread.
+
+    Transfers that break off are resumed with a `Range` request, or by
+    skipping what we already have when the server ignores ranges. Sources
+    over `max_bytes` are refused from their Content-Length when they send
+    one, otherwise as soon as the limit is crossed. `reader()` gives a file
+    object that decodes can use while the bytes are still arriving.
+    """
+
+    def __init__(self, url, path, max_bytes=MAX_BYTES, session=None):
+        self.url = url
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.session = session or get_http_session()
+        self.size = None
+        self.bytes_written = 0
+        self.resumes = 0
+        self.error = None
+        self.elapsed = None
+        self._digest = hashlib.sha256()
+        self._condition = threading.Condition()
+        self._done = False
+        self._cancelled = False
+        self._thread = None
+
+    def start(self):
+        # Create the file up front so readers can open it right away
+        self._file = open(self.path, 'wb')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """Block until the download is complete and raise its error, if any."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._done, timeout):
+                raise TimeoutError(f"Download of {self.url} still running")
+        if self.error:
+            raise self.error
+        return self.path
+
+    def cancel(self):
+        """Stop the transfer and wait for the download thread to exit."""
+        self._cancelled = True
+        if self._thread:
+            self._thread.join()
+
+    @property
+    def done(self):
+        return self._done
+
+    def sha256(self):
+        """Hex digest of the whole file, computed while it was written."""
+        self.wait()
+        return self._digest.hexdigest()
+
+    def reader(self):
+        return GrowingFileReader(self)
+
+    def wait_for(self, offset, timeout=None):
+        """Block until `offset` bytes are on disk or the download ended; return the bytes available."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._done or self.bytes_written >= offset, timeout)
+            if self.error and self.bytes_written < offset:
+                raise self.error
+            return self.bytes_written
+
+    def wait_for_size(self):
+        """Return the final size, waiting for the end only when the server didn't announce it."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._done or self.size is not None)
+            if self.size is None and self.error:
+                raise self.error
+            return self.size if self.size is not None else self.bytes_written
+
+    def _run(self):
+        start = perf_counter()
+        try:
+            with self._file as f:
+                self._fetch(f)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.elapsed = perf_counter() - start
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def _fetch(self, f):
+        attempts = 0
+        while True:
+            try:
+                self._fetch_from(f, self.bytes_written)
+                return
+            except RESUMABLE_ERRORS as e:
+                attempts += 1
+                if attempts > RESUME_ATTEMPTS:
+                    raise
+                self.resumes += 1
+                print(f"Download of {self.url} broke off at {self.bytes_written} bytes ({e}), resuming")
+
+    def _fetch_from(self, f, offset):
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+        with self.session.get(self.url, headers=headers, stream=True,
+                              timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            response.raise_for_status()
+            # A plain 200 to a range request restarts at byte 0, drop what we have
+            skip = offset if offset and response.status_code != 206 else 0
+            length = response.headers.get('Content-Length')
+            if length is not None and response.status_code != 206:
+                self._set_size(int(length))
+            elif response.status_code == 206:
+                total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                if total.isdigit():
+                    self._set_size(int(total))
+
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if self._cancelled:
+                    raise DownloadCancelled(self.url)
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk, skip = chunk[dropped:], skip - dropped
+                if not chunk:
+                    continue
+                if self.bytes_written + len(chunk) > self.max_bytes:
+                    raise DownloadTooLarge(self.max_bytes)
+                f.write(chunk)
+                f.flush()
+                self._digest.update(chunk)
+                with self._condition:
+                    self.bytes_written += len(chunk)
+                    self._condition.notify_all()
+
+        if self.size is not None and self.bytes_written < self.size:
+            raise IncompleteDownload(f"got {self.bytes_written} of {self.size} bytes")
+
+    def _set_size(self, size):
+        if size > self.max_bytes:
+            raise DownloadTooLarge(self.max_bytes)
+        with self._condition:
+            self.size = size
+            self._condition.notify_all()
+
+
+class GrowingFileReader(io.RawIOBase):
+    """Seekable reader of a file a `Download` is still writing.
+
+    Reads block until the requested bytes have arrived, so decoders can
+    start on the head of a track while the rest is in flight.
+    """
+
+    def __init__(self, download):
+        self.download = download
+        self.file = open(download.path, 'rb')
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.offset = offset
+        elif whence == io.SEEK_CUR:
+            self.offset += offset
+        else:
+            self.offset = self.download.wait_for_size() + offset
+        return self.offset
+
+    def readinto(self, buffer):
+        available = self.download.wait_for(self.offset + len(buffer))
+        count = max(0, min(len(buffer), available - self.offset))
+        if count == 0:
+            return 0
+        self.file.seek(self.offset)
+        data = self.file.read(count)
+        buffer[:len(data)] = data
+        self.offset += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
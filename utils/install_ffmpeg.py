@@ -1,16 +1,49 @@
+import os
 import subprocess
 import sys
+import threading
+import time
 
-def check_ffmpeg():
-    """Check if FFmpeg is installed and accessible"""
-    try:
-        # Try to run ffmpeg -version
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        return True
-    except (subprocess.SubprocessError, FileNotFoundError):
-        return False
+# Result of the last `ffmpeg -version` run, so requests don't spawn one each
+_ffmpeg_available = None
+# Seconds before a failed installation is attempted again
+INSTALL_RETRY_INTERVAL = int(os.getenv('FFMPEG_INSTALL_RETRY_INTERVAL', '3600'))
+_install_failed_at = None
+_install_lock = threading.Lock()
+
+def check_ffmpeg(refresh=False):
+    """Check if FFmpeg is installed and accessible (cached after the first call)"""
+    global _ffmpeg_available
+    if _ffmpeg_available is None or refresh:
+        try:
+            # Try to run ffmpeg -version
+            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+            _ffmpeg_available = True
+        except (subprocess.SubprocessError, FileNotFoundError):
+            _ffmpeg_available = False
+    return _ffmpeg_available
 
 def install_ffmpeg():
+    """Install FFmpeg and return whether it is available.
+
+    A failed installation is remembered for `INSTALL_RETRY_INTERVAL` seconds,
+    during which this returns False right away instead of downloading again.
+    """
+    global _install_failed_at
+    with _install_lock:
+        if check_ffmpeg():
+            return True
+        if _install_failed_at is not None and time.time() - _install_failed_at < INSTALL_RETRY_INTERVAL:
+            return False
+        try:
+            installed = _install()
+        except Exception:
+            _install_failed_at = time.time()
+            raise
+        _install_failed_at = None if installed else time.time()
+        return installed
+
+def _install():
     print("Starting Ffmpeg installation...")
 
     subprocess.check_call([sys.executable, "-m", "pip",
@@ -57,7 +90,7 @@ def install_ffmpeg():
                                 capture_output=True, text=True, check=True)
         print("FFmpeg version:")
         print(result.stdout)
-        return True
+        return check_ffmpeg(refresh=True)
     except (subprocess.CalledProcessError, FileNotFoundError):
         print("FFmpeg installation verification failed")
         return False
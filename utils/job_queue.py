@@ -0,0 +1,582 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, nullcontext
+from functools import partial
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from utils.tracing import current_trace, start_trace
+
+load_dotenv()
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Priority classes, most urgent first
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BULK)
+
+# Estimated cost, in seconds of audio, of jobs submitted without one
+DEFAULT_COST = 240.0
+# Seconds of past work counted against a client when picking the next job
+FAIR_WINDOW = 3600
+# Seconds of waiting after which a job is promoted to the next class up
+AGING = 600
+# Seconds without a heartbeat after which a running job is taken to be abandoned,
+# its worker having been killed by the gunicorn timeout, crashed or redeployed
+STALE_AFTER = 120
+# Runs an abandoned job gets before it is marked failed instead of queued again
+MAX_ATTEMPTS = 3
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue, or the client's share of it, is full."""
+
+    def __init__(self, depth, retry_after, client=None):
+        if client is None:
+            super().__init__(f"Queue is full ({depth} jobs waiting)")
+        else:
+            super().__init__(f"Too many queued jobs for this client ({depth} waiting)")
+        self.depth = depth
+        self.retry_after = retry_after
+        self.client = client
+
+
+def _new_job(params, priority=BULK, client=None, cost=None, job_id=None):
+    return {
+        'id': job_id or uuid.uuid4().hex,
+        'status': QUEUED,
+        'stage': QUEUED,
+        'progress': 0.0,
+        'params': params,
+        'result': {},
+        'error': None,
+        'created_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'priority': priority if priority in PRIORITIES else BULK,
+        'client': client or '',
+        'cost': DEFAULT_COST if cost is None else float(cost),
+        'heartbeat_at': None,
+        'attempts': 0
+    }
+
+
+def _abandoned_error(attempts):
+    return f"Job was abandoned by its worker {attempts} times (crash, timeout or redeploy)"
+
+
+def pick_next(queued, service, now, aging=AGING):
+    """Choose which queued job runs next.
+
+    Interactive jobs go before bulk ones; a job climbs one class for every
+    `aging` seconds it has waited, so bulk work is never starved. Within a
+    class the job that would leave its client with the least work done
+    recently wins: `service` maps clients to the cost of the jobs they
+    started lately, and the job's own estimated cost is added to it. That
+    keeps one busy client from taking every slot and lets short jobs pass
+    hour-long ones.
+    """
+    def order(job):
+        rank = PRIORITIES.index(job['priority']) if job['priority'] in PRIORITIES else len(PRIORITIES)
+        if aging:
+            rank -= int((now - job['created_at']) // aging)
+        return max(rank, 0), service.get(job['client'], 0.0) + job['cost'], job['created_at']
+    return min(queued, key=order)
+
+
+class MemoryJobStore:
+    """Keeps jobs in a dict. Only visible to the process that created them."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, params, max_depth, priority=BULK, client=None, cost=None, max_per_client=None, job_id=None):
+        with self._lock:
+            if self._count(QUEUED) >= max_depth:
+                return None
+            job = _new_job(params, priority, client, cost, job_id)
+            if max_per_client and sum(
+                1 for queued in self._jobs.values()
+                if queued['status'] == QUEUED and queued['client'] == job['client']
+            ) >= max_per_client:
+                raise QueueFullError(max_per_client, None, job['client'])
+            self._jobs[job['id']] = job
+            return dict(job)
+
+    def claim(self, pick=pick_next, fair_window=FAIR_WINDOW):
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job['status'] == QUEUED]
+            if not queued:
+                return None
+            now = time.time()
+            service = {}
+            for job in self._jobs.values():
+                if job['started_at'] is not None and job['started_at'] >= now - fair_window:
+                    service[job['client']] = service.get(job['client'], 0.0) + job['cost']
+            job = self._jobs[pick(queued, service, now)['id']]
+            job.update(status=RUNNING, stage=RUNNING, started_at=now, heartbeat_at=now,
+                       attempts=job['attempts'] + 1)
+            return dict(job)
+
+    def update(self, job_id, result=None, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields, heartbeat_at=time.time())
+            if result:
+                job['result'] = {**job['result'], **result}
+
+    def heartbeat(self, job_ids):
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job and job['status'] == RUNNING:
+                    job['heartbeat_at'] = time.time()
+
+    def recover(self, stale_after, max_attempts=MAX_ATTEMPTS):
+        """Queue again, or fail past `max_attempts`, running jobs without a heartbeat for `stale_after` seconds."""
+        with self._lock:
+            now = time.time()
+            recovered = []
+            for job in self._jobs.values():
+                if job['status'] != RUNNING or (job['heartbeat_at'] or job['started_at']) >= now - stale_after:
+                    continue
+                if job['attempts'] >= max_attempts:
+                    job.update(status=FAILED, stage=FAILED, error=_abandoned_error(job['attempts']), finished_at=now)
+                else:
+                    job.update(status=QUEUED, stage=QUEUED, progress=0.0, result={}, started_at=None,
+                               heartbeat_at=None)
+                recovered.append(job['id'])
+            return recovered
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def count(self, status):
+        with self._lock:
+            return self._count(status)
+
+    def waits(self, since):
+        """Return `(priority, seconds queued)` of the jobs started since `since`."""
+        with self._lock:
+            return [
+                (job['priority'], job['started_at'] - job['created_at'])
+                for job in self._jobs.values()
+                if job['started_at'] is not None and job['started_at'] >= since
+            ]
+
+    def queued_by_priority(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                if job['status'] == QUEUED:
+                    counts[job['priority']] = counts.get(job['priority'], 0) + 1
+            return counts
+
+    def prune(self, older_than):
+        with self._lock:
+            # Running jobs nobody has beaten for as long are orphans, whether or not they were recovered
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if (job['finished_at'] and job['finished_at'] < older_than)
+                or (job['status'] == RUNNING and (job['heartbeat_at'] or job['started_at']) < older_than)
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _count(self, status):
+        return sum(1 for job in self._jobs.values() if job['status'] == status)
+
+
+class SQLiteJobStore:
+    """Keeps jobs in a SQLite file so every gunicorn worker shares one queue."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    progress REAL NOT NULL,
+                    params TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            # Scheduling columns, added to databases created before they existed
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in (
+                ('priority', f"TEXT NOT NULL DEFAULT '{BULK}'"),
+                ('client', "TEXT NOT NULL DEFAULT ''"),
+                ('cost', f"REAL NOT NULL DEFAULT {DEFAULT_COST}"),
+                ('heartbeat_at', "REAL"),
+                ('attempts', "INTEGER NOT NULL DEFAULT 0")
+            ):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return closing(conn)
+
+    def add(self, params, max_depth, priority=BULK, client=None, cost=None, max_per_client=None, job_id=None):
+        job = _new_job(params, priority, client, cost, job_id)
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            depth = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()[0]
+            if depth >= max_depth:
+                conn.execute("ROLLBACK")
+                return None
+            if max_per_client and conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND client = ?", (QUEUED, job['client'])
+            ).fetchone()[0] >= max_per_client:
+                conn.execute("ROLLBACK")
+                raise QueueFullError(max_per_client, None, job['client'])
+            columns = list(job)
+            conn.execute(
+                f"INSERT INTO jobs ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                tuple(
+                    json.dumps(job[column]) if column in ('params', 'result') else job[column]
+                    for column in columns
+                )
+            )
+            conn.execute("COMMIT")
+        return job
+
+    def claim(self, pick=pick_next, fair_window=FAIR_WINDOW):
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            queued = [
+                dict(row) for row in conn.execute(
+                    "SELECT id, priority, client, cost, created_at FROM jobs WHERE status = ?",
+                    (QUEUED,)
+                )
+            ]
+            if not queued:
+                conn.execute("ROLLBACK")
+                return None
+            now = time.time()
+            service = {
+                row['client']: row['service']
+                for row in conn.execute(
+                    "SELECT client, SUM(cost) AS service FROM jobs "
+                    "WHERE started_at >= ? GROUP BY client", (now - fair_window,)
+                )
+            }
+            job_id = pick(queued, service, now)['id']
+            conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, started_at = ?, heartbeat_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (RUNNING, RUNNING, now, now, job_id)
+            )
+            conn.execute("COMMIT")
+            return self._get(conn, job_id)
+
+    def update(self, job_id, result=None, **fields):
+        fields['heartbeat_at'] = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if result:
+                current = conn.execute(
+                    "SELECT result FROM jobs WHERE id = ?", (job_id,)
+                ).fetchone()['result']
+                fields['result'] = json.dumps({**json.loads(current), **result})
+            assignments = ", ".join(f"{column} = ?" for column in fields)
+            conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?",
+                (*fields.values(), job_id)
+            )
+            conn.execute("COMMIT")
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET heartbeat_at = ? WHERE status = ? AND id IN ({', '.join('?' for _ in job_ids)})",
+                (time.time(), RUNNING, *job_ids)
+            )
+
+    def recover(self, stale_after, max_attempts=MAX_ATTEMPTS):
+        """Queue again, or fail past `max_attempts`, running jobs without a heartbeat for `stale_after` seconds."""
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            stale = conn.execute(
+                "SELECT id, attempts FROM jobs WHERE status = ? AND COALESCE(heartbeat_at, started_at) < ?",
+                (RUNNING, now - stale_after)
+            ).fetchall()
+            for row in stale:
+                if row['attempts'] >= max_attempts:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, stage = ?, error = ?, finished_at = ? WHERE id = ?",
+                        (FAILED, FAILED, _abandoned_error(row['attempts']), now, row['id'])
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, stage = ?, progress = 0, result = '{}', started_at = NULL, "
+                        "heartbeat_at = NULL WHERE id = ?",
+                        (QUEUED, QUEUED, row['id'])
+                    )
+            conn.execute("COMMIT")
+            return [row['id'] for row in stale]
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            return self._get(conn, job_id)
+
+    def count(self, status):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)
+            ).fetchone()[0]
+
+    def waits(self, since):
+        """Return `(priority, seconds queued)` of the jobs started since `since`."""
+        with self._connect() as conn:
+            return [
+                (row['priority'], row['wait'])
+                for row in conn.execute(
+                    "SELECT priority, started_at - created_at AS wait FROM jobs WHERE started_at >= ?",
+                    (since,)
+                )
+            ]
+
+    def queued_by_priority(self):
+        with self._connect() as conn:
+            return {
+                row['priority']: row['jobs']
+                for row in conn.execute(
+                    "SELECT priority, COUNT(*) AS jobs FROM jobs WHERE status = ? GROUP BY priority",
+                    (QUEUED,)
+                )
+            }
+
+    def prune(self, older_than):
+        with self._lock, self._connect() as conn:
+            # Running jobs nobody has beaten for as long are orphans, whether or not they were recovered
+            conn.execute(
+                "DELETE FROM jobs WHERE (finished_at IS NOT NULL AND finished_at < ?) "
+                "OR (status = ? AND COALESCE(heartbeat_at, started_at) < ?)",
+                (older_than, RUNNING, older_than)
+            )
+
+    def _get(self, conn, job_id):
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['result'] = json.loads(job['result'])
+        return job
+
+
+class JobQueue:
+    """Bounded pool of worker threads draining a job store.
+
+    Jobs carry a priority class, the client that sent them and an estimated
+    cost; `pick_next` uses them to decide what runs next. `max_per_client`
+    caps how many queued jobs one client may hold.
+
+    `handler(params, report)` runs each job. It calls `report(stage, progress,
+    **result)` as it goes and returns the final result dict; any exception
+    marks the job as failed with the exception message.
+
+    Running jobs hold a lease: a thread refreshes their heartbeat every
+    quarter of `stale_after` seconds. A job whose worker died without
+    finishing it, killed by the gunicorn timeout, crashed or redeployed,
+    stops beating; any worker of the queue then queues it again, or marks
+    it failed once it has been tried `max_attempts` times.
+    """
+
+    def __init__(self, handler, store, workers=1, max_depth=8, retry_after=30,
+                 poll_interval=1.0, job_ttl=3600, max_per_client=None,
+                 fair_window=FAIR_WINDOW, aging=AGING, stale_after=STALE_AFTER,
+                 max_attempts=MAX_ATTEMPTS):
+        self.handler = handler
+        self.store = store
+        self.workers = workers
+        self.max_depth = max_depth
+        self.retry_after = retry_after
+        self.max_per_client = max_per_client
+        self.fair_window = fair_window
+        self.aging = aging
+        self.poll_interval = poll_interval
+        self.job_ttl = job_ttl
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.app = None
+        self._threads = []
+        self._heartbeat = None
+        self._running = set()
+        self._last_recovery = 0.0
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Run jobs inside `app`'s application context, and start the workers.
+
+        Jobs already queued, or abandoned by a worker that died, are picked
+        up right away instead of waiting for the next submission.
+        """
+        self.app = app
+        self.start()
+
+    def submit(self, params, priority=BULK, client=None, cost=None, job_id=None):
+        """Queue a job, under `job_id` if given, and return its id, or raise `QueueFullError`."""
+        self.start()
+        self.store.prune(time.time() - self.job_ttl)
+        try:
+            job = self.store.add(params, self.max_depth, priority=priority, client=client,
+                                 cost=cost, max_per_client=self.max_per_client, job_id=job_id)
+        except QueueFullError as e:
+            e.retry_after = self.retry_after
+            raise
+        if job is None:
+            raise QueueFullError(self.max_depth, self.retry_after)
+        self._wakeup.set()
+        return job['id']
+
+    def status(self, job_id):
+        """Return the public view of a job, or None if it doesn't exist."""
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        status = {
+            'job_id': job['id'],
+            'status': job['status'],
+            'stage': job['stage'],
+            'progress': job['progress'],
+            'error': job['error'],
+            'created_at': job['created_at'],
+            'started_at': job['started_at'],
+            'finished_at': job['finished_at'],
+            'priority': job['priority'],
+            'attempts': job['attempts']
+        }
+        if job['status'] == QUEUED:
+            status['queue_depth'] = self.store.count(QUEUED)
+        status.update(job['result'])
+        return status
+
+    def stats(self):
+        """Return queued jobs and queue wait percentiles per priority class."""
+        queued = self.store.queued_by_priority()
+        waits = {}
+        for priority, wait in self.store.waits(time.time() - self.job_ttl):
+            waits.setdefault(priority, []).append(wait)
+        stats = {}
+        for priority in PRIORITIES:
+            samples = sorted(waits.get(priority, []))
+            stats[priority] = {
+                'queued': queued.get(priority, 0),
+                'started': len(samples),
+                'wait_mean': sum(samples) / len(samples) if samples else 0.0,
+                'wait_p50': _percentile(samples, 0.5),
+                'wait_p95': _percentile(samples, 0.95),
+                'wait_max': samples[-1] if samples else 0.0
+            }
+        return stats
+
+    def start(self):
+        """Start the worker threads, and the heartbeat thread, if they aren't running yet."""
+        with self._start_lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            if self.stale_after and self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+                self._heartbeat.start()
+
+    def _beat(self):
+        """Refresh the lease of the jobs this process is running."""
+        while True:
+            time.sleep(self.stale_after / 4)
+            try:
+                self.store.heartbeat(list(self._running))
+            except Exception as e:
+                print(f"Failed to refresh the job heartbeats: {str(e)}")
+
+    def recover(self):
+        """Queue again, or fail, the jobs whose worker stopped beating; returns their ids."""
+        self._last_recovery = time.time()
+        recovered = self.store.recover(self.stale_after, self.max_attempts)
+        if recovered:
+            current_trace().event('jobs_recovered', jobs=recovered)
+        return recovered
+
+    def _work(self):
+        while True:
+            try:
+                if self.stale_after and time.time() - self._last_recovery >= self.stale_after / 4:
+                    self.recover()
+                job = self.store.claim(partial(pick_next, aging=self.aging), self.fair_window)
+            except Exception as e:
+                print(f"Failed to claim a job: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        job_id = job['id']
+
+        def report(stage, progress, **result):
+            self.store.update(job_id, stage=stage, progress=progress, result=result)
+
+        context = self.app.app_context() if self.app else nullcontext()
+        self._running.add(job_id)
+        try:
+            # The job's root span logs its failure, if any
+            with context, start_trace('job', job_id, priority=job['priority'], attempt=job.get('attempts', 1)):
+                result = self.handler(job['params'], report)
+            self.store.update(job_id, status=DONE, stage=DONE, progress=1.0,
+                              finished_at=time.time(), result=result)
+        except Exception as e:
+            self.store.update(job_id, status=FAILED, stage=FAILED, error=str(e),
+                              finished_at=time.time())
+        finally:
+            self._running.discard(job_id)
+
+
+def _percentile(samples, fraction):
+    """Nearest-rank percentile of sorted `samples`."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def create_job_store(path=None):
+    """Build the job store selected by `JOB_QUEUE_BACKEND` (sqlite or memory).
+
+    SQLite stores live at `path`, by default `JOB_QUEUE_DB`.
+    """
+    if os.getenv('JOB_QUEUE_BACKEND', 'sqlite') == 'memory':
+        return MemoryJobStore()
+    return SQLiteJobStore(path or os.getenv('JOB_QUEUE_DB', 'temp/jobs.db'))
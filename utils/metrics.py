@@ -0,0 +1,357 @@
+import fcntl
+import json
+import math
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Seconds, from a cached ffmpeg check to an hour-long separation
+STAGE_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+AUDIO_BUCKETS = (5, 15, 30, 60, 120, 240, 480, 900, 1800, 3600, 7200)
+REALTIME_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5)
+# Every gunicorn worker writes its metrics here so whichever one is scraped reports them all
+# Resolved once, the flush thread mustn't follow later changes of the working directory
+METRICS_DIR = os.path.abspath(os.getenv('METRICS_DIR', 'temp/metrics'))
+# Seconds between writes of a worker's metrics to `METRICS_DIR`
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+# Totals of workers that exited, kept so counters don't go back when one restarts
+EXITED = 'exited.json'
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {', '.join(labelnames)}, got {', '.join(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic total, optionally split by labels."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def snapshot(self):
+        """Values of this process, by label tuple."""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, value):
+        return total + value
+
+    def samples(self, values=None):
+        """Render `values`, merged from every worker, or those of this process."""
+        values = self.snapshot() if values is None else values
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Counter):
+    """Current value, either set as things happen or read by `function` at scrape time.
+
+    `function()` returns a number, or a dict of label tuples to numbers for
+    labelled gauges. Across workers the values of the running ones are
+    added up, except for `shared` gauges whose function reads state every
+    worker sees, like the job queue; those are read once, by the scraped one.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None, shared=False):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self.shared = shared
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _read(self):
+        values = self.function()
+        return values if isinstance(values, dict) else {(): values}
+
+    def snapshot(self):
+        if self.function is None:
+            return super().snapshot()
+        return {} if self.shared else self._read()
+
+    def samples(self, values=None):
+        if self.shared or values is None and self.function is not None:
+            values = self._read()
+        yield from super().samples(values)
+
+
+class Histogram:
+    """Distribution of observations over fixed upper bounds, like Prometheus client histograms."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        # Index of the first bucket that holds the value; cumulated at scrape time
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, **labels):
+        series = self._series.get(_label_key(self.labelnames, labels))
+        return sum(series[0]) if series else 0
+
+    def sum(self, **labels):
+        series = self._series.get(_label_key(self.labelnames, labels))
+        return series[1] if series else 0.0
+
+    def snapshot(self):
+        """`[bucket counts, sum]` of this process, by label tuple."""
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._series.items()}
+
+    @staticmethod
+    def merge(total, value):
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1]]
+
+    def samples(self, values=None):
+        series = self.snapshot() if values is None else values
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labelnames, key, [('le', _format_value(bound))]), cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), cumulative
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """Metrics rendered in the Prometheus text format.
+
+    With a `directory`, shared by the gunicorn workers, every worker writes
+    its values to `<directory>/<pid>.json` every `flush_interval` seconds
+    once `start` is called, and `render` adds up the files of all of them,
+    so any worker answers a scrape for the whole server. Counters and
+    histograms of workers that exited are folded into `exited.json`;
+    gauges only count running workers. Without one it renders this
+    process alone.
+    """
+
+    def __init__(self, directory=None, flush_interval=FLUSH_INTERVAL):
+        self.directory = Path(os.path.abspath(directory)) if directory else None
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None, shared=False):
+        return self.register(Gauge(name, documentation, labelnames, function, shared))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        """Values of this process: `{metric: [[labels, value], ...]}`, ready for JSON."""
+        return {
+            name: [[list(key), value] for key, value in metric.snapshot().items()]
+            for name, metric in list(self._metrics.items())
+        }
+
+    def _merge(self, totals, snapshot, gauges=True):
+        for name, series in snapshot.items():
+            metric = self._metrics.get(name)
+            if metric is None or (metric.type == 'gauge' and not gauges):
+                continue
+            values = totals.setdefault(name, {})
+            for key, value in series:
+                key = tuple(key)
+                values[key] = metric.merge(values[key], value) if key in values else value
+        return totals
+
+    @contextmanager
+    def _locked(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _write(self, path, snapshot):
+        partial = path.with_suffix(f".{os.getpid()}.tmp")
+        partial.write_text(json.dumps(snapshot))
+        os.replace(partial, path)
+
+    def _read(self, path):
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _retire(self, path):
+        """Fold the counters and histograms of an exited worker into the `exited.json` totals."""
+        exited = self._merge(self._merge({}, self._read(self.directory / EXITED)), self._read(path), gauges=False)
+        self._write(self.directory / EXITED, {
+            name: [[list(key), value] for key, value in values.items()] for name, values in exited.items()
+        })
+        path.unlink(missing_ok=True)
+
+    def flush(self):
+        """Write this worker's values to the shared directory."""
+        path = self.directory / f"{os.getpid()}.json"
+        snapshot = self.snapshot()
+        with self._locked():
+            self._write(path, snapshot)
+
+    def start(self):
+        """Write this worker's values to `directory` every `flush_interval` seconds, from a thread."""
+        if self.directory is None or self._thread is not None:
+            return
+        path = self.directory / f"{os.getpid()}.json"
+        # Left by an exited worker whose pid this one got
+        if path.exists():
+            with self._locked():
+                self._retire(path)
+
+        def run():
+            while True:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Failed to write metrics: {str(e)}")
+                time.sleep(self.flush_interval)
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def collect(self):
+        """Values of every worker added up, by metric name and label tuple."""
+        own = self.directory / f"{os.getpid()}.json"
+        totals = {}
+        with self._locked():
+            if self._thread is not None:
+                self._write(own, self.snapshot())
+            for path in sorted(self.directory.glob('*.json')):
+                if path.name == EXITED:
+                    continue
+                if path.stem.isdigit() and not _alive(int(path.stem)):
+                    self._retire(path)
+                else:
+                    self._merge(totals, self._read(path))
+            self._merge(totals, self._read(self.directory / EXITED), gauges=False)
+        if self._thread is None:
+            # Not flushing, so this process isn't among the files
+            self._merge(totals, self.snapshot())
+        return totals
+
+    def render(self):
+        values = self.collect() if self.directory else {}
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            samples = metric.samples(values.get(metric.name, {}) if self.directory else None)
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def resident_memory_bytes():
+    """Current resident set size of this process, or its peak where /proc is missing."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+registry = Registry(METRICS_DIR)
+
+stage_seconds = registry.histogram(
+    'separation_stage_seconds', 'Seconds spent in each stage of a separation job', ['stage']
+)
+audio_seconds = registry.histogram(
+    'separation_audio_seconds', 'Duration of the separated audio in seconds', buckets=AUDIO_BUCKETS
+)
+realtime_factor = registry.histogram(
+    'separation_realtime_factor', 'Job processing seconds per second of audio', buckets=REALTIME_BUCKETS
+)
+jobs_total = registry.counter(
+    'separation_jobs_total', 'Finished separation jobs by outcome (done, cached or failed)', ['outcome']
+)
+jobs_in_flight = registry.gauge('separation_jobs_in_flight', 'Separation jobs running in the server workers')
+s3_bytes = registry.counter(
+    's3_bytes_total', 'Bytes moved to and from S3 by the server workers', ['direction']
+)
+registry.gauge('process_resident_memory_bytes', 'Resident memory of the server workers in bytes',
+               function=resident_memory_bytes)
@@ -0,0 +1,134 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# `relative_cost` is the CPU time per audio minute relative to htdemucs, used
+# to weigh jobs in the queue
+ModelSpec = namedtuple('ModelSpec', ['name', 'description', 'relative_cost'])
+
+KNOWN_MODELS = {
+    'htdemucs': ModelSpec('htdemucs', "Hybrid Transformer Demucs v4, the default", 1.0),
+    'htdemucs_ft': ModelSpec('htdemucs_ft', "Bag of 4 fine-tuned htdemucs, best quality", 4.0),
+    'hdemucs_mmi': ModelSpec('hdemucs_mmi', "Hybrid Demucs v3, a single model", 1.0),
+    'mdx_extra_q': ModelSpec('mdx_extra_q', "Quantized bag of 4 MDX models, smallest download", 4.0),
+}
+
+DEFAULT_MODEL = os.getenv('DEMUCS_MODEL', 'htdemucs')
+# Models requests may pick; anything else is refused
+AVAILABLE_MODELS = [
+    name.strip() for name in
+    os.getenv('SEPARATION_MODELS', f"{DEFAULT_MODEL},htdemucs_ft").split(',') if name.strip()
+]
+# Used for previews, long tracks and `quality=fast`
+FAST_MODEL = os.getenv('SEPARATION_FAST_MODEL', DEFAULT_MODEL)
+# Used for `quality=high`
+QUALITY_MODEL = os.getenv('SEPARATION_QUALITY_MODEL', 'htdemucs_ft')
+LONG_TRACK_SECONDS = float(os.getenv('SEPARATION_LONG_TRACK_SECONDS', '1200'))
+# Weights kept resident per process before idle models are unloaded
+MEMORY_BUDGET = int(os.getenv('MODEL_MEMORY_BUDGET_MB', '2048')) * 1024 * 1024
+
+QUALITIES = ('fast', 'standard', 'high')
+
+
+class UnknownModelError(ValueError):
+    """A request asked for a model that isn't in `SEPARATION_MODELS`."""
+
+
+def model_spec(name):
+    return KNOWN_MODELS.get(name) or ModelSpec(name, "", 1.0)
+
+
+def list_models():
+    """Describe the models requests may use."""
+    return [
+        {
+            'name': name,
+            'description': model_spec(name).description,
+            'relative_cost': model_spec(name).relative_cost,
+            'default': name == DEFAULT_MODEL
+        }
+        for name in AVAILABLE_MODELS
+    ]
+
+
+def choose_model(requested=None, quality=None, preview=False, duration=None):
+    """Pick the model for a request.
+
+    An explicit `requested` model wins, then the `quality` asked for. By
+    default previews and tracks longer than `SEPARATION_LONG_TRACK_SECONDS`
+    get the fast model and everything else the default one.
+    """
+    if requested:
+        if requested not in AVAILABLE_MODELS:
+            raise UnknownModelError(
+                f"Unknown model {requested}, choose from {', '.join(AVAILABLE_MODELS)}"
+            )
+        return requested
+    if quality == 'high':
+        name = QUALITY_MODEL
+    elif quality == 'fast' or (quality != 'standard' and (
+            preview or (duration is not None and duration > LONG_TRACK_SECONDS))):
+        name = FAST_MODEL
+    else:
+        name = DEFAULT_MODEL
+    return name if name in AVAILABLE_MODELS else DEFAULT_MODEL
+
+
+def model_bytes(model):
+    """Memory held by the weights and buffers of `model`."""
+    if not hasattr(model, 'parameters'):
+        return 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ResidentModels:
+    """Loaded models by name, kept within a memory budget.
+
+    Adding a model unloads the least recently used ones until the weights
+    fit in `budget` bytes. The newest model always stays, even on its own
+    over the budget. A job still running on an unloaded model keeps it alive
+    until it finishes.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            model = self._models.get(name)
+            if model is not None:
+                self._models.move_to_end(name)
+            return model
+
+    def add(self, name, model):
+        size = model_bytes(model)
+        with self._lock:
+            self._models[name] = model
+            self._models.move_to_end(name)
+            self._sizes[name] = size
+            while len(self._models) > 1 and self.total_bytes() > self.budget:
+                idle, _ = self._models.popitem(last=False)
+                del self._sizes[idle]
+                print(f"Unloading model {idle} to stay within the "
+                      f"{self.budget / 1024 ** 2:.0f} MB model budget")
+
+    def total_bytes(self):
+        return sum(self._sizes.values())
+
+    def names(self):
+        """Resident model names, least recently used first."""
+        with self._lock:
+            return list(self._models)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
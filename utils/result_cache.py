@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from utils.audio_io import DEFAULT_OUTPUT
+
+load_dotenv()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Return the sha256 hex digest of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Separation results keyed on the audio content, model and mode.
+
+    The index lives in a SQLite file so it survives restarts and is shared
+    by every gunicorn worker. Entries older than `max_age` seconds are
+    dropped, then the least recently used ones until the stems they point
+    to fit in `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 ** 3, max_age=7 * 24 * 3600):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    downloads TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    separation_time REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    waveforms TEXT
+                )
+            """)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(results)")}
+            if 'waveforms' not in columns:
+                # Indexes written before waveform sidecars existed
+                conn.execute("ALTER TABLE results ADD COLUMN waveforms TEXT")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS stats (
+                    name TEXT PRIMARY KEY,
+                    value REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return closing(conn)
+
+    @staticmethod
+    def key(audio_hash, model_name, mode, window=None, output=DEFAULT_OUTPUT):
+        """Build the cache key for one separation request, or preview `window`.
+
+        `output` is the stem format tag such as `flac` or `opus-96`.
+        """
+        layout = '2' if mode == '2' else '4'
+        key = f"{audio_hash}:{model_name}:{layout}"
+        if window:
+            key += f":{window[0]:g}+{window[1]:g}"
+        if output != DEFAULT_OUTPUT:
+            key += f":{output}"
+        return key
+
+    def get(self, key):
+        """Return the cached entry for `key` or None, updating the hit counters."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM results WHERE key = ? AND created_at >= ?",
+                (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                self._bump(conn, misses=1)
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE results SET last_used_at = ? WHERE key = ?", (now, key))
+            self._bump(conn, hits=1, bytes_saved=row['size_bytes'],
+                       seconds_saved=row['separation_time'])
+            conn.execute("COMMIT")
+        return {
+            'downloads': json.loads(row['downloads']),
+            'waveforms': json.loads(row['waveforms'] or '{}'),
+            'size_bytes': row['size_bytes'],
+            'separation_time': row['separation_time'],
+            'created_at': row['created_at']
+        }
+
+    def put(self, key, downloads, size_bytes, separation_time=0.0, waveforms=None):
+        """Store the downloads and waveforms maps of a finished separation and evict old entries."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO results "
+                "(key, downloads, size_bytes, separation_time, created_at, last_used_at, waveforms) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(downloads), size_bytes, separation_time, now, now, json.dumps(waveforms or {}))
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+
+    def clear(self, before=None):
+        """Forget every entry, or those created `before` a time, e.g. after their stems were deleted."""
+        with self._lock, self._connect() as conn:
+            if before is None:
+                conn.execute("DELETE FROM results")
+            else:
+                conn.execute("DELETE FROM results WHERE created_at < ?", (before,))
+
+    def stats(self):
+        """Return entry count, stored size, hit rate and what hits saved."""
+        with self._connect() as conn:
+            entries, total_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM results"
+            ).fetchone()
+            counters = {
+                row['name']: row['value']
+                for row in conn.execute("SELECT name, value FROM stats")
+            }
+        hits = int(counters.get('hits', 0))
+        misses = int(counters.get('misses', 0))
+        return {
+            'entries': entries,
+            'size_bytes': total_bytes,
+            'max_bytes': self.max_bytes,
+            'max_age': self.max_age,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'bytes_saved': int(counters.get('bytes_saved', 0)),
+            'seconds_saved': counters.get('seconds_saved', 0.0)
+        }
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.max_age,))
+        total_bytes = conn.execute(
+            "SELECT COALESCE(SUM(size_bytes), 0) FROM results"
+        ).fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        for row in conn.execute(
+            "SELECT key, size_bytes FROM results ORDER BY last_used_at"
+        ).fetchall():
+            conn.execute("DELETE FROM results WHERE key = ?", (row['key'],))
+            total_bytes -= row['size_bytes']
+            if total_bytes <= self.max_bytes:
+                break
+
+    def _bump(self, conn, **increments):
+        for name, value in increments.items():
+            conn.execute(
+                "INSERT INTO stats VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, value)
+            )
+
+
+def create_result_cache():
+    """Build the cache configured by the `RESULT_CACHE_*` env vars, or None when disabled."""
+    if os.getenv('RESULT_CACHE_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    return ResultCache(
+        os.getenv('RESULT_CACHE_DB', 'temp/result_cache.db'),
+        max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', str(10 * 1024 ** 3))),
+        max_age=int(os.getenv('RESULT_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+    )
@@ -0,0 +1,237 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Seconds an uploaded stem is kept before the sweeper deletes it
+TTL = int(os.getenv('RETENTION_TTL_SECONDS', str(7 * 24 * 3600)))
+# Seconds between background sweeps of expired stems, 0 to only sweep on request
+SWEEP_INTERVAL = int(os.getenv('RETENTION_SWEEP_INTERVAL', '3600'))
+# delete_objects takes at most 1000 keys
+BATCH_SIZE = 1000
+SWEEP_CONCURRENCY = int(os.getenv('RETENTION_SWEEP_CONCURRENCY', '4'))
+# Objects deleted per second at most, 0 for no limit
+MAX_DELETE_RATE = float(os.getenv('RETENTION_MAX_DELETES_PER_SECOND', '1000'))
+
+EXPIRED = 'expired'
+ALL = 'all'
+SCOPES = (EXPIRED, ALL)
+
+
+class RetentionIndex:
+    """When each uploaded object expires, kept in a SQLite file next to the result cache.
+
+    The sweeper reads the expired keys from here instead of listing the
+    bucket, and drops them once they are deleted, so an interrupted sweep
+    picks up where it stopped. The file also holds the sweep state shared
+    by every gunicorn worker.
+    """
+
+    def __init__(self, path, ttl=TTL):
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    key TEXT PRIMARY KEY,
+                    size_bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS objects_expiry ON objects (expires_at)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS state (
+                    name TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return closing(conn)
+
+    def record(self, key, size_bytes, ttl=None):
+        """Note an uploaded object; it expires `ttl` seconds from now (the index TTL by default)."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                (key, size_bytes, now, now + (self.ttl if ttl is None else ttl))
+            )
+
+    def expired(self, now=None, limit=BATCH_SIZE):
+        """Return up to `limit` `(key, size_bytes)` of expired objects, oldest first."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT key, size_bytes FROM objects WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (time.time() if now is None else now, limit)
+            ).fetchall()
+        return [(row['key'], row['size_bytes']) for row in rows]
+
+    def forget(self, keys):
+        """Drop deleted objects from the index."""
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("DELETE FROM objects WHERE key = ?", [(key,) for key in keys])
+            conn.execute("COMMIT")
+
+    def stats(self, now=None):
+        """Return tracked and expired object counts and sizes."""
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            objects, size_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM objects"
+            ).fetchone()
+            expired, expired_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM objects WHERE expires_at <= ?", (now,)
+            ).fetchone()
+        return {
+            'objects': objects,
+            'size_bytes': size_bytes,
+            'expired': expired,
+            'expired_bytes': expired_bytes,
+            'ttl': self.ttl
+        }
+
+    def get_state(self, name):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return row['value'] if row else None
+
+    def set_state(self, name, value):
+        with self._lock, self._connect() as conn:
+            if value is None:
+                conn.execute("DELETE FROM state WHERE name = ?", (name,))
+            else:
+                conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (name, str(value)))
+
+    def claim_sweep(self, interval, now=None):
+        """Whether a periodic sweep is due, marking it started so other workers skip it."""
+        now = time.time() if now is None else now
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM state WHERE name = 'last_sweep_at'").fetchone()
+            due = row is None or now - float(row['value']) >= interval
+            if due:
+                conn.execute("INSERT OR REPLACE INTO state VALUES ('last_sweep_at', ?)", (str(now),))
+            conn.execute("COMMIT")
+        return due
+
+
+class Sweeper:
+    """Deletes objects from the bucket in concurrent `delete_objects` batches.
+
+    At most `max_rate` objects are deleted per second. Progress is saved
+    after every round of batches: expired objects leave the index, and a
+    sweep of the whole bucket stores the last key it reached, so a sweep
+    that is interrupted resumes from there the next time it runs. Without
+    an `index` only whole-bucket sweeps work, and they start over.
+    """
+
+    def __init__(self, index, s3_client, bucket_name, batch_size=BATCH_SIZE,
+                 concurrency=SWEEP_CONCURRENCY, max_rate=MAX_DELETE_RATE):
+        self.index = index
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_rate = max_rate
+
+    def sweep(self, scope=EXPIRED, report=None, now=None):
+        """Delete the expired objects, or every object of the bucket for scope `all`.
+
+        `report(totals)` is called after each round. Returns the totals:
+        objects deleted, bytes freed and keys that failed to delete.
+        """
+        totals = {'deleted': 0, 'bytes_freed': 0, 'errors': 0, 'resumed': False}
+        start = time.perf_counter()
+        # Keys that failed stay in the index for the next sweep, not the next round
+        failed = set()
+        rounds = self._all_rounds(totals) if scope == ALL else self._expired_rounds(now, failed)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for objects, save_progress in rounds:
+                self._throttle(totals['deleted'] + len(objects), start)
+                batches = [objects[i:i + self.batch_size] for i in range(0, len(objects), self.batch_size)]
+                errors = set().union(*pool.map(self._delete, batches))
+                failed.update(errors)
+                deleted = [(key, size) for key, size in objects if key not in errors]
+                if self.index:
+                    self.index.forget([key for key, _ in deleted])
+                save_progress()
+                totals['deleted'] += len(deleted)
+                totals['bytes_freed'] += sum(size for _, size in deleted)
+                totals['errors'] += len(errors)
+                if report:
+                    report(totals)
+                if not deleted:
+                    break
+        return totals
+
+    def _expired_rounds(self, now, failed):
+        if self.index is None:
+            raise ValueError("Expired objects can't be swept without a retention index")
+        limit = self.batch_size * self.concurrency
+        while True:
+            objects = [(key, size) for key, size in self.index.expired(now, limit + len(failed))
+                       if key not in failed][:limit]
+            if not objects:
+                return
+            yield objects, lambda: None
+
+    def _all_rounds(self, totals):
+        cursor = self.index.get_state('sweep_cursor') if self.index else None
+        totals['resumed'] = cursor is not None
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        options = {'Bucket': self.bucket_name, 'PaginationConfig': {'PageSize': self.batch_size}}
+        if cursor:
+            options['StartAfter'] = cursor
+        objects = []
+        for page in paginator.paginate(**options):
+            objects.extend((obj['Key'], obj['Size']) for obj in page.get('Contents', []))
+            if len(objects) >= self.batch_size * self.concurrency:
+                last_key = objects[-1][0]
+                yield objects, lambda: self._save_cursor(last_key)
+                objects = []
+        if objects:
+            yield objects, lambda: None
+        self._save_cursor(None)
+
+    def _save_cursor(self, key):
+        if self.index:
+            self.index.set_state('sweep_cursor', key)
+
+    def _delete(self, batch):
+        """Delete one batch of at most 1000 objects and return the keys that failed."""
+        response = self.s3_client.delete_objects(
+            Bucket=self.bucket_name,
+            Delete={'Objects': [{'Key': key} for key, _ in batch], 'Quiet': True}
+        )
+        errors = response.get('Errors', [])
+        for error in errors[:3]:
+            print(f"Failed to delete {error['Key']}: {error.get('Message', error.get('Code'))}")
+        return {error['Key'] for error in errors}
+
+    def _throttle(self, deleted, start):
+        if self.max_rate <= 0:
+            return
+        wait = deleted / self.max_rate - (time.perf_counter() - start)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def create_retention_index():
+    """Build the index configured by the `RETENTION_*` env vars, or None when disabled."""
+    if os.getenv('RETENTION_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    return RetentionIndex(os.getenv('RETENTION_DB', 'temp/retention.db'))
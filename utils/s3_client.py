@@ -0,0 +1,179 @@
+import os
+import threading
+from urllib.parse import unquote, urlparse
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MB = 1024 * 1024
+
+# One stem upload per thread, each with up to S3_MAX_CONCURRENCY multipart parts in flight
+MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '8'))
+MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '50'))
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '8')) * MB,
+    multipart_chunksize=int(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', '8')) * MB,
+    max_concurrency=MAX_CONCURRENCY,
+    use_threads=True
+)
+
+# Private stems get no public-read ACL and are only reachable through presigned links
+PRIVATE_OBJECTS = os.getenv('S3_PRIVATE_STEMS', '0').lower() in ('1', 'true', 'yes')
+PRESIGN_EXPIRY = int(os.getenv('S3_PRESIGN_EXPIRY', '3600'))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Return the process-wide S3 client, creating it on first use.
+
+    boto3 clients are thread safe, so every request and upload thread of a
+    worker shares one client and its connection pool.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = boto3.client(
+                    's3',
+                    endpoint_url=os.getenv('AWS_ENDPOINT_URL') or None,
+                    config=Config(
+                        max_pool_connections=MAX_POOL_CONNECTIONS,
+                        signature_version='s3v4',
+                        retries={'max_attempts': 5, 'mode': 'adaptive'}
+                    )
+                )
+    return _client
+
+
+def reset_s3_client():
+    """Forget the shared client, e.g. after the credentials or endpoint changed."""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def public_url(bucket_name, key):
+    """Permanent URL of a public-read object."""
+    return f"https://{bucket_name}.s3.{os.getenv('AWS_DEFAULT_REGION')}.amazonaws.com/{key}"
+
+
+def presigned_url(bucket_name, key, expires_in=None, filename=None):
+    """Temporary GET URL of an object; with `filename` browsers save it under that name."""
+    params = {'Bucket': bucket_name, 'Key': key}
+    if filename:
+        params['ResponseContentDisposition'] = f'attachment; filename="{filename}"'
+    return get_s3_client().generate_presigned_url(
+        'get_object', Params=params, ExpiresIn=expires_in or PRESIGN_EXPIRY
+    )
+
+
+def object_url(bucket_name, key):
+    """Link handed to clients: presigned for private objects, public otherwise."""
+    if PRIVATE_OBJECTS:
+        return presigned_url(bucket_name, key)
+    return public_url(bucket_name, key)
+
+
+def object_key(url, bucket_name):
+    """Key of the object a public or presigned URL points to."""
+    parsed_url = urlparse(url)
+    key = unquote(parsed_url.path).lstrip('/')
+    # Path style URLs (custom endpoints) carry the bucket as the first segment
+    if not parsed_url.netloc.startswith(f"{bucket_name}.") and key.startswith(f"{bucket_name}/"):
+        key = key[len(bucket_name) + 1:]
+    return key
+
+
+def extra_args(content_type):
+    """Upload ExtraArgs for a stem, public-read unless objects are private."""
+    args = {'ContentType': content_type}
+    if not PRIVATE_OBJECTS:
+        args['ACL'] = 'public-read'
+    return args
+
+
+class StreamingUpload:
+    """Multipart upload of a file that is still being written.
+
+    `feed` uploads every complete part written so far on `pool`; `finish`
+    uploads the rest once the file is final. Files that never grew past
+    one part are sent with a single `upload_fileobj` instead.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, extra_args, pool, part_size=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.extra_args = extra_args
+        self.pool = pool
+        self.part_size = part_size or TRANSFER_CONFIG.multipart_chunksize
+        self.offset = 0
+        self.parts = []
+        self.upload_id = None
+
+    def feed(self, path):
+        """Start uploading any complete parts of `path` not sent yet."""
+        with open(path, 'rb') as f:
+            while os.path.getsize(path) - self.offset >= self.part_size:
+                f.seek(self.offset)
+                self._upload_part(f.read(self.part_size))
+
+    def finish(self, path):
+        """Upload the rest of `path` and complete the object."""
+        if self.upload_id is None:
+            with open(path, 'rb') as f:
+                self.s3_client.upload_fileobj(f, self.bucket_name, self.key,
+                                              ExtraArgs=self.extra_args, Config=TRANSFER_CONFIG)
+            return
+
+        try:
+            with open(path, 'rb') as f:
+                f.seek(self.offset)
+                rest = f.read()
+            if rest:
+                self._upload_part(rest)
+            parts = [
+                {'PartNumber': number, 'ETag': future.result()['ETag']}
+                for number, future in self.parts
+            ]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Drop the parts uploaded so far."""
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id
+            )
+            self.upload_id = None
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, **self.extra_args
+            )['UploadId']
+        number = len(self.parts) + 1
+        future = self.pool.submit(
+            self.s3_client.upload_part,
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=body
+        )
+        self.parts.append((number, future))
+        self.offset += len(body)
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Keep each job's audio in a memory backed directory when there is room for it
+SCRATCH_DIR = os.getenv('SEPARATION_SCRATCH_DIR')
+MEMORY_DIR = '/dev/shm'
+MEMORY_MIN_FREE = int(os.getenv('SEPARATION_SCRATCH_MIN_FREE_MB', '1024')) * 1024 * 1024
+# Use the fixed temp/ and separated/<model>/ paths instead, for debugging
+DEBUG_LAYOUT = os.getenv('SEPARATION_DEBUG_LAYOUT', '0').lower() in ('1', 'true', 'yes')
+
+
+def scratch_root():
+    """Directory new job scratch dirs are created in."""
+    if SCRATCH_DIR:
+        return SCRATCH_DIR
+    try:
+        if shutil.disk_usage(MEMORY_DIR).free >= MEMORY_MIN_FREE:
+            return MEMORY_DIR
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+
+@contextmanager
+def job_scratch():
+    """Yield a directory private to one job and delete it, whatever happens, afterwards.
+
+    Yields None when `SEPARATION_DEBUG_LAYOUT` asks for the fixed layout.
+    """
+    if DEBUG_LAYOUT:
+        yield None
+        return
+    path = Path(tempfile.mkdtemp(prefix='stem-splitter-', dir=scratch_root()))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,89 @@
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class SegmentStore:
+    """Separated sources of grid-aligned blocks of a track, kept on local disk.
+
+    Previews separate only the blocks around their window and leave them
+    here, so a later preview or the full track of the same audio picks them
+    up instead of separating them again. Blocks are stored as float16 under
+    `<root>/<track key>/<index>.npy`; the least recently used files go once
+    the store is over `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3):
+        self.root = Path(os.path.abspath(root))
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(audio_hash, model_name, samplerate, block, padding):
+        """Track key: blocks are only interchangeable on the same grid."""
+        return f"{audio_hash}-{model_name}-{samplerate}-{block}-{padding}"
+
+    def _path(self, key, index):
+        return self.root / key / f"{index}.npy"
+
+    def has(self, key):
+        """Whether any block of `key` is stored."""
+        directory = self.root / key
+        return directory.is_dir() and any(directory.glob('*.npy'))
+
+    def get(self, key, index):
+        """Return the `[sources, channels, samples]` tensor of a block, or None."""
+        path = self._path(key, index)
+        try:
+            sources = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return torch.from_numpy(sources.astype(np.float32))
+
+    def put(self, key, index, sources):
+        """Store the separated sources of a block and evict old blocks."""
+        path = self._path(key, index)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(partial, 'wb') as f:
+            np.save(f, sources.numpy().astype(np.float16))
+        os.replace(partial, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            for path in self.root.glob('*/*.npy'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                try:
+                    path.parent.rmdir()
+                except OSError:
+                    pass
+
+
+def create_segment_store():
+    """Build the store configured by the `SEGMENT_STORE_*` env vars, or None when disabled."""
+    if os.getenv('SEGMENT_STORE_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    return SegmentStore(
+        os.getenv('SEGMENT_STORE_DIR', 'temp/segments'),
+        max_bytes=int(os.getenv('SEGMENT_STORE_MAX_BYTES', str(2 * 1024 ** 3)))
+    )
@@ -0,0 +1,612 @@
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from pathlib import Path
+from time import perf_counter
+
+import julius
+import soundfile as sf
+import torch
+import torch.nn.functional as F
+from demucs.apply import TensorChunk, apply_model
+from demucs.audio import convert_audio, convert_audio_channels
+from demucs.pretrained import get_model
+from demucs.utils import center_trim
+from dotenv import load_dotenv
+
+from utils.audio_io import OUTPUT_FORMATS, decode, encode, fit_full_scale, open_stem_writer, probe
+from utils.batch_scheduler import BatchScheduler
+from utils.inference_backend import BACKEND, build_model, model_variant
+from utils.inference_pool import (
+    CPU_AFFINITY, HOST_WORKERS, PROCESSES, InferencePool, claim_slot, parse_affinity, worker_cpus
+)
+from utils.model_registry import DEFAULT_MODEL, MEMORY_BUDGET, ResidentModels
+from utils.waveform import PEAKS_ENABLED, PeakBuilder, peaks_path
+
+load_dotenv()
+
+DEVICE = os.getenv('DEMUCS_DEVICE', 'cuda' if torch.cuda.is_available() else 'cpu')
+OVERLAP = 0.25
+BATCH_SIZE = int(os.getenv('SEPARATION_BATCH_SIZE', '1'))
+BATCH_WAIT = float(os.getenv('SEPARATION_BATCH_WAIT_MS', '50')) / 1000
+STREAM_WINDOW = float(os.getenv('SEPARATION_STREAM_WINDOW', '30'))
+MP3_PRESET = int(os.getenv('STEM_MP3_PRESET', '2'))
+# Stems are encoded on this many threads; lameenc and libsndfile release the GIL
+ENCODE_WORKERS = int(os.getenv('STEM_ENCODE_WORKERS', '4'))
+# Extra samples decoded around a streamed window so resampling has context at its edges
+RESAMPLE_CONTEXT = 1024
+# Previews are separated in blocks on this grid, each with `PREVIEW_PADDING`
+# seconds of context on either side, so overlapping requests share blocks
+PREVIEW_BLOCK = float(os.getenv('PREVIEW_BLOCK_SECONDS', '10'))
+PREVIEW_PADDING = float(os.getenv('PREVIEW_PADDING_SECONDS', '2'))
+
+# Response key -> file name (without extension) for each separation mode.
+# Mode "2" matches `demucs --two-stems vocals`, anything else is the 4 stem split.
+STEM_LAYOUTS = {
+    '2': {
+        'vocals': 'vocals',
+        'instrumental': 'no_vocals'
+    },
+    '4': {
+        'vocals': 'vocals',
+        'drums': 'drums',
+        'bass': 'bass',
+        'other': 'other'
+    }
+}
+
+_models = ResidentModels(MEMORY_BUDGET)
+_model_lock = threading.Lock()
+_inference_pool = None
+_pool_lock = threading.Lock()
+
+
+def stem_layout(mode):
+    """Return the stem layout used for the given separation mode."""
+    return STEM_LAYOUTS['2'] if mode == '2' else STEM_LAYOUTS['4']
+
+
+def load_model(name=DEFAULT_MODEL):
+    """Return the resident model for `name`, loading it on first use.
+
+    Models stay loaded until the `MODEL_MEMORY_BUDGET_MB` budget pushes
+    out the least recently used ones, so every gunicorn worker pays a
+    checkpoint load once per model. With an inference pool the weights
+    live in the pool processes and this returns their `ModelInfo` instead.
+    Returns `(model, load_time)` where `load_time` is 0 when the model was
+    already resident.
+    """
+    model = _models.get(name)
+    if model is not None:
+        return model, 0.0
+
+    with _model_lock:
+        model = _models.get(name)
+        if model is not None:
+            return model, 0.0
+
+        load_start = perf_counter()
+        pool = get_inference_pool()
+        if pool is not None:
+            print(f"Loading Demucs model {name} in the inference pool")
+            model = pool.model_info(name)
+        else:
+            model = load_weights(name)
+        _models.add(name, model)
+        return model, perf_counter() - load_start
+
+
+def load_weights(name):
+    """Load `name` onto `DEVICE` as built by the `INFERENCE_BACKEND`, ready for inference."""
+    print(f"Loading Demucs model {name} on {DEVICE} ({BACKEND} backend)")
+    return build_model(name, load_checkpoint)
+
+
+def load_checkpoint(name):
+    """Load the plain float checkpoint of `name` onto `DEVICE`."""
+    model = get_model(name)
+    model.to(DEVICE)
+    model.eval()
+    return model
+
+
+def resident_models():
+    """Names of the models loaded in this process, least recently used first."""
+    return _models.names()
+
+
+def unload_models():
+    """Drop every resident model (mostly useful for tests)."""
+    with _model_lock:
+        _models.clear()
+
+
+def load_track(path, samplerate, channels, start=None, stop=None):
+    """Decode `path` into a `[channels, samples]` float tensor at `samplerate`.
+
+    `start` and `stop`, in samples at `samplerate`, decode only that part.
+    """
+    if start is None and stop is None:
+        data, source_rate = decode(path, samplerate, channels)
+        return convert_audio(torch.from_numpy(data), source_rate, samplerate, channels)
+
+    start = start or 0
+    duration = None if stop is None else (stop - start) / samplerate
+    data, source_rate = decode(path, samplerate, channels, start / samplerate, duration)
+    wav = convert_audio(torch.from_numpy(data), source_rate, samplerate, channels)
+    if stop is not None:
+        wav = wav[:, :stop - start]
+        wav = F.pad(wav, (0, stop - start - wav.shape[-1]))
+    return wav
+
+
+def track_length(path, samplerate):
+    """Length of the track at `path` in samples at `samplerate`."""
+    info = probe(path)
+    return int(info.frames * samplerate / info.samplerate)
+
+
+def segment_length(model):
+    """Samples per inference segment (the shortest training segment in a bag)."""
+    models = getattr(model, 'models', [model])
+    return int(min(float(sub_model.segment) for sub_model in models) * model.samplerate)
+
+
+def run_model(model, segments):
+    """Run `model` on a `[batch, channels, samples]` stack of equal length segments."""
+    with torch.no_grad():
+        return apply_model(model, segments, device=DEVICE, shifts=0, split=False)
+
+
+def run_segments(model, segments):
+    """Run each segment through the model on its own, in order."""
+    for segment in segments:
+        yield run_model(model, segment[None])[0]
+
+
+_batch_scheduler = BatchScheduler(run_model, BATCH_SIZE, BATCH_WAIT) if BATCH_SIZE > 1 else None
+
+
+def get_inference_pool():
+    """Return the shared inference pool, started on first use, or None with `INFERENCE_PROCESSES=0`."""
+    global _inference_pool
+    if _inference_pool is None and PROCESSES > 0:
+        with _pool_lock:
+            if _inference_pool is None:
+                # Every gunicorn worker has a pool; each keeps to its own share of the CPUs
+                slot = claim_slot()
+                cpus = worker_cpus(slot)
+                affinity = parse_affinity(CPU_AFFINITY, PROCESSES, cpus, offset=slot * PROCESSES)
+                _inference_pool = InferencePool(load_weights, run_model, PROCESSES, affinity=affinity, cpus=cpus)
+                print(f"Started {PROCESSES} inference processes with {_inference_pool.threads} torch threads "
+                      f"each, web worker slot {slot} of {HOST_WORKERS} ({len(cpus)} CPUs)")
+    return _inference_pool
+
+
+def segment_runner(model_name):
+    """Return the `(model, segments) -> outputs` runner to use for `model_name`.
+
+    With `INFERENCE_PROCESSES` set, segments run in the inference pool.
+    Otherwise, with `SEPARATION_BATCH_SIZE` above 1, they go through the
+    shared batch scheduler so concurrent jobs on the same model run together.
+    """
+    pool = get_inference_pool()
+    if pool is not None:
+        return lambda model, segments: pool.run(model_name, model, segments)
+    if _batch_scheduler is None:
+        return run_segments
+    return lambda model, segments: _batch_scheduler.run(model_name, model, segments)
+
+
+def window_bounds(length, window, overlap):
+    """Yield `(start, stop)` of windows covering `length` samples, overlapping by `overlap`."""
+    start = 0
+    while True:
+        stop = min(start + window, length)
+        yield start, stop
+        if stop >= length:
+            return
+        start += window - overlap
+
+
+def _read_range(snd, start, stop, samplerate, channels):
+    """Read samples `[start, stop)` at `samplerate` from an open SoundFile."""
+    if snd.samplerate == samplerate:
+        snd.seek(start)
+        data = snd.read(stop - start, dtype='float32', always_2d=True)
+        wav = torch.from_numpy(data.T.copy())
+    else:
+        # Read whole resampling blocks so the window lands on exact output samples
+        common = math.gcd(snd.samplerate, samplerate)
+        src_step, dst_step = snd.samplerate // common, samplerate // common
+        first = max(0, (start - RESAMPLE_CONTEXT) // dst_step)
+        last = (stop + RESAMPLE_CONTEXT) // dst_step + 1
+        snd.seek(first * src_step)
+        data = snd.read((last - first) * src_step, dtype='float32', always_2d=True)
+        wav = julius.resample_frac(torch.from_numpy(data.T.copy()), snd.samplerate, samplerate)
+        skip = start - first * dst_step
+        wav = wav[..., skip:skip + stop - start]
+    return convert_audio_channels(wav, channels)
+
+
+def track_windows(path, samplerate, channels, window, overlap):
+    """Yield `[channels, samples]` windows of `path` that overlap by `overlap` samples.
+
+    Only the current window is decoded. `path` may also be a seekable file
+    object. Files libsndfile can't seek in are decoded whole by ffmpeg and
+    sliced instead.
+    """
+    try:
+        snd = sf.SoundFile(path if hasattr(path, 'read') else str(path))
+    except RuntimeError:
+        wav = load_track(path, samplerate, channels)
+        for start, stop in window_bounds(wav.shape[-1], window, overlap):
+            yield wav[..., start:stop]
+        return
+
+    with snd:
+        length = snd.frames * samplerate // snd.samplerate
+        for start, stop in window_bounds(length, window, overlap):
+            yield _read_range(snd, start, stop, samplerate, channels)
+
+
+def separate_tensor(model, wav, runner=run_segments):
+    """Run `model` over a `[channels, samples]` mix and return `[sources, channels, samples]`.
+
+    The mix is cut into overlapping segments of the model's training length,
+    `runner` turns them into per-source outputs and the outputs are
+    overlap-added back with triangular weights, like `apply_model(split=True)`.
+    """
+    return torch.cat(list(separate_chunks(model, wav, runner)), dim=-1)
+
+
+def separate_chunks(model, wav, runner=run_segments, start=0):
+    """Like `separate_tensor`, but yield the sources from sample `start` on in finished chunks.
+
+    A chunk comes out as soon as no later segment overlaps it. Only the
+    segments that reach past `start` are run, and the samples are the same
+    as those `separate_tensor` returns.
+    """
+    ref = wav.mean(0)
+    mean = ref.mean()
+    std = ref.std()
+    if not std > 0:
+        std = torch.tensor(1.0)
+    mix = (wav - mean) / std
+
+    channels, length = mix.shape
+    seg_length = segment_length(model)
+    stride = int((1 - OVERLAP) * seg_length)
+    # Segments ending before `start` add nothing to what is left
+    first = max((start - seg_length) // stride + 1, 0)
+    offsets = range(first * stride, length, stride)
+    weight = torch.cat([
+        torch.arange(1, seg_length // 2 + 1),
+        torch.arange(seg_length - seg_length // 2, 0, -1)
+    ]).float()
+    weight /= weight.max()
+
+    out = torch.zeros(len(model.sources), channels, length)
+    sum_weight = torch.zeros(length)
+    segments = (TensorChunk(mix, offset, seg_length).padded(seg_length) for offset in offsets)
+    done = start
+    for offset, segment_out in zip(offsets, runner(model, segments)):
+        chunk_length = min(seg_length, length - offset)
+        segment_out = center_trim(segment_out.cpu(), chunk_length)
+        out[..., offset:offset + chunk_length] += weight[:chunk_length] * segment_out
+        sum_weight[offset:offset + chunk_length] += weight[:chunk_length]
+        finished = min(offset + stride, length)
+        if finished > done:
+            yield out[..., done:finished] / sum_weight[done:finished] * std + mean
+            done = finished
+
+
+def mix_stems(model, sources, mode):
+    """Map model sources onto the stem layout of `mode`."""
+    named = dict(zip(model.sources, sources))
+    if mode == '2':
+        vocals = named.pop('vocals')
+        return {'vocals': vocals, 'no_vocals': sum(named.values())}
+    return named
+
+
+def separate_blocks(model, input_path, start, stop, length, runner=run_segments, store=None,
+                    store_key=None, block_seconds=PREVIEW_BLOCK, padding_seconds=PREVIEW_PADDING,
+                    timings=None):
+    """Separate samples `start` to `stop` of `input_path` block by block on a fixed grid.
+
+    Each block is decoded and separated with `padding_seconds` of context on
+    either side; neighbouring blocks are crossfaded over their shared padding.
+    Blocks found in the `SegmentStore` under `store_key` are reused, the
+    others are added to it. Returns `[sources, channels, stop - start]`.
+    """
+    timings = {} if timings is None else timings
+    for name in ('decode_time', 'inference_time', 'blocks_reused', 'blocks_separated'):
+        timings.setdefault(name, 0)
+    block = int(block_seconds * model.samplerate)
+    padding = int(padding_seconds * model.samplerate)
+    first, last = start // block, (stop - 1) // block
+    low = max(first * block - padding, 0)
+    high = min((last + 1) * block + padding, length)
+
+    out = torch.zeros(len(model.sources), model.audio_channels, high - low)
+    total_weight = torch.zeros(high - low)
+    ramp = torch.linspace(0, 1, 2 * padding + 2)[1:-1]
+    for index in range(first, last + 1):
+        block_start = max(index * block - padding, 0)
+        block_stop = min((index + 1) * block + padding, length)
+        sources = store.get(store_key, index) if store else None
+        if sources is not None and sources.shape[-1] == block_stop - block_start:
+            timings['blocks_reused'] += 1
+        else:
+            decode_start = perf_counter()
+            wav = load_track(input_path, model.samplerate, model.audio_channels, block_start, block_stop)
+            inference_start = perf_counter()
+            timings['decode_time'] += inference_start - decode_start
+            sources = separate_tensor(model, wav, runner)
+            timings['inference_time'] += perf_counter() - inference_start
+            timings['blocks_separated'] += 1
+            if store:
+                store.put(store_key, index, sources)
+
+        weight = torch.ones(block_stop - block_start)
+        fade = min(2 * padding, len(weight))
+        if fade and block_start > 0:
+            weight[:fade] = ramp[:fade]
+        if fade and block_stop < length:
+            weight[-fade:] = torch.minimum(weight[-fade:], ramp.flip(0)[-fade:])
+        out[..., block_start - low:block_stop - low] += weight * sources
+        total_weight[block_start - low:block_stop - low] += weight
+    out /= total_weight
+    return out[..., start - low:stop - low]
+
+
+def stem_paths(output_dir, mode, output_format='mp3'):
+    """Map each file stem of `mode` to its path under `output_dir` for `output_format`."""
+    extension = OUTPUT_FORMATS[output_format][0]
+    return {file_stem: Path(output_dir) / f"{file_stem}{extension}" for file_stem in stem_layout(mode).values()}
+
+
+def write_stem(path, wav, samplerate, bitrate=None, peaks=PEAKS_ENABLED):
+    """Encode one stem to `path`, with its waveform peaks sidecar when `peaks` is set."""
+    # Peaks are taken from the audio as encoded, after any scaling down
+    wav = fit_full_scale(wav)
+    encode(path, wav, samplerate, bitrate=bitrate)
+    if peaks:
+        builder = PeakBuilder(samplerate)
+        builder.add(wav)
+        builder.write(peaks_path(path))
+
+
+def open_checkpoint(checkpoints, audio_hash, model_name, layout):
+    """Checkpoint of separating `audio_hash` with `model_name` cut as `layout`.
+
+    None without a store, or while another job on the same audio holds it.
+    """
+    if not (checkpoints and audio_hash):
+        return None
+    return checkpoints.open(checkpoints.key(audio_hash, model_variant(model_name), layout))
+
+
+def separate_file(input_path, output_dir, mode="2", model_name=DEFAULT_MODEL, on_stem=None,
+                  window=None, segment_store=None, audio_hash=None, output_format='mp3', bitrate=None,
+                  peaks=PEAKS_ENABLED, checkpoints=None):
+    """Separate `input_path` into stems written under `output_dir`.
+
+    Stems are written as `output_format` (a key of `OUTPUT_FORMATS`) at
+    `bitrate` kbps for the lossy formats, all stems encoded in parallel.
+    With `peaks` each stem gets a waveform sidecar at `peaks_path(stem)`,
+    written before `on_stem` is called for it.
+    Returns `(stems_files, timings)` where `stems_files` maps the response
+    stem names to file paths and `timings` holds the model load, decode,
+    inference and encode durations and the `audio_duration` separated, in
+    seconds. `on_stem(stem, path)` is
+    called as soon as each stem file is complete, while others are still
+    being encoded.
+
+    A `window` of `(start, duration)` seconds separates only that part of
+    the track, in blocks that are kept in `segment_store` under the
+    track's `audio_hash`. A full track whose blocks were stored by earlier
+    previews is separated the same way so those blocks are reused.
+    Otherwise, with a `CheckpointStore` as `checkpoints`, the stems are
+    saved chunk by chunk as they are finished so a retry after a crash
+    resumes the inference where it stopped; `timings['resumed_duration']`
+    holds the seconds of audio reused.
+    """
+    timings = {}
+    model, timings['model_load_time'] = load_model(model_name)
+    runner = segment_runner(model_name)
+
+    store_key = None
+    if segment_store and audio_hash:
+        store_key = segment_store.key(audio_hash, model_variant(model_name), model.samplerate,
+                                      PREVIEW_BLOCK, PREVIEW_PADDING)
+    if window or (store_key and segment_store.has(store_key)):
+        length = track_length(input_path, model.samplerate)
+        start, stop = 0, length
+        if window:
+            start = int(window[0] * model.samplerate)
+            stop = min(start + int(window[1] * model.samplerate), length)
+            if start >= length:
+                raise ValueError(f"Preview starts after the end of the {length / model.samplerate:.1f}s track")
+        sources = separate_blocks(model, input_path, start, stop, length, runner,
+                                  segment_store if store_key else None, store_key, timings=timings)
+        stems = mix_stems(model, sources, mode)
+    else:
+        decode_start = perf_counter()
+        wav = load_track(input_path, model.samplerate, model.audio_channels)
+        timings['decode_time'] = perf_counter() - decode_start
+
+        inference_start = perf_counter()
+        # Blocks are kept in the segment store already, only whole tracks need checkpoints
+        checkpoint = open_checkpoint(checkpoints, audio_hash, model_name, f"full{len(stem_layout(mode))}")
+        if checkpoint:
+            try:
+                chunks = separate_chunks(model, wav, runner, start=checkpoint.samples)
+                chunks = list(checkpointed_stems(model, mode, ((sources, None) for sources in chunks), checkpoint))
+                stems = {file_stem: torch.cat([chunk[file_stem] for chunk in chunks], dim=-1)
+                         for file_stem in chunks[0]}
+                timings['resumed_duration'] = checkpoint.resumed / model.samplerate
+                checkpoint.finish()
+            finally:
+                checkpoint.close()
+        else:
+            stems = mix_stems(model, separate_tensor(model, wav, runner), mode)
+        timings['inference_time'] = perf_counter() - inference_start
+
+    timings['audio_duration'] = next(iter(stems.values())).shape[-1] / model.samplerate
+    encode_start = perf_counter()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = stem_paths(output_dir, mode, output_format)
+    stems_files = {}
+    with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as pool:
+        encodes = {
+            pool.submit(write_stem, paths[file_stem], stems[file_stem], model.samplerate, bitrate, peaks): stem
+            for stem, file_stem in stem_layout(mode).items()
+        }
+        for future in as_completed(encodes):
+            future.result()
+            stem = encodes[future]
+            stems_files[stem] = str(paths[stem_layout(mode)[stem]])
+            if on_stem:
+                on_stem(stem, stems_files[stem])
+    timings['encode_time'] = perf_counter() - encode_start
+
+    return stems_files, timings
+
+
+def stream_sources(model, windows, runner=run_segments, tail=None):
+    """Separate overlapping windows and yield finished `[sources, channels, samples]` chunks.
+
+    Consecutive windows must overlap by one model segment. The overlap is
+    crossfaded linearly, so each chunk is final once yielded. Each chunk
+    comes with the tail to pass back as `tail` to carry on after it with
+    the next window, None after the last chunk.
+    """
+    overlap = segment_length(model)
+    fade = torch.linspace(0, 1, overlap)
+    for wav in windows:
+        sources = separate_tensor(model, wav, runner)
+        if tail is not None:
+            n = tail.shape[-1]
+            sources[..., :n] = tail * (1 - fade[:n]) + sources[..., :n] * fade[:n]
+        keep = max(sources.shape[-1] - overlap, 0)
+        tail = sources[..., keep:].clone()
+        yield sources[..., :keep], tail
+    if tail is not None:
+        yield tail, None
+
+
+def checkpointed_stems(model, mode, chunks, checkpoint=None):
+    """Yield `mix_stems` of `(sources, state)` chunks, after the stems `checkpoint` saved.
+
+    Every new chunk of stems is saved to `checkpoint` with its state, so
+    only the stems of `mode` are kept, already overlap-added.
+    """
+    file_stems = list(stem_layout(mode).values())
+    if checkpoint:
+        for saved in checkpoint.chunks():
+            yield dict(zip(file_stems, saved))
+    for sources, state in chunks:
+        stems = mix_stems(model, sources, mode)
+        if checkpoint:
+            checkpoint.save(torch.stack([stems[file_stem] for file_stem in file_stems]), state)
+        yield stems
+
+
+def _timed(iterable, timings, key):
+    """Yield from `iterable`, adding the time spent producing items to `timings[key]`."""
+    iterator = iter(iterable)
+    while True:
+        start = perf_counter()
+        item = next(iterator, None)
+        timings[key] += perf_counter() - start
+        if item is None:
+            return
+        yield item
+
+
+def separate_file_streaming(input_path, output_dir, mode="2", model_name=DEFAULT_MODEL,
+                            window_seconds=STREAM_WINDOW, on_stem=None, on_chunk=None,
+                            output_format='mp3', bitrate=None, peaks=PEAKS_ENABLED,
+                            checkpoints=None, audio_hash=None):
+    """Separate `input_path` window by window so memory stays flat whatever its length.
+
+    Decoded windows go through `stream_sources` and finished audio is handed
+    straight to the stem encoders, which run in parallel, and to the peak
+    builders when `peaks` is set. `on_chunk(stems_files)` is called after
+    every chunk is flushed to the partial stem files, `on_stem(stem, path)`
+    once each file and its peaks sidecar are complete. Stems are
+    checkpointed under `audio_hash` like in `separate_file`, window by
+    window; a resumed job still encodes the whole track, but only runs the
+    model on the windows that are left. Returns `(stems_files, timings)`
+    like `separate_file`.
+    """
+    timings = {'decode_time': 0.0, 'inference_time': 0.0, 'encode_time': 0.0, 'audio_duration': 0.0}
+    model, timings['model_load_time'] = load_model(model_name)
+    overlap = segment_length(model)
+    window = max(int(window_seconds * model.samplerate), 2 * overlap)
+    runner = segment_runner(model_name)
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = stem_paths(output_dir, mode, output_format)
+    stems_files = {stem: str(paths[file_stem]) for stem, file_stem in stem_layout(mode).items()}
+    writers = {
+        file_stem: open_stem_writer(path, model.samplerate, model.audio_channels, bitrate, preset=MP3_PRESET)
+        for file_stem, path in paths.items()
+    }
+    builders = {file_stem: PeakBuilder(model.samplerate) for file_stem in paths} if peaks else {}
+    pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+
+    def write(file_stem, wav):
+        writers[file_stem].write(wav)
+        if peaks:
+            builders[file_stem].add(wav)
+
+    checkpoint = open_checkpoint(checkpoints, audio_hash, model_name, f"stream{window}-{len(stem_layout(mode))}")
+    try:
+        windows = track_windows(input_path, model.samplerate, model.audio_channels, window, overlap)
+        tail = None
+        if checkpoint:
+            # Each saved chunk finished a window; the last one saved its crossfade tail
+            windows = islice(windows, checkpoint.saved, None)
+            tail = checkpoint.state()
+        chunks = _timed(
+            checkpointed_stems(model, mode,
+                               stream_sources(model, _timed(windows, timings, 'decode_time'), runner, tail),
+                               checkpoint),
+            timings, 'inference_time'
+        )
+        for stems in chunks:
+            encode_start = perf_counter()
+            list(pool.map(lambda file_stem: write(file_stem, stems[file_stem]), writers))
+            timings['encode_time'] += perf_counter() - encode_start
+            timings['audio_duration'] += next(iter(stems.values())).shape[-1] / model.samplerate
+            if on_chunk:
+                on_chunk(stems_files)
+    except BaseException:
+        if checkpoint:
+            checkpoint.close()
+        raise
+    finally:
+        encode_start = perf_counter()
+        list(pool.map(lambda writer: writer.close(), writers.values()))
+        pool.shutdown()
+        for file_stem, builder in builders.items():
+            builder.write(peaks_path(paths[file_stem]))
+        timings['encode_time'] += perf_counter() - encode_start
+
+    if checkpoint:
+        timings['resumed_duration'] = checkpoint.resumed / model.samplerate
+        checkpoint.finish()
+    if on_stem:
+        for stem, stem_path in stems_files.items():
+            on_stem(stem, stem_path)
+
+    # Decoding happens inside the inference iterator, don't count it twice
+    timings['inference_time'] -= timings['decode_time']
+    return stems_files, timings
@@ -0,0 +1,109 @@
+import contextvars
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from time import perf_counter
+
+from dotenv import load_dotenv
+
+from utils.metrics import stage_seconds
+
+load_dotenv()
+
+# Print every finished span as a JSON line; spans are still kept on the trace when off
+TRACE_LOG = os.getenv('TRACING_ENABLED', '1').lower() not in ('0', 'false', 'no')
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """The spans of one job, each logged as a JSON line when it ends.
+
+    Spans are flat: every one carries the `trace_id` (the job id for queued
+    jobs) so a job's lines can be grepped out of interleaved worker logs.
+    """
+
+    def __init__(self, name, trace_id=None, log=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.log = TRACE_LOG if log is None else log
+        self.attributes = attributes
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the block as span `name`; the caller may add attributes to the yielded dict."""
+        start_time = time.time()
+        start = perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes['error'] = str(e)
+            raise
+        finally:
+            self.record(name, perf_counter() - start, start_time, **attributes)
+
+    def record(self, name, duration, start_time=None, **attributes):
+        """Add a span that was timed elsewhere, e.g. a stage measured by the engine."""
+        span = {
+            'trace_id': self.trace_id,
+            'trace': self.name,
+            'span': name,
+            'start': time.time() - duration if start_time is None else start_time,
+            'duration': duration,
+            **attributes
+        }
+        self.spans.append(span)
+        if self.log:
+            print(json.dumps(span, default=str))
+        return span
+
+    def event(self, name, **attributes):
+        """Add a zero-length span, for things that happen rather than take time."""
+        return self.record(name, 0.0, **attributes)
+
+    def durations(self):
+        """Total seconds per span name."""
+        totals = {}
+        for span in self.spans:
+            totals[span['span']] = totals.get(span['span'], 0.0) + span['duration']
+        return totals
+
+
+@contextmanager
+def start_trace(name, trace_id=None, log=None, **attributes):
+    """Make a new trace current for the block, which is its root span."""
+    trace = Trace(name, trace_id, log, **attributes)
+    token = _current.set(trace)
+    try:
+        with trace.span(name, **attributes):
+            yield trace
+    finally:
+        _current.reset(token)
+
+
+def current_trace():
+    """The trace of the running job, or a fresh one outside of any."""
+    return _current.get() or Trace('untraced')
+
+
+def record_stage(name, seconds, start_time=None, **attributes):
+    """Add a pipeline stage to the job's trace and to the stage histogram."""
+    stage_seconds.observe(seconds, stage=name)
+    current_trace().record(name, seconds, start_time, **attributes)
+
+
+@contextmanager
+def stage(name, **attributes):
+    """Time the block as pipeline stage `name`, see `record_stage`."""
+    start_time = time.time()
+    start = perf_counter()
+    try:
+        yield attributes
+    except Exception as e:
+        attributes['error'] = str(e)
+        raise
+    finally:
+        record_stage(name, perf_counter() - start, start_time, **attributes)
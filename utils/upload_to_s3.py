@@ -1,17 +1,18 @@
-import boto3
 import os
 from dotenv import load_dotenv
 import io
 import uuid
+from utils.audio_io import content_type
+from utils.s3_client import TRANSFER_CONFIG, extra_args, get_s3_client, object_url
 
 load_dotenv()
 
 def upload_to_s3(file_content, filename, bucket_name=None):
-    """Upload a file to S3 and return the public URL"""
+    """Upload a file to S3 and return its download URL"""
     if bucket_name is None:
         bucket_name = os.getenv('AWS_BUCKET_NAME')
     
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
     safe_filename = f"{uuid.uuid4().hex}_{filename}"
     s3_path = f"stems/{safe_filename}"
     
@@ -21,11 +22,9 @@ def upload_to_s3(file_content, filename, bucket_name=None):
         s3_upload_buffer,
         bucket_name,
         s3_path,
-        ExtraArgs={
-            'ContentType': 'audio/mpeg',
-            'ACL': 'public-read'
-        }
+        ExtraArgs=extra_args(content_type(filename, default='audio/mpeg')),
+        Config=TRANSFER_CONFIG
     )
     
-    # Return the public URL
-    return f"https://{bucket_name}.s3.{os.getenv('AWS_DEFAULT_REGION')}.amazonaws.com/{s3_path}"
\ No newline at end of file
+    # Public URL, or a presigned one for private stems
+    return object_url(bucket_name, s3_path)
\ No newline at end of file
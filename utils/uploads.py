@@ -0,0 +1,129 @@
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+from dotenv import load_dotenv
+from flask import Request
+from werkzeug.utils import secure_filename
+
+from utils.ingest import MAX_BYTES, MB
+
+load_dotenv()
+
+# Audio sent with the request waits here until its job moves it into the job's scratch
+# directory; it must be shared by every gunicorn worker, as any of them may run the job
+UPLOAD_DIR = os.getenv('SEPARATION_UPLOAD_DIR', 'temp/uploads')
+# Seconds before an upload no job picked up is deleted
+UPLOAD_TTL = int(os.getenv('SEPARATION_UPLOAD_TTL', str(24 * 3600)))
+CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_KB', '256')) * 1024
+# Room for the other form fields of a multipart request
+FORM_OVERHEAD = 1024 * 1024
+
+# Extension of raw bodies sent without a file name
+MIME_EXTENSIONS = {
+    'audio/mpeg': 'mp3',
+    'audio/mp3': 'mp3',
+    'audio/wav': 'wav',
+    'audio/wave': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/mp4': 'm4a',
+    'audio/m4a': 'm4a',
+    'audio/x-m4a': 'm4a',
+}
+
+
+class UploadTooLarge(Exception):
+    """The uploaded audio is bigger than the ingestion size limit."""
+
+    def __init__(self, max_bytes):
+        super().__init__(f"Audio file is larger than the {max_bytes / MB:g} MB limit")
+        self.max_bytes = max_bytes
+
+
+def new_upload_path(filename, upload_dir=None):
+    """Fresh path under the upload directory for a file called `filename`."""
+    directory = Path(upload_dir or UPLOAD_DIR) / uuid.uuid4().hex
+    directory.mkdir(parents=True)
+    return directory / (secure_filename(filename or '') or 'upload')
+
+
+def is_upload(path, upload_dir=None):
+    """Whether `path` is a file this module created under the upload directory."""
+    root = os.path.abspath(upload_dir or UPLOAD_DIR)
+    return os.path.abspath(path).startswith(root + os.sep)
+
+
+def save_stream(stream, path, max_bytes=MAX_BYTES, chunk_size=CHUNK_SIZE):
+    """Copy `stream` to `path` chunk by chunk and return the bytes written.
+
+    Raises `UploadTooLarge`, leaving nothing behind, past `max_bytes`.
+    """
+    written = 0
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                f.write(chunk)
+    except BaseException:
+        discard_upload(path)
+        raise
+    return written
+
+
+def discard_upload(path):
+    """Delete an upload and its directory."""
+    path = Path(path)
+    if is_upload(path):
+        shutil.rmtree(path.parent, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+
+
+def prune_uploads(older_than=None, upload_dir=None):
+    """Delete uploads older than `UPLOAD_TTL` seconds that no job took, and return how many."""
+    root = Path(upload_dir or UPLOAD_DIR)
+    cutoff = time.time() - (UPLOAD_TTL if older_than is None else older_than)
+    pruned = 0
+    try:
+        directories = list(root.iterdir())
+    except FileNotFoundError:
+        return 0
+    for directory in directories:
+        try:
+            if directory.stat().st_mtime < cutoff:
+                shutil.rmtree(directory, ignore_errors=True)
+                pruned += 1
+        except FileNotFoundError:
+            pass
+    return pruned
+
+
+class UploadRequest(Request):
+    """Request that can write its multipart file parts straight into the upload directory.
+
+    Routes taking audio set `upload_to_disk` before reading `files`, and
+    `upload_paths` lists what was written; Werkzeug would otherwise spool
+    the parts into a temporary file first (or keep small ones in memory),
+    and the job would then copy them once more. Other routes parse files
+    the usual way.
+    """
+
+    upload_to_disk = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_paths = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not self.upload_to_disk:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        path = new_upload_path(filename)
+        self.upload_paths.append(path)
+        return open(path, 'wb+')
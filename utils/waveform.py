@@ -0,0 +1,105 @@
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Write waveform peak sidecars next to the stems so clients can draw them without the audio
+PEAKS_ENABLED = os.getenv('WAVEFORM_PEAKS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+# Samples per peak of each resolution, each a multiple of the finest
+LEVELS = [int(level) for level in os.getenv('WAVEFORM_LEVELS', '256,1024,4096').split(',')]
+SUFFIX = '.peaks.dat'
+
+# audiowaveform .dat version 2 header: version, flags (1 = 8 bit), sample rate,
+# samples per peak, number of peaks, channels
+DAT_HEADER = struct.Struct('<iIiiIi')
+
+
+def peaks_path(stem_path):
+    """Path of the peaks sidecar of a stem file, `vocals.mp3` -> `vocals.peaks.dat`."""
+    return Path(stem_path).with_suffix(SUFFIX)
+
+
+class PeakBuilder:
+    """Min/max peaks of a stem at several resolutions, fed chunk by chunk.
+
+    Channels are merged, so each peak is the lowest and highest sample of any
+    channel in its block. Only the finest level is computed from the audio,
+    coarser ones are reduced from it.
+    """
+
+    def __init__(self, samplerate, levels=LEVELS):
+        self.samplerate = samplerate
+        self.levels = sorted(levels)
+        self.finest = self.levels[0]
+        if any(level % self.finest for level in self.levels):
+            raise ValueError(f"Waveform levels {levels} must all be multiples of {self.finest}")
+        self.mins = []
+        self.maxs = []
+        self.rest = None
+
+    def add(self, wav):
+        """Add a `[channels, frames]` chunk of the stem."""
+        wav = np.asarray(wav, dtype=np.float32)
+        if self.rest is not None:
+            wav = np.concatenate([self.rest, wav], axis=-1)
+        full = wav.shape[-1] - wav.shape[-1] % self.finest
+        blocks = wav[:, :full].reshape(wav.shape[0], -1, self.finest)
+        self.mins.append(blocks.min(axis=(0, 2)))
+        self.maxs.append(blocks.max(axis=(0, 2)))
+        self.rest = wav[:, full:]
+
+    def peaks(self):
+        """Return `{samples_per_peak: (mins, maxs)}`, the last block possibly partial."""
+        mins, maxs = list(self.mins), list(self.maxs)
+        if self.rest is not None and self.rest.size:
+            mins.append(np.array([self.rest.min()]))
+            maxs.append(np.array([self.rest.max()]))
+        mins = np.concatenate(mins) if mins else np.zeros(0, dtype=np.float32)
+        maxs = np.concatenate(maxs) if maxs else np.zeros(0, dtype=np.float32)
+
+        levels = {}
+        for level in self.levels:
+            if not len(mins):
+                levels[level] = (mins, maxs)
+                continue
+            starts = np.arange(0, len(mins), level // self.finest)
+            levels[level] = (np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts))
+        return levels
+
+    def write(self, path):
+        """Write every level as an 8 bit audiowaveform `.dat` (version 2), finest first.
+
+        The documents are concatenated; each header holds its number of
+        peaks, so readers split the file by walking the headers.
+        """
+        with open(path, 'wb') as f:
+            for level, (mins, maxs) in self.peaks().items():
+                data = np.empty(2 * len(mins), dtype=np.int8)
+                data[0::2] = quantize(mins)
+                data[1::2] = quantize(maxs)
+                f.write(DAT_HEADER.pack(2, 1, self.samplerate, level, len(mins), 1))
+                f.write(data.tobytes())
+        return str(path)
+
+
+def quantize(values):
+    """Scale float samples to 8 bit peak values."""
+    return np.clip(np.round(values * 127), -128, 127).astype(np.int8)
+
+
+def read_peaks(path):
+    """Read a peaks sidecar back as `{samples_per_peak: (mins, maxs)}` of floats."""
+    levels = {}
+    data = Path(path).read_bytes()
+    offset = 0
+    while offset < len(data):
+        _, _, _, level, length, channels = DAT_HEADER.unpack_from(data, offset)
+        offset += DAT_HEADER.size
+        values = np.frombuffer(data, dtype=np.int8, count=2 * length * channels, offset=offset)
+        offset += values.size
+        levels[level] = (values[0::2] / 127, values[1::2] / 127)
+    return levels